@@ -0,0 +1,223 @@
+"""adapter running the calls of a blocking database in a pool of threads."""
+import threading
+
+from twisted.internet.defer import Deferred, DeferredList, succeed, TimeoutError
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from twisted.python import log
+
+from . import data, utils
+
+
+class ThreadedDatabase(object):
+    """
+Runs the calls of a blocking database in a bounded pool of threads, so that the reactor is not blocked.
+Writes to the same key are run in order, reads of a key wait for the pending writes to this key and
+everything else runs concurrently.
+Calls to databases which are not threadsafe are serialized using a lock, but still run outside of the reactor.
+All methods return deferreds.
+"""
+    deadlines = True  # get() accepts a deadline
+
+    def __init__(self, db, reactor, threads=data.DEFAULT_THREADS, max_queue=data.MAX_THREAD_QUEUE):
+        self.db = db
+        self.lossy = getattr(db, "lossy", False)
+        self.reactor = reactor
+        self.threads = threads
+        self.max_queue = max_queue
+        self.pool = ThreadPool(minthreads=0, maxthreads=threads, name="kvndb-db")
+        self.pool.start()
+        self.shutdown_trigger = reactor.addSystemEventTrigger("after", "shutdown", self._shutdown)
+        if getattr(db, "threadsafe", False):
+            self.lock = None
+        else:
+            self.lock = threading.Lock()
+        self.tails = {}  # key -> deferred fired once the last pending write of key finished
+        self.reads = set()  # deferreds fired once a pending read finished
+        self.exclusive = None  # deferred of a running reset; all calls wait for it
+        self.queue_depth = 0  # calls submitted, but not yet finished
+        self.max_queue_depth = 0
+        self.calls = 0
+        self.drain_waiters = []
+
+    @property
+    def full(self):
+        """True if more calls than max_queue are waiting."""
+        return self.queue_depth >= self.max_queue
+
+    def drained(self):
+        """returns a deferred which will be called once the queue is less than half full."""
+        d = Deferred()
+        if self.queue_depth <= self.max_queue // 2:
+            d.callback(None)
+        else:
+            self.drain_waiters.append(d)
+        return d
+
+    def stats(self):
+        """returns a dict describing the load of the pool."""
+        return {
+            "threads": self.threads,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "calls": self.calls,
+            "pending_keys": len(self.tails),
+            }
+
+    def backend_stats(self):
+        """returns a deferred for the stats() of the database or an empty dict if it does not provide them."""
+        if not hasattr(self.db, "stats"):
+            return succeed({})
+        return self._submit(None, False, self.db.stats)
+
+    def _locked(self, f, *args):
+        """calls f while holding the lock."""
+        with self.lock:
+            return f(*args)
+
+    def _call(self, ignored, f, *args):
+        """runs f in the pool."""
+        if self.lock is None:
+            return deferToThreadPool(self.reactor, self.pool, f, *args)
+        return deferToThreadPool(self.reactor, self.pool, self._locked, f, *args)
+
+    def _submit(self, key, write, f, *args):
+        """runs f after the pending writes to key and a running reset. If write is True, later calls for key wait for this call."""
+        waits = []
+        if self.exclusive is not None:
+            waits.append(self.exclusive)
+        if key in self.tails:
+            waits.append(self.tails[key])
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self.calls += 1
+        if len(waits) == 0:
+            d = self._call(None, f, *args)
+        else:
+            d = DeferredList(waits)
+            d.addCallback(self._call, f, *args)
+        d.addBoth(self._finished)
+        if write:
+            tail = Deferred()
+            self.tails[key] = tail
+            d.addBoth(self._write_finished, key, tail)
+        else:
+            done = Deferred()
+            self.reads.add(done)
+            d.addBoth(self._read_finished, done)
+        return d
+
+    def _finished(self, result):
+        """called when a call finished."""
+        self.queue_depth -= 1
+        if len(self.drain_waiters) > 0 and self.queue_depth <= self.max_queue // 2:
+            waiters = self.drain_waiters
+            self.drain_waiters = []
+            for d in waiters:
+                d.callback(None)
+        return result
+
+    def _write_finished(self, result, key, tail):
+        """called when a write to key finished."""
+        if self.tails.get(key, None) is tail:
+            del self.tails[key]
+        tail.callback(None)
+        return result
+
+    def _read_finished(self, result, done):
+        """called when a read finished."""
+        self.reads.discard(done)
+        done.callback(None)
+        return result
+
+    def _log_failure(self, f):
+        """logs a failed write; the router does not wait for the result of writes."""
+        log.err(f, "Write failed:")
+
+    def _all_writes(self):
+        """returns a deferred which will be called once all pending writes and a running reset finished."""
+        waits = self.tails.values()
+        if self.exclusive is not None:
+            waits.append(self.exclusive)
+        if len(waits) == 0:
+            return succeed(None)
+        return DeferredList(waits)
+
+    def _all_calls(self):
+        """returns a deferred which will be called once all pending reads and writes and a running reset finished."""
+        waits = list(self.reads)
+        waits.append(self._all_writes())
+        return DeferredList(waits)
+
+    def get(self, key, deadline=None):
+        """returns a deferred for the value for key. If deadline passes before a thread is free, it fails with a TimeoutError."""
+        if deadline is None:
+            return self._submit(key, False, self.db.get, key)
+        return self._submit(key, False, self._get_before, key, deadline)
+
+    def _get_before(self, key, deadline):
+        """returns the value for key unless deadline passed. Runs in a thread."""
+        if self.reactor.seconds() >= deadline:
+            raise TimeoutError()
+        return self.db.get(key)
+
+    def set(self, key, value):
+        """sets key to value"""
+        d = self._submit(key, True, self.db.set, key, value)
+        d.addErrback(self._log_failure)
+        return d
+
+    def delete(self, key):
+        """deletes the key/value pair for key."""
+        d = self._submit(key, True, self.db.delete, key)
+        d.addErrback(self._log_failure)
+        return d
+
+    def getkeys(self):
+        """returns a deferred for a list of keys."""
+        return self._submit(None, False, self.db.getkeys)
+
+    def keyrange(self, start, end=None, limit=0, reverse=False):
+        """returns a deferred for a sorted list of the keys in [start, end). See utils.keyrange()."""
+        return self._submit(None, False, utils.keyrange, self.db, start, end, limit, reverse)
+
+    def sync(self):
+        """syncs the database once all writes submitted before finished."""
+        d = self._all_writes()
+        d.addCallback(self._call, getattr(self.db, "sync", lambda: None))
+        return d
+
+    def reset(self):
+        """resets the database once all pending calls finished. Calls submitted afterwards wait for the reset."""
+        d = self._all_calls()
+        d.addCallback(self._call, self.db.reset)
+        exclusive = Deferred()
+        self.exclusive = exclusive
+        d.addBoth(self._reset_finished, exclusive)
+        return d
+
+    def _reset_finished(self, result, exclusive):
+        """called when a reset finished."""
+        if self.exclusive is exclusive:
+            self.exclusive = None
+        exclusive.callback(None)
+        return result
+
+    def close(self):
+        """closes the database once all pending calls finished and stops the threads."""
+        d = self._all_calls()
+        d.addCallback(self._call, self.db.close)
+        d.addBoth(self._stop_pool)
+        return d
+
+    def _stop_pool(self, result):
+        """stops the threads."""
+        if self.shutdown_trigger is not None:
+            self.reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self._shutdown()
+        return result
+
+    def _shutdown(self):
+        """stops the threads when the reactor shuts down."""
+        self.shutdown_trigger = None
+        self.pool.stop()
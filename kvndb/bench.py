@@ -0,0 +1,431 @@
+"""benchmarks of a router, databases and load generating clients running on this host."""
+import os
+import sys
+import json
+import random
+import bisect
+
+from twisted.internet import endpoints
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
+from twisted.python.failure import Failure
+from twisted.python import log
+
+from . import data, router, dbproto, txclient, utils
+from .asyncdb import ThreadedDatabase
+
+
+class KeyChooser(object):
+    """chooses one of n keys, either uniformly or following a zipfian distribution with the given exponent."""
+    def __init__(self, n, distribution="uniform", exponent=data.DEFAULT_ZIPF_EXPONENT, rng=None):
+        if distribution not in data.BENCH_DISTRIBUTIONS:
+            raise ValueError("Unknown key distribution: '{d}'!".format(d=distribution))
+        self.n = n
+        self.distribution = distribution
+        self.rng = rng or random.Random()
+        self.cdf = None
+        if distribution == "zipf":
+            self.cdf = []
+            total = 0.0
+            for i in xrange(n):
+                total += 1.0 / (i + 1) ** exponent
+                self.cdf.append(total)
+
+    def next(self):
+        """returns the next key."""
+        if self.cdf is None:
+            i = self.rng.randrange(self.n)
+        else:
+            i = bisect.bisect_left(self.cdf, self.rng.random() * self.cdf[-1])
+        return "key{i}".format(i=i)
+
+
+def make_value(size, rng=None):
+    """returns a value of size bytes, which compresses like text."""
+    rng = rng or random.Random()
+    return "".join([rng.choice("0123456789abcdef") for i in xrange(size)])
+
+
+class LoadGenerator(object):
+    """
+Sends gets and sets over a ClientProtocol, keeping pipeline requests outstanding.
+read_ratio of the requests are gets. Sets wait for the acknowledgement of acks databases,
+so that their latency can be measured; acks must be at least 1.
+"""
+    def __init__(self, reactor, client, chooser, read_ratio, value, pipeline=16, acks=1, rng=None):
+        self.reactor = reactor
+        self.client = client
+        self.chooser = chooser
+        self.read_ratio = read_ratio
+        self.value = value
+        self.pipeline = pipeline
+        if acks < 1:
+            raise ValueError("Sets need the acknowledgement of at least one database to measure their latency!")
+        self.acks = acks
+        self.rng = rng or random.Random()
+        self.running = False
+        self.outstanding = 0
+        self.done = None
+        self.reset()
+
+    def reset(self):
+        """forgets the latencies measured so far, e.g. after warming up."""
+        self.reads = utils.Histogram()
+        self.writes = utils.Histogram()
+        self.misses = 0
+        self.errors = 0
+
+    def start(self, duration):
+        """sends requests for duration seconds. Returns a deferred which will be called once all answers arrived."""
+        self.running = True
+        self.done = Deferred()
+        for i in xrange(self.pipeline):
+            self.send()
+        self.reactor.callLater(duration, self.stop)
+        return self.done
+
+    def stop(self):
+        """stops sending requests."""
+        self.running = False
+        if self.outstanding == 0 and not self.done.called:
+            self.done.callback(self)
+
+    def send(self):
+        """sends the next request."""
+        key = self.chooser.next()
+        if self.rng.random() < self.read_ratio:
+            d = self.client.get(key)
+            histogram = self.reads
+        else:
+            d = self.client.set(key, self.value, acks=self.acks)
+            histogram = self.writes
+        self.outstanding += 1
+        d.addBoth(self._finished, histogram, self.reactor.seconds())
+
+    def _finished(self, result, histogram, started):
+        """called when a request was answered."""
+        self.outstanding -= 1
+        if isinstance(result, Failure):
+            if result.check(KeyError):
+                self.misses += 1
+                histogram.add(self.reactor.seconds() - started)
+            else:
+                self.errors += 1
+        else:
+            histogram.add(self.reactor.seconds() - started)
+        if self.running:
+            self.send()
+        elif self.outstanding == 0 and not self.done.called:
+            self.done.callback(self)
+
+    def to_dict(self):
+        """returns the measurements as a dict which can be serialized to JSON."""
+        return {"reads": self.reads.to_dict(), "writes": self.writes.to_dict(), "misses": self.misses, "errors": self.errors}
+
+
+@inlineCallbacks
+def run_load(
+    reactor, endpoint, password=None, duration=10.0, warmup=1.0, keys=10000, read_ratio=0.9, distribution="uniform",
+    exponent=data.DEFAULT_ZIPF_EXPONENT, value_size=1024, pipeline=16, acks=1, compression=None, seed=None,
+    ):
+    """
+connects a load generator to the router at endpoint, sends requests for warmup + duration seconds and returns
+a deferred for the dict of the measurements after the warmup. Used by the subprocesses of a Benchmark.
+"""
+    rng = random.Random(seed)
+    client = txclient.ClientProtocol(password, reactor=reactor, compression=compression)
+    yield endpoints.connectProtocol(endpoint, client)
+    yield client.callback
+    generator = LoadGenerator(
+        reactor, client, KeyChooser(keys, distribution, exponent, rng), read_ratio, make_value(value_size, rng),
+        pipeline, acks, rng,
+        )
+    d = generator.start(warmup + duration)
+    yield utils.dsleep(reactor, warmup)
+    generator.reset()
+    started = reactor.seconds()
+    yield d
+    result = generator.to_dict()
+    result["elapsed"] = reactor.seconds() - started
+    client.transport.loseConnection()
+    returnValue(result)
+
+
+class OutputCollector(ProcessProtocol):
+    """collects the output of a subprocess. ended is called with the output once the process exited."""
+    def __init__(self):
+        self.output = []
+        self.ended = Deferred()
+
+    def outReceived(self, s):
+        """called when the process wrote to stdout."""
+        self.output.append(s)
+
+    def processEnded(self, reason):
+        """called when the process exited."""
+        self.ended.callback("".join(self.output))
+
+
+class Benchmark(object):
+    """
+Starts a router, a number of databases and clients on this host and measures the throughput and the latencies.
+backend is the name of the database interface used as mode on the command line and db_class its class.
+If db_args is not empty, its first element is a path; every database uses this path with its index appended.
+The databases and load generating clients run in this process or, if processes is True, in subprocesses
+running the command line interface. Each client keeps pipeline requests outstanding, read_ratio of them gets.
+Keys are chosen uniformly or following a zipfian distribution. All keys are written before the benchmark.
+If resync is True, another database is reset while the benchmark runs and the time until it serves is measured.
+router_kwargs are passed to the RouterFactory.
+"""
+    def __init__(
+        self, reactor, backend, db_class, db_args=(), databases=2, clients=4, duration=10.0, warmup=1.0, keys=10000,
+        read_ratio=0.9, distribution="uniform", exponent=data.DEFAULT_ZIPF_EXPONENT, value_size=1024, pipeline=16, acks=1,
+        resync=False, processes=False, threads=data.DEFAULT_THREADS, compression=None, store_compressed=False,
+        router_kwargs=None, seed=None,
+        ):
+        if distribution not in data.BENCH_DISTRIBUTIONS:
+            raise ValueError("Unknown key distribution: '{d}'!".format(d=distribution))
+        self.reactor = reactor
+        self.backend = backend
+        self.db_class = db_class
+        self.db_args = list(db_args)
+        self.databases = databases
+        self.clients = clients
+        self.duration = duration
+        self.warmup = warmup
+        self.keys = keys
+        self.read_ratio = read_ratio
+        self.distribution = distribution
+        self.exponent = exponent
+        self.value_size = value_size
+        self.pipeline = pipeline
+        self.acks = acks
+        self.resync = resync
+        self.processes = processes
+        self.threads = threads
+        self.compression = compression
+        self.store_compressed = store_compressed
+        self.router_kwargs = router_kwargs or {}
+        self.rng = random.Random(seed)
+        self.factory = None
+        self.port = None
+        self.dbs = []  # in-process DatabaseClientProtocols
+        self.children = []  # OutputCollectors of the subprocesses
+        self.resync_time = None
+
+    def config(self):
+        """returns a dict describing the benchmark."""
+        return {
+            "backend": self.backend,
+            "databases": self.databases,
+            "clients": self.clients,
+            "duration": self.duration,
+            "warmup": self.warmup,
+            "keys": self.keys,
+            "read_ratio": self.read_ratio,
+            "distribution": self.distribution,
+            "exponent": self.exponent,
+            "value_size": self.value_size,
+            "pipeline": self.pipeline,
+            "acks": self.acks,
+            "resync": self.resync,
+            "processes": self.processes,
+            "compression": self.compression,
+            "store_compressed": self.store_compressed,
+            "router": self.router_kwargs,
+            }
+
+    def endpoint(self):
+        """returns a client endpoint for the router."""
+        return endpoints.TCP4ClientEndpoint(self.reactor, "127.0.0.1", self.port.getHost().port)
+
+    def args_for(self, i):
+        """returns the database arguments of the i-th database."""
+        if len(self.db_args) == 0 or not getattr(self.db_class, "blocking", True):
+            # databases in memory do not take a path
+            return list(self.db_args)
+        return ["{p}.{i}".format(p=self.db_args[0], i=i)] + self.db_args[1:]
+
+    def spawn(self, args):
+        """runs the command line interface with args in a subprocess and returns its OutputCollector."""
+        env = dict(os.environ)
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([path] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+        collector = OutputCollector()
+        self.reactor.spawnProcess(collector, sys.executable, [sys.executable, "-m", "kvndb"] + args, env=env)
+        self.children.append(collector)
+        return collector
+
+    def start_database(self, i, reset=False):
+        """starts the i-th database."""
+        if self.processes:
+            args = ["--threads", str(self.threads)]
+            if self.store_compressed:
+                args.append("--store-compressed")
+            if reset:
+                args += ["--reset", "--reset-sleep", "0"]
+            self.spawn(args + [self.backend, "127.0.0.1", str(self.port.getHost().port)] + self.args_for(i))
+            return
+        db = self.db_class(self.args_for(i))
+        if self.threads > 0 and getattr(db, "blocking", True):
+            db = ThreadedDatabase(db, self.reactor, threads=self.threads)
+        proto = dbproto.DatabaseClientProtocol(
+            db, None, self.reactor, reset=reset, reset_sleep_interval=0, store_compressed=self.store_compressed,
+            )
+        proto.callback.addErrback(log.err)
+        self.dbs.append(proto)
+        endpoints.connectProtocol(self.endpoint(), proto).addErrback(log.err)
+
+    @inlineCallbacks
+    def wait_for_servers(self, n):
+        """waits until n databases serve and none is syncing."""
+        started = self.reactor.seconds()
+        while len(self.factory.servers) < n or len(self.factory.syncing) > 0:
+            if self.reactor.seconds() - started > data.BENCH_START_TIMEOUT:
+                raise RuntimeError("Databases did not connect in time!")
+            yield utils.dsleep(self.reactor, 0.05)
+
+    @inlineCallbacks
+    def preload(self):
+        """writes all keys."""
+        client = txclient.ClientProtocol(None, reactor=self.reactor, compression=self.compression)
+        yield endpoints.connectProtocol(self.endpoint(), client)
+        yield client.callback
+        value = make_value(self.value_size, self.rng)
+        for start in xrange(0, self.keys, data.BENCH_PRELOAD_BATCH):
+            client.mset([("key{i}".format(i=i), value) for i in xrange(start, min(start + data.BENCH_PRELOAD_BATCH, self.keys))])
+        # the writes before are applied once this one was acknowledged
+        yield client.set("key0", value, acks=1)
+        client.transport.loseConnection()
+
+    @inlineCallbacks
+    def measure_resync(self):
+        """resets another database and measures the time until it serves."""
+        started = self.reactor.seconds()
+        self.start_database(self.databases, reset=True)
+        try:
+            yield self.wait_for_servers(self.databases + 1)
+        except RuntimeError:
+            log.msg("Database did not finish the reset in time.")
+            return
+        self.resync_time = self.reactor.seconds() - started
+
+    @inlineCallbacks
+    def generate_load(self):
+        """runs the load generators and returns a list of their measurements."""
+        if self.processes:
+            args = [
+                "--bench-role", "client", "--bench-duration", str(self.duration), "--bench-warmup", str(self.warmup),
+                "--bench-keys", str(self.keys), "--bench-reads", str(self.read_ratio), "--bench-distribution", self.distribution,
+                "--bench-zipf-exponent", str(self.exponent), "--bench-value-size", str(self.value_size),
+                "--bench-pipeline", str(self.pipeline), "--bench-acks", str(self.acks),
+                ]
+            if self.compression is not None:
+                args += ["--compression", str(self.compression)]
+            collectors = []
+            for i in xrange(self.clients):
+                seed = str(self.rng.randrange(2**32))
+                collectors.append(self.spawn(args + ["--bench-seed", seed, "bench", "127.0.0.1", str(self.port.getHost().port)]))
+            if self.resync:
+                yield utils.dsleep(self.reactor, self.warmup + self.duration / 3.0)
+                yield self.measure_resync()
+            outputs = yield DeferredList([collector.ended for collector in collectors])
+            returnValue([json.loads(output) for success, output in outputs])
+        generators = []
+        for i in xrange(self.clients):
+            client = txclient.ClientProtocol(None, reactor=self.reactor, compression=self.compression)
+            yield endpoints.connectProtocol(self.endpoint(), client)
+            yield client.callback
+            rng = random.Random(self.rng.randrange(2**32))
+            generators.append(LoadGenerator(
+                self.reactor, client, KeyChooser(self.keys, self.distribution, self.exponent, rng), self.read_ratio,
+                make_value(self.value_size, rng), self.pipeline, self.acks, rng,
+                ))
+        ds = [generator.start(self.warmup + self.duration) for generator in generators]
+        yield utils.dsleep(self.reactor, self.warmup)
+        started = self.reactor.seconds()
+        for generator in generators:
+            generator.reset()
+        if self.resync:
+            yield utils.dsleep(self.reactor, self.duration / 3.0)
+            yield self.measure_resync()
+        yield DeferredList(ds)
+        elapsed = self.reactor.seconds() - started
+        results = []
+        for generator in generators:
+            result = generator.to_dict()
+            result["elapsed"] = elapsed
+            results.append(result)
+            generator.client.transport.loseConnection()
+        returnValue(results)
+
+    @inlineCallbacks
+    def run(self):
+        """runs the benchmark and returns a deferred for a dict of the results."""
+        self.factory = router.RouterFactory(self.reactor, None, **self.router_kwargs)
+        self.port = yield endpoints.TCP4ServerEndpoint(self.reactor, 0, interface="127.0.0.1").listen(self.factory)
+        try:
+            for i in xrange(self.databases):
+                self.start_database(i)
+            yield self.wait_for_servers(self.databases)
+            yield self.preload()
+            results = yield self.generate_load()
+        finally:
+            yield self.stop()
+        returnValue(self.summarize(results))
+
+    def summarize(self, results):
+        """merges the measurements of the load generators."""
+        reads = utils.Histogram()
+        writes = utils.Histogram()
+        misses = errors = 0
+        elapsed = 0.0
+        for result in results:
+            reads.merge(utils.Histogram.from_dict(result["reads"]))
+            writes.merge(utils.Histogram.from_dict(result["writes"]))
+            misses += result["misses"]
+            errors += result["errors"]
+            elapsed = max(elapsed, result["elapsed"])
+        total = utils.Histogram()
+        total.merge(reads)
+        total.merge(writes)
+        summary = {
+            "config": self.config(),
+            "elapsed": round(elapsed, 3),
+            "requests": total.total,
+            "throughput": round(total.total / elapsed, 1) if elapsed > 0 else 0.0,
+            "misses": misses,
+            "errors": errors,
+            "latency": total.summary(),
+            "reads": reads.summary(),
+            "writes": writes.summary(),
+            }
+        if self.resync:
+            summary["resync_time"] = self.resync_time
+        return summary
+
+    @inlineCallbacks
+    def stop(self):
+        """stops the databases and the router."""
+        for proto in self.dbs:
+            if proto.transport is not None:
+                proto.transport.loseConnection()
+        running = []
+        for collector in self.children:
+            if not collector.ended.called:
+                collector.transport.signalProcess("TERM")
+                running.append(collector.ended)
+        if len(running) > 0:
+            yield DeferredList(running)
+        if self.port is not None:
+            yield self.port.stopListening()
+
+
+def write_result(result, path=None):
+    """writes the result of a benchmark as JSON to the file at path or to stdout."""
+    s = json.dumps(result, indent=4, sort_keys=True)
+    if path is None:
+        sys.stdout.write(s + "\n")
+    else:
+        with open(path, "w") as f:
+            f.write(s + "\n")
@@ -0,0 +1,122 @@
+"""a size bounded value cache."""
+import collections
+import time
+
+from . import data
+
+
+class LRUCache(object):
+    """
+A least-recently-used cache for key/value pairs with a memory budget in bytes.
+Values fetched asynchronously should be added using begin_fill() and end_fill(),
+so that a value is not cached if the key was written while the fetch was running.
+If max_age is not None, entries expire max_age seconds after they were stored.
+"""
+    def __init__(self, maxsize, max_age=None, clock=time.time):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.clock = clock
+        self.size = 0
+        self.entries = collections.OrderedDict()  # key -> (value, expiration time or None)
+        self.epoch = 0  # incremented on every write
+        self.pending = {}  # key -> number of running fills
+        self.written = {}  # key -> epoch of the last write, only for keys with running fills
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @staticmethod
+    def entry_size(key, value):
+        """returns the approximate memory used by an entry."""
+        return len(key) + len(value) + data.CACHE_ENTRY_OVERHEAD
+
+    def get(self, key):
+        """returns the cached value for key. Raises KeyError if not cached."""
+        try:
+            value, expires = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires is not None and expires < self.clock():
+            self.size -= self.entry_size(key, value)
+            self.misses += 1
+            raise KeyError(key)
+        self.entries[key] = (value, expires)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """a write of value to key."""
+        self._written(key)
+        self._store(key, value)
+
+    def invalidate(self, key):
+        """a delete of key."""
+        self._written(key)
+        self._remove(key)
+
+    def begin_fill(self, key):
+        """called before a value for key is fetched. returns a token for end_fill()."""
+        self.pending[key] = self.pending.get(key, 0) + 1
+        return self.epoch
+
+    def end_fill(self, key, token, value=None):
+        """called when a fetch started with begin_fill() finished. The value is only cached if key was not written in between."""
+        if value is not None and self.written.get(key, token) <= token:
+            self._store(key, value)
+        n = self.pending.get(key, 1) - 1
+        if n <= 0:
+            self.pending.pop(key, None)
+            self.written.pop(key, None)
+        else:
+            self.pending[key] = n
+
+    def clear(self):
+        """removes all entries."""
+        self.epoch += 1
+        for key in self.pending:
+            self.written[key] = self.epoch
+        self.entries.clear()
+        self.size = 0
+
+    def hit_ratio(self):
+        """returns the ratio of lookups answered from the cache."""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def _written(self, key):
+        """records a write of key."""
+        self.epoch += 1
+        if key in self.pending:
+            self.written[key] = self.epoch
+
+    def _store(self, key, value):
+        """stores value for key, evicting old entries if required."""
+        self._remove(key)
+        size = self.entry_size(key, value)
+        if size > self.maxsize:
+            return
+        if self.max_age is None:
+            expires = None
+        else:
+            expires = self.clock() + self.max_age
+        self.entries[key] = (value, expires)
+        self.size += size
+        while self.size > self.maxsize:
+            oldkey, (oldvalue, expires) = self.entries.popitem(last=False)
+            self.size -= self.entry_size(oldkey, oldvalue)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """removes key from the cache."""
+        if key in self.entries:
+            value, expires = self.entries.pop(key)
+            self.size -= self.entry_size(key, value)
@@ -1,5 +1,6 @@
 """Command line client interface."""
 import cmd
+import json
 import shlex
 
 from twisted.internet import threads
@@ -53,7 +54,7 @@ class KVNDBCmdClient(cmd.Cmd):
     do_show = do_view = do_print = do_get
 
     def do_getkeys(self, cmd):
-        """getkeys [COLUMNS]: show a list of all keys."""
+        """getkeys [COLUMNS]: show a sorted list of all keys."""
         if cmd:
             try:
                 cols = int(cmd)
@@ -62,21 +63,80 @@ class KVNDBCmdClient(cmd.Cmd):
                 return
         else:
             cols = 2
+        self.show_keyrange("", None, 0, cols)
+
+    do_keys = do_list = do_getkeys
+
+    def do_range(self, cmd):
+        """range START [END [LIMIT]]: show the sorted keys from START up to, but excluding, END. '-' for END means no end."""
+        args = shlex.split(cmd)
+        if not 1 <= len(args) <= 3:
+            self.stdout.write("Error: Expected 1 to 3 arguments, got {n} instead!\n".format(n=len(args)))
+            return
+        end = None
+        limit = 0
+        if len(args) > 1 and args[1] != "-":
+            end = args[1]
+        if len(args) > 2:
+            try:
+                limit = int(args[2])
+            except ValueError:
+                self.stdout.write("Error: Invalid limit!\n")
+                return
+        self.show_keyrange(args[0], end, limit)
+
+    def do_prefix(self, cmd):
+        """prefix PREFIX [LIMIT]: show the sorted keys starting with PREFIX."""
+        args = shlex.split(cmd)
+        if not 1 <= len(args) <= 2:
+            self.stdout.write("Error: Expected 1 or 2 arguments, got {n} instead!\n".format(n=len(args)))
+            return
+        limit = 0
+        if len(args) > 1:
+            try:
+                limit = int(args[1])
+            except ValueError:
+                self.stdout.write("Error: Invalid limit!\n")
+                return
+        self.show_keyrange(args[0], utils.prefix_end(args[0]), limit)
+
+    def show_keyrange(self, start, end, limit, cols=1):
+        """shows the sorted keys in [start, end) in cols columns. Falls back to sorting all keys if the router does not support key ranges."""
+        try:
+            if self.proto.keyranges:
+                keys = threads.blockingCallFromThread(
+                    self.reactor, self.proto.keyrange, start, end, limit,
+                    )
+            else:
+                keys = threads.blockingCallFromThread(
+                    self.reactor, self.proto.getkeys,
+                    )
+                keys = utils.filter_keyrange(keys, start, end, limit)
+        except Exception as e:
+            self.stdout.write("Error: {e}\n".format(e=e))
+            return
+        formated = utils.fmtcols(keys, cols)
+        if not formated.endswith("\n"):
+            formated += "\n"
+        self.stdout.write(formated)
+
+    def do_stats(self, cmd):
+        """stats [SECTION]: show the statistics of the router and the databases or only the given section."""
         try:
-            keys = threads.blockingCallFromThread(
-                self.reactor, self.proto.getkeys,
+            stats = threads.blockingCallFromThread(
+                self.reactor, self.proto.stats, data.STATS_TIMEOUT * 2,
                 )
         except Exception as e:
             self.stdout.write("Error: {e}\n".format(e=e))
             return
-        else:
-            sk = sorted(keys)
-            formated = utils.fmtcols(sk, cols)
-            if not formated.endswith("\n"):
-                formated += "\n"
-            self.stdout.write(formated)
+        if cmd:
+            if cmd not in stats:
+                self.stdout.write("Error: Unknown section '{s}'!\n".format(s=cmd))
+                return
+            stats = stats[cmd]
+        self.stdout.write(json.dumps(stats, indent=2, sort_keys=True) + "\n")
 
-    do_keys = do_list = do_getkeys
+    do_info = do_stats
 
     def defer_entry(self, proto):
         """
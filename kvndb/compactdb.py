@@ -0,0 +1,370 @@
+"""A compact in memory database for many small keys."""
+from array import array
+
+from . import data
+
+
+SLOT_EMPTY = -1
+SLOT_DELETED = -2
+TAG_BITS = 24  # bits of the hash stored in a slot next to the offset, so most mismatches need no key comparison
+TAG_MASK = 2**TAG_BITS - 1
+HASH_MASK = 2**64 - 1
+
+
+def pack_length(n):
+    """returns n as a varint."""
+    if n < 0x80:
+        return chr(n)
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return "".join(out)
+
+
+def unpack_length(buf, offset):
+    """reads a varint from buf at offset. Returns (length, offset after the varint)."""
+    b = buf[offset]
+    if b < 0x80:
+        return b, offset + 1
+    n = 0
+    shift = 0
+    while b >= 0x80:
+        n |= (b & 0x7f) << shift
+        shift += 7
+        offset += 1
+        b = buf[offset]
+    return n | (b << shift), offset + 1
+
+
+class CompactDatabase(object):
+    """
+A database living in the memory, using much less memory per key than RamDatabase.
+All records (varint keylength, varint valuelength, key, value) are appended to a single bytearray arena.
+The index is an open-addressing hash table of a single array of machine words: every slot holds the offset
+of a record shifted left by TAG_BITS and the highest TAG_BITS bits of the hash of its key.
+Old records are dead space until the arena is compacted, which happens once most of it is dead.
+Growing the index and compacting the arena are done in small steps, scheduled on the reactor and run
+by the writes, so that no call blocks for long: a growing index allocates the new table in chunks and
+then moves the keys from the old table to it, and the compaction slides the live records to the front
+of the arena.
+The optional argument is the number of keys to size the index for, so that it does not need to be resized.
+"""
+    blocking = False  # calls return immediately; no need for a thread pool
+    threadsafe = False  # compaction moves the records
+
+    def __init__(self, args):
+        self.args = args
+        if len(self.args) > 1:
+            raise ValueError("Expected at most the expected number of keys as argument for the DB.")
+        if len(self.args) == 1:
+            self.capacity = int(args[0])
+        else:
+            self.capacity = 0
+        self.reactor = None  # used to schedule the steps; defaults to the global reactor
+        self.call = None  # the scheduled step
+        self.generation = 0  # incremented for every new table, so that iterators notice a resize
+        self.reset()
+
+    def _slots_for(self, n):
+        """returns the number of slots for n keys, so that at most half of them are used."""
+        size = data.COMPACTDB_MIN_SLOTS
+        while n * 2 > size:
+            size *= 2
+        return size
+
+    def _hash(self, key):
+        """returns (hash, tag) for key."""
+        h = hash(key) & HASH_MASK
+        return h, (h >> (64 - TAG_BITS)) & TAG_MASK
+
+    def _record(self, offset):
+        """returns (key start, value start, value end) of the record at offset."""
+        keylength, i = unpack_length(self.arena, offset)
+        valuelength, i = unpack_length(self.arena, i)
+        return i, i + keylength, i + keylength + valuelength
+
+    def _find(self, slots, key, h, tag):
+        """returns the position of the slot of key in the table slots or -1 if key is not stored in it."""
+        mask = len(slots) - 1
+        i = h & mask
+        keylength = len(key)
+        while True:
+            slot = slots[i]
+            if slot == SLOT_EMPTY:
+                return -1
+            if slot >= 0 and slot & TAG_MASK == tag:
+                start, vstart, end = self._record(slot >> TAG_BITS)
+                if vstart - start == keylength and self.arena[start:vstart] == key:
+                    return i
+            i = (i + 1) & mask
+
+    def _lookup(self, key, h, tag):
+        """returns (table, position) of the slot of key or (None, -1) if key is not stored."""
+        i = self._find(self.slots, key, h, tag)
+        if i >= 0:
+            return self.slots, i
+        if self.old is not None:
+            i = self._find(self.old, key, h, tag)
+            if i >= 0:
+                return self.old, i
+        return None, -1
+
+    def _insert(self, h, slot):
+        """stores slot in the first free slot of the current table for the hash h."""
+        slots = self.slots
+        mask = len(slots) - 1
+        i = h & mask
+        while slots[i] >= 0:
+            i = (i + 1) & mask
+        if slots[i] == SLOT_EMPTY:
+            self.used += 1
+        slots[i] = slot
+
+    def get(self, key):
+        """returns the value for key."""
+        slots, i = self._lookup(key, *self._hash(key))
+        if slots is None:
+            raise KeyError(key)
+        start, vstart, end = self._record(slots[i] >> TAG_BITS)
+        return str(self.arena[vstart:end])
+
+    def set(self, key, value):
+        """sets key to value"""
+        h, tag = self._hash(key)
+        slots, i = self._lookup(key, h, tag)
+        if slots is not None:
+            offset = slots[i] >> TAG_BITS
+            start, vstart, end = self._record(offset)
+            if end - vstart == len(value):
+                # same size, e.g. a counter: overwrite in place
+                self.arena[vstart:end] = value
+                return
+            self.dead += end - offset
+            slots[i] = (len(self.arena) << TAG_BITS) | tag
+        else:
+            if self.used + 1 > len(self.slots) * data.COMPACTDB_MAX_LOAD:
+                self._grow()
+            self._insert(h, (len(self.arena) << TAG_BITS) | tag)
+            self.keys += 1
+        self.arena += pack_length(len(key)) + pack_length(len(value)) + key + value
+        self._maybe_compact()
+        self._work(data.COMPACTDB_WRITE_STEP)
+
+    def delete(self, key):
+        """deletes the key/value pair for key."""
+        slots, i = self._lookup(key, *self._hash(key))
+        if slots is None:
+            return
+        offset = slots[i] >> TAG_BITS
+        self.dead += self._record(offset)[2] - offset
+        slots[i] = SLOT_DELETED
+        self.keys -= 1
+        self._maybe_compact()
+        self._work(data.COMPACTDB_WRITE_STEP)
+
+    def _grow(self):
+        """starts allocating a new table with room for more keys. Switches to it early if the current table is full."""
+        if self.growing is None:
+            self.growing = array("l")
+            self.growing_size = self._slots_for(self.keys + 1)
+            self._schedule()
+        if self.used + 1 > len(self.slots) * data.COMPACTDB_MAX_FILL:
+            # the keys were added faster than the table was allocated
+            self._alloc_step(self.growing_size)
+
+    def _alloc_step(self, n):
+        """allocates up to n slots of the new table and starts moving the keys to it once it is complete."""
+        growing = self.growing
+        n = min(n, self.growing_size - len(growing))
+        growing.extend(array("l", [SLOT_EMPTY]) * n)
+        if len(growing) < self.growing_size:
+            return
+        if self.old is not None:
+            # the keys were added faster than they were moved
+            self._resize_step(len(self.old))
+        self.growing = None
+        self.old = self.slots
+        self.old_position = 0
+        self.slots = growing
+        self.used = 0
+        self.generation += 1
+
+    def _resize_step(self, n):
+        """moves the keys of up to n slots of the old table to the current one."""
+        old = self.old
+        i = self.old_position
+        end = min(i + n, len(old))
+        while i < end:
+            slot = old[i]
+            if slot >= 0:
+                start, vstart, rend = self._record(slot >> TAG_BITS)
+                self._insert(self._hash(str(self.arena[start:vstart]))[0], slot)
+                # keeps the probe sequences of the old table intact
+                old[i] = SLOT_DELETED
+            i += 1
+        self.old_position = i
+        if i == len(old):
+            self.old = None
+
+    def _maybe_compact(self):
+        """starts compacting the arena if enough of it is dead."""
+        if self.compact_position is not None:
+            return
+        if len(self.arena) >= data.COMPACTDB_MIN_COMPACT_SIZE and self.dead >= len(self.arena) * data.COMPACTDB_COMPACT_RATIO:
+            self.compact_position = 0
+            self.compact_end = 0
+            self._schedule()
+
+    def _compact_step(self, n):
+        """slides up to n records at the compaction position to the end of the compacted records."""
+        arena = self.arena
+        position = self.compact_position
+        out = self.compact_end
+        while n > 0 and position < len(arena):
+            start, vstart, end = self._record(position)
+            key = str(arena[start:vstart])
+            h, tag = self._hash(key)
+            slots, i = self._lookup(key, h, tag)
+            if slots is not None and slots[i] >> TAG_BITS == position:
+                # the record is live
+                if out != position:
+                    arena[out:out + end - position] = arena[position:end]
+                    slots[i] = (out << TAG_BITS) | tag
+                out += end - position
+            position = end
+            n -= 1
+        if position == len(arena):
+            # the records between the compacted ones and the end are dead
+            self.dead -= position - out
+            del arena[out:]
+            self.compact_position = None
+            self.compactions += 1
+        else:
+            self.compact_position = position
+            self.compact_end = out
+
+    def _work(self, n):
+        """runs up to n steps of a running resize and of a running compaction."""
+        if self.growing is not None:
+            self._alloc_step(data.COMPACTDB_ALLOC_STEP)
+        if self.old is not None:
+            self._resize_step(n)
+        if self.compact_position is not None:
+            self._compact_step(n)
+
+    def _schedule(self):
+        """schedules a step if a resize or a compaction is running."""
+        if self.call is not None or (self.growing is None and self.old is None and self.compact_position is None):
+            return
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.call = self.reactor.callLater(0, self._step)
+
+    def _step(self):
+        """runs a scheduled step and schedules the next one."""
+        self.call = None
+        self._work(data.COMPACTDB_STEP)
+        self._schedule()
+
+    def compact(self):
+        """compacts the whole arena at once."""
+        if self.compact_position is None:
+            self.compact_position = 0
+            self.compact_end = 0
+        while self.compact_position is not None:
+            self._compact_step(data.COMPACTDB_STEP)
+
+    def getkeys(self):
+        """returns a list of keys."""
+        return list(self.iterkeys())
+
+    def iterkeys(self):
+        """
+returns an iterator walking the slots of the index, without copying the keys first.
+The keys stored during the whole iteration are returned at least once; keys moved to a new table while
+the index grows may be returned twice.
+"""
+        generation = self.generation
+        if self.old is not None:
+            generation -= 1
+        i = 0
+        while True:
+            if generation == self.generation:
+                slots = self.slots
+            elif generation == self.generation - 1 and self.old is not None:
+                slots = self.old
+            else:
+                # the table was dropped once all of its keys were moved to the newer ones
+                if self.old is not None and self.generation - 1 > generation:
+                    generation = self.generation - 1
+                else:
+                    generation = self.generation
+                i = 0
+                continue
+            if i >= len(slots):
+                if generation == self.generation:
+                    return
+                generation += 1
+                i = 0
+                continue
+            slot = slots[i]
+            i += 1
+            if slot >= 0:
+                start, vstart, end = self._record(slot >> TAG_BITS)
+                yield str(self.arena[start:vstart])
+
+    def memory(self):
+        """returns the memory used by the arena and the index."""
+        memory = len(self.arena)
+        for slots in (self.slots, self.old, self.growing):
+            if slots is not None:
+                memory += len(slots) * slots.itemsize
+        return memory
+
+    def stats(self):
+        """returns a dict with the number of keys, the bytes stored and the memory used."""
+        return {
+            "keys": self.keys,
+            "bytes": len(self.arena) - self.dead,
+            "dead_bytes": self.dead,
+            "memory": self.memory(),
+            "slots": len(self.slots),
+            "resizing": self.growing is not None or self.old is not None,
+            "compacting": self.compact_position is not None,
+            "compactions": self.compactions,
+            }
+
+    def sync(self):
+        """no-op."""
+        pass
+
+    def reset(self):
+        """resets the database."""
+        self._cancel()
+        size = self._slots_for(self.capacity)
+        self.slots = array("l", [SLOT_EMPTY]) * size
+        self.growing = None  # the new table while it is allocated
+        self.growing_size = 0
+        self.old = None  # the table the keys are moved from while the index grows
+        self.old_position = 0  # the next slot of the old table to move
+        self.generation += 1
+        self.used = 0  # slots of the current table which are not empty, including deleted ones
+        self.keys = 0
+        self.arena = bytearray()
+        self.dead = 0  # bytes of the arena used by deleted and old records
+        self.compact_position = None  # the next record to compact or None if the arena is not compacted
+        self.compact_end = 0  # end of the compacted records
+        self.compactions = 0
+
+    def _cancel(self):
+        """cancels the scheduled step."""
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def close(self):
+        """cancels the scheduled step."""
+        self._cancel()
@@ -9,8 +9,33 @@ ID_ANSWER = "\x05"
 ID_NOTFOUND = "\x06"
 ID_ALLKEYS = "\x07"
 ID_SWITCH = "\x08"
+ID_MGET = "\x09"
+ID_MSET = "\x0a"
+ID_MDEL = "\x0b"
+ID_MANSWER = "\x0c"
+ID_SCAN = "\x0d"
+ID_SCANANSWER = "\x0e"
+ID_TRACK = "\x0f"
+ID_INVALIDATE = "\x10"
+ID_FLUSH = "\x11"
+ID_SNAPSHOT = "\x12"
+ID_SNAPSHOTCHUNK = "\x13"
+ID_SNAPSHOTEND = "\x14"
+ID_SEQ = "\x15"
+ID_CATCHUP = "\x16"
+ID_ACKWRITE = "\x17"
+ID_SYNC = "\x18"
+ID_ACK = "\x19"
+ID_ROUTERS = "\x1a"
+ID_DEADLINE = "\x1b"
+ID_CANCEL = "\x1c"
+ID_EXPIRED = "\x1d"
+ID_STATS = "\x1e"
+ID_KEYRANGE = "\x1f"
 
-VERSION = 1
+OPCODE_NAMES = dict([(value, name[3:].lower()) for name, value in globals().items() if name.startswith("ID_")])
+
+VERSION = 3
 VERSION_FORMAT = "!Q"
 VERSION_LENGTH = struct.calcsize(VERSION_FORMAT)
 
@@ -23,21 +48,134 @@ MODE_ERROR = "\x06"
 MODE_CONNECTING = "\x07"
 MODE_RANGE = "\x08"
 
+CAP_COMPRESSION = 1  # every value carries a VALUE_* flag byte and may be compressed
+CAP_LOSSY = 2  # the database evicts keys; a key missing on it may exist on the other databases
+CAP_KEYRANGE = 4  # the peer handles ID_KEYRANGE; the router filters all keys of databases which do not
+SUPPORTED_CAPS = CAP_COMPRESSION | CAP_LOSSY | CAP_KEYRANGE
+CAPS_FORMAT = "!L"  # bitmask of capabilities appended to the mode and the range during the handshake
+CAPS_SIZE = struct.calcsize(CAPS_FORMAT)
+
+VALUE_RAW = "\x00"
+VALUE_ZLIB = "\x01"
+DEFAULT_COMPRESSION_THRESHOLD = 1024  # values smaller than this many bytes are not compressed
+
 STATE_OK = "O"
 STATE_ERROR = "E"
 STATE_PASSWORD_REQUIRED = "P"
 
 MESSAGE_LENGTH_FORMAT = "!Q"
 MESSAGE_LENGTH_SIZE = struct.calcsize(MESSAGE_LENGTH_FORMAT)
+MAX_MESSAGE_LENGTH = 2**28  # batch answers may be much larger than the default limit of 99999 bytes
 MESSAGE_KEY_LENGTH_FORMAT = "!L"
 MESSAGE_KEY_LENGTH_SIZE = struct.calcsize(MESSAGE_KEY_LENGTH_FORMAT)
-MESSAGE_ID_FORMAT = "!I"
+MESSAGE_VALUE_LENGTH_FORMAT = "!L"
+MESSAGE_VALUE_LENGTH_SIZE = struct.calcsize(MESSAGE_VALUE_LENGTH_FORMAT)
+MESSAGE_ID_FORMAT = "!Q"
 MESSAGE_ID_SIZE = struct.calcsize(MESSAGE_ID_FORMAT)
+CURSOR_FORMAT = "!Q"
+CURSOR_SIZE = struct.calcsize(CURSOR_FORMAT)
+SCAN_FORMAT = "!QL"  # cursor, count
+SCAN_SIZE = struct.calcsize(SCAN_FORMAT)
+KEYRANGE_FORMAT = "!LB"  # limit, flags; followed by the start key and optionally the end key
+KEYRANGE_SIZE = struct.calcsize(KEYRANGE_FORMAT)
+KEYRANGE_REVERSE = 1  # the largest keys first
+SEQ_FORMAT = "!Q"
+SEQ_SIZE = struct.calcsize(SEQ_FORMAT)
+CATCHUP_FORMAT = "!QQ"  # epoch, sequence number
+CATCHUP_SIZE = struct.calcsize(CATCHUP_FORMAT)
+DEADLINE_FORMAT = "!L"  # milliseconds left until the deadline of a read
+DEADLINE_SIZE = struct.calcsize(DEADLINE_FORMAT)
+MAX_DEADLINE = 2**32 - 1
+
+# precompiled, so that the headers of a message are parsed in place using unpack_from(msg, offset)
+MESSAGE_LENGTH_STRUCT = struct.Struct(MESSAGE_LENGTH_FORMAT)
+MESSAGE_KEY_LENGTH_STRUCT = struct.Struct(MESSAGE_KEY_LENGTH_FORMAT)
+MESSAGE_VALUE_LENGTH_STRUCT = struct.Struct(MESSAGE_VALUE_LENGTH_FORMAT)
+MESSAGE_ID_STRUCT = struct.Struct(MESSAGE_ID_FORMAT)
+CURSOR_STRUCT = struct.Struct(CURSOR_FORMAT)
+SCAN_STRUCT = struct.Struct(SCAN_FORMAT)
+KEYRANGE_STRUCT = struct.Struct(KEYRANGE_FORMAT)
+SEQ_STRUCT = struct.Struct(SEQ_FORMAT)
+CATCHUP_STRUCT = struct.Struct(CATCHUP_FORMAT)
+DEADLINE_STRUCT = struct.Struct(DEADLINE_FORMAT)
+CAPS_STRUCT = struct.Struct(CAPS_FORMAT)
 
 DEFAULT_PORT = 54565
 
 INVALID_PASSWORD_SLEEP_INTERVAL = 3
 
-RANGE = 2**20
+DEFAULT_SCAN_COUNT = 1024
+MAX_OPEN_SCANS = 1024
+SORTED_BLOCK_SIZE = 1024  # keys per block of a sorted index before it is split
+ITERKEYS_BATCH = 1024  # keys read from a sorted index at once while iterating over it
+
+RESET_MODES = ("snapshot", "scan")
+DEFAULT_RESET_MODE = "snapshot"
+SNAPSHOT_CHUNK_SIZE = 2**20  # bytes of key/value pairs per snapshot chunk
+SNAPSHOT_READ_BATCH = 128  # values read from the database at once while sending a snapshot
+SNAPSHOT_PROGRESS_INTERVAL = 5.0  # seconds between progress messages during a snapshot transfer
+
+DEFAULT_WRITE_LOG_SIZE = 64 * 2**20  # bytes of recent writes kept by the router for databases catching up
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+SEQ_SAVE_INTERVAL = 1.0  # seconds between saves of the sequence number of a database
+DEFAULT_THREADS = 4  # threads used for calls to blocking databases
+MAX_THREAD_QUEUE = 1024  # database calls waiting for a thread before the database stops reading requests
+GROUP_COMMIT_WINDOW = 0.005  # seconds a database waits for more writes before syncing them together
+COMMIT_RETRY_INTERVAL = 1.0  # seconds before a database retries a failed sync
+ROUTER_REFRESH_INTERVAL = 30.0  # seconds between requests for the list of routers by a client pool
+DEFAULT_QUEUE_HIGH = 16 * 2**20  # bytes of queued writes to a database after which the router stops reading from clients
+DEFAULT_QUEUE_LOW = 4 * 2**20  # bytes of queued writes below which the router continues reading
+
+BENCH_DISTRIBUTIONS = ("uniform", "zipf")
+DEFAULT_ZIPF_EXPONENT = 0.99
+BENCH_PRELOAD_BATCH = 1000  # keys written per batch before a benchmark
+BENCH_START_TIMEOUT = 60.0  # seconds the databases of a benchmark may take to connect or reset
+
+HISTOGRAM_PERCENTILES = (50, 95, 99, 99.9)  # reported by latency histograms
+HISTOGRAM_BASE = 1.01  # ratio between the bounds of two latency buckets; about 1% precision
+STATS_RATE_INTERVAL = 10.0  # seconds over which the request rates reported by a router are measured
+STATS_TIMEOUT = 5.0  # seconds a router waits for the statistics of a database
+SLOW_LOG_SIZE = 128  # slow requests kept for the statistics
+PROFILE_SIGNAL = "SIGUSR2"  # toggles the profiler
+
+READ_POLICIES = ("random", "least", "p2c")
+DEFAULT_READ_POLICY = "p2c"
+LATENCY_EWMA_ALPHA = 0.1
+
+DEFAULT_HEDGE_BUDGET = 0.05  # max ratio of gets which may be hedged
+HEDGE_SAMPLES = 1024  # number of recent get latencies used for the hedging delay
+HEDGE_MIN_SAMPLES = 128
+HEDGE_RECOMPUTE_INTERVAL = 128
+
+CACHE_ENTRY_OVERHEAD = 128  # approximate memory used by a cache entry in addition to key and value
+DEFAULT_NEAR_CACHE_MAX_AGE = 30.0
+ROUTER_CACHE_MAX_AGE = 1.0  # seconds a router caches a value if other routers may write it
+MAX_TRACKED_KEYS = 2**16  # per client; if exceeded the whole near cache of the client is invalidated
+
+RANGE = 2**32  # request ids of a connection
+MAX_ROUTERS = 16  # the rid ranges are partitioned between this many routers
 RANGE_FORMAT = "!QQ"
 RANGE_SIZE = struct.calcsize(RANGE_FORMAT)
+
+RING_HASH_FORMAT = "!Q"
+RING_HASH_SIZE = struct.calcsize(RING_HASH_FORMAT)
+DEFAULT_VNODES = 64
+REBALANCE_DELAY = 1.0
+
+RAMDB_EVICTION_POLICIES = ("lru", "lfu", "random")
+DEFAULT_RAMDB_EVICTION_POLICY = "lru"
+RAMDB_ENTRY_OVERHEAD = 128  # approximate memory used by a key of a RamDatabase in addition to key and value
+RAMDB_LFU_SAMPLES = 5  # keys compared when evicting the least frequently used key
+
+COMPACTDB_MIN_SLOTS = 1024  # must be a power of 2
+COMPACTDB_MAX_LOAD = 0.75  # ratio of used slots (including deleted ones) after which the index of a CompactDatabase is rebuilt
+COMPACTDB_COMPACT_RATIO = 0.5  # compact the arena once this ratio of it is used by old records
+COMPACTDB_MIN_COMPACT_SIZE = 2**20  # smaller arenas are not compacted
+COMPACTDB_STEP = 1024  # slots or records moved by a scheduled step of a resize or compaction of a CompactDatabase
+COMPACTDB_WRITE_STEP = 4  # slots or records moved by every write while a resize or compaction is running
+COMPACTDB_ALLOC_STEP = 2**16  # slots of the new table of a growing CompactDatabase allocated by a step
+COMPACTDB_MAX_FILL = 0.9  # ratio of used slots after which a growing index stops waiting for its new table
+
+LOGDB_SEGMENT_SIZE = 64 * 2**20  # bytes after which the active segment of a LogDatabase is rotated
+LOGDB_MERGE_RATIO = 0.5  # merge once this ratio of the immutable segments is dead
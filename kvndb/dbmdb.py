@@ -1,9 +1,15 @@
 """anydbm database interface."""
+import os
 import anydbm
 
+DBM_SUFFIXES = ("", ".db", ".dat", ".dir", ".pag")  # files created by the dbm modules
+
 
 class DbmDatabase(object):
     """A anydbm database"""
+    blocking = True
+    threadsafe = False
+
     def __init__(self, args):
         self.args = args
         if len(self.args) != 1:
@@ -33,6 +39,29 @@ class DbmDatabase(object):
         """returns a list of keys."""
         return self.db.keys()
 
+    def iterkeys(self):
+        """returns an iterator over the keys, walking the database if supported by the dbm module."""
+        if hasattr(self.db, "firstkey"):
+            # gdbm
+            key = self.db.firstkey()
+            while key is not None:
+                yield key
+                key = self.db.nextkey(key)
+        else:
+            for key in self.db.keys():
+                yield key
+
+    def stats(self):
+        """returns a dict with the number of keys and the size of the database files."""
+        paths = [self.path + suffix for suffix in DBM_SUFFIXES]
+        size = sum([os.path.getsize(path) for path in paths if os.path.isfile(path)])
+        return {"keys": len(self.db), "bytes": size}
+
+    def sync(self):
+        """writes pending changes to the disk, if supported by the dbm module."""
+        if hasattr(self.db, "sync"):
+            self.db.sync()
+
     def reset(self):
         """resets the database."""
         self.db.close()
@@ -1,9 +1,16 @@
 """Databaseserver side protocol of the routing."""
 import struct
 import os
+import json
+import itertools
+import collections
 
+from zope.interface import implementer
 from twisted.protocols.basic import IntNStringReceiver
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import endpoints
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, maybeDeferred, fail, TimeoutError
 from twisted.python.failure import Failure
 from twisted.python import log
 
@@ -25,19 +32,120 @@ class IncorrectPassword(ValueError):
     pass
 
 
+class SyncState(object):
+    """
+The epoch of the router and the sequence number of the last write applied to a database.
+If path is not None, the state is saved to and loaded from this file.
+"""
+    def __init__(self, path=None):
+        self.path = path
+        self.epoch = 0
+        self.seq = 0
+        self.saved = None
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                content = f.read().split()
+            if len(content) == 2:
+                self.epoch, self.seq = int(content[0]), int(content[1])
+                self.saved = (self.epoch, self.seq)
+
+    def save(self, state=None):
+        """saves state, a tuple (epoch, seq), or the current state if it is None."""
+        if state is None:
+            state = (self.epoch, self.seq)
+        if self.path is None or self.saved == state:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            f.write("{e} {s}\n".format(e=state[0], s=state[1]))
+        os.rename(self.path + ".tmp", self.path)
+        self.saved = state
+
+
+@implementer(IPushProducer)
+class SnapshotProducer(object):
+    """Pauses the snapshots sent by a database while the buffer of the transport is full."""
+    def __init__(self):
+        self.sending = set()  # rids of the snapshots being sent
+        self.paused = False
+        self.waiting = []  # deferreds of snapshots waiting for the transport
+
+    def wait(self):
+        """returns a deferred which will be called once the transport can take more data."""
+        d = Deferred()
+        if self.paused:
+            self.waiting.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def pauseProducing(self):
+        """called by the transport when its buffer is full."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """called by the transport when its buffer was written."""
+        self.paused = False
+        waiting = self.waiting
+        self.waiting = []
+        for d in waiting:
+            d.callback(None)
+
+    def stopProducing(self):
+        """called by the transport when the connection is lost; stops all snapshots."""
+        self.sending.clear()
+        self.resumeProducing()
+
+
 class DatabaseClientProtocol(IntNStringReceiver):
-    """This protocol connects a database to the router."""
-    def __init__(self, db, password, reactor, reset=False, reset_sleep_interval=0.2):
+    """
+This protocol connects a database to the router.
+If reset is True, the database is cleared and synced from the other databases after connecting.
+reset_mode is one of data.RESET_MODES: 'snapshot' bulk-loads the contents streamed by a donor database,
+'scan' scans the keys and requests every value.
+state is the SyncState of the database. If the router still knows the writes after it, only these are
+received after connecting.
+If store_compressed is True, the values are stored in the form sent by the router: with a flag byte and,
+if the client compressed them, compressed with zlib. This must not change without resetting the database.
+If tracer is a kvndb.profiling.RequestTracer, it times the requests of the router.
+"""
+    def __init__(
+        self, db, password, reactor, reset=False, reset_sleep_interval=0.2, reset_mode=data.DEFAULT_RESET_MODE, state=None,
+        store_compressed=False, tracer=None,
+        ):
         if hasattr(IntNStringReceiver, "__init__"):
             IntNStringReceiver.__init__(self)
         self.db = db
         self.reactor = reactor
         self.password = password
         self.reset = reset
+        if reset_mode not in data.RESET_MODES:
+            raise ValueError("Unknown reset mode: '{m}'!".format(m=reset_mode))
+        self.reset_mode = reset_mode
         self.sleep_interval = reset_sleep_interval
+        self.store_compressed = store_compressed
+        self.tracer = tracer
         self.reset_req_string = os.urandom(data.MESSAGE_ID_SIZE)
         self.to_sync = []
         self.reset_requests = {}
+        self.sync_scan_done = False
+        self.buffer = None  # key -> value or None for deletes; writes received during a snapshot transfer
+        self.reset_epoch = 0
+        self.snapshot_stats = None
+        self.producer = SnapshotProducer()
+        if state is None:
+            state = SyncState()
+        self.state = state
+        self.connector = None  # the DatabaseConnector if the connection is restored when lost
+        self.node_id = None  # name of the database sent to the router; the same for all routers
+        self.syncing = False  # True while the router does not send reads to this database
+        self.throttled = False
+        self.commit_call = None
+        self.commit_requests = 0  # sync requests waiting for the next commit
+        self.commit_writes = 0  # writes received since the last commit
+        self.committed_seq = state.seq
+        self.commit_stats = {"commits": 0, "requests": 0, "writes": 0, "last_batch": 0, "max_batch": 0, "sync_time": 0.0}
+        self.scans = collections.OrderedDict()  # cursor -> key iterator
+        self.next_scan = 1
         self.range_start = None
         self.range_end = None
         self.free = set()
@@ -45,6 +153,7 @@ class DatabaseClientProtocol(IntNStringReceiver):
         self.mode = data.MODE_CONNECTING
         self.structFormat = data.MESSAGE_LENGTH_FORMAT
         self.prefixLength = data.MESSAGE_LENGTH_SIZE
+        self.MAX_LENGTH = data.MAX_MESSAGE_LENGTH
         self.callback = Deferred()  # will be called once the handshake is finished
 
     def connectionMade(self):
@@ -58,14 +167,37 @@ class DatabaseClientProtocol(IntNStringReceiver):
 
     def connectionLost(self, reason=None):
         """this will be called when the connection was lost."""
+        self.producer.stopProducing()
+        if self.commit_call is not None and self.commit_call.active():
+            self.commit_call.cancel()
         log.err("Error: Connection lost. Reason: {r}".format(r=reason))
-        log.msg("Closing database...")
-        self.db.close()
-        log.msg("Database closed.")
+        if self.connector is not None:
+            self.connector.connection_lost(self)
+        else:
+            log.msg("Closing database...")
+            self.db.close()
+            log.msg("Database closed.")
+
+    def send_mode(self):
+        """tells the router that this is a database and which capabilities it uses."""
+        # key ranges are optional; the router filters all keys instead if it does not support them
+        caps = self.required_caps() | data.CAP_KEYRANGE
+        self.sendString(data.MODE_SERVER + data.CAPS_STRUCT.pack(caps))
+
+    def required_caps(self):
+        """returns the capabilities the router needs to support for this database."""
+        caps = 0
+        if self.store_compressed:
+            caps |= data.CAP_COMPRESSION
+        if getattr(self.db, "lossy", False):
+            caps |= data.CAP_LOSSY
+        return caps
 
-    @inlineCallbacks
     def stringReceived(self, msg):
-        """called when a message was received."""
+        """
+called when a message was received.
+Requests are dispatched by their first byte; only the handlers which wait for the database use deferreds.
+"""
         if self.mode == data.MODE_ERROR:
             # error occured, connection is probably already being terminated.
             log.err("Received a message, but the protocol is already mismatching. Ignoring Message.")
@@ -76,7 +208,7 @@ class DatabaseClientProtocol(IntNStringReceiver):
             if msg == data.STATE_OK:
                 # Version OK, continue
                 log.msg("Version OK, sending mode and requesting range...")
-                self.sendString(data.MODE_SERVER)
+                self.send_mode()
                 self.mode = data.MODE_RANGE  # <--- this is correct
             elif msg == data.STATE_ERROR:
                 # Version mismatch
@@ -113,7 +245,7 @@ class DatabaseClientProtocol(IntNStringReceiver):
                 # Password OK, continue
                 log.msg("Password OK, sending mode and requesting range...")
                 self.mode = data.MODE_RANGE
-                self.sendString(data.MODE_SERVER)  # <--- this is correct
+                self.send_mode()  # <--- this is correct
             elif msg == data.STATE_ERROR:
                 # Password invalid
                 log.err("Invalid password!")
@@ -127,120 +259,600 @@ class DatabaseClientProtocol(IntNStringReceiver):
                 self.transport.loseConnection()
 
         elif self.mode == data.MODE_RANGE:
-            self.range_start, self.range_end = struct.unpack(data.RANGE_FORMAT, msg)
+            self.range_start, self.range_end = struct.unpack_from(data.RANGE_FORMAT, msg)
             log.msg("Range is {s} to {e}.".format(s=self.range_start, e=self.range_end))
+            caps = 0
+            if len(msg) > data.RANGE_SIZE:
+                caps = data.CAPS_STRUCT.unpack_from(msg, data.RANGE_SIZE)[0]
+            missing = self.required_caps() & ~caps
+            if missing != 0:
+                log.err("The router does not support the capabilities {c} of this database. Losing Connection...".format(c=missing))
+                self.mode = data.MODE_ERROR
+                self.transport.loseConnection()
+                self.callback.errback(Failure(ProtocolError("Capabilities {c} not supported by the router!".format(c=missing))))
+                return
             self.cur_id = self.range_start
             self.mode = data.MODE_SERVER
-            if self.reset:
-                self.init_reset()
+            if self.connector is not None:
+                # when connected to several routers, only one of them is used to reset the database
+                self.reset = self.connector.claim_reset(self)
+            if self.reset or self.resetting_elsewhere():
+                # the current data is dropped anyway
+                epoch, seq = 0, 0
             else:
-                self.callback.callback(self)
+                epoch, seq = self.state.epoch, self.state.seq
+                log.msg("Catching up from write {s}...".format(s=seq))
+            self.sendString(data.ID_CATCHUP + data.CATCHUP_STRUCT.pack(epoch, seq) + (self.node_id or ""))
 
         elif self.mode == data.MODE_SERVER:
             # db requests.
+            if getattr(self.db, "full", False) and not self.throttled:
+                # too many calls are waiting for the database; stop reading requests until it caught up
+                self.throttled = True
+                self.transport.pauseProducing()
+                self.db.drained().addCallback(self._unthrottle)
             actionbyte = msg[0]
-            msg = msg[1:]
-            if actionbyte == data.ID_SET:
-                keylength = struct.unpack(data.MESSAGE_KEY_LENGTH_FORMAT, msg[:data.MESSAGE_KEY_LENGTH_SIZE])[0]
-                key = msg[data.MESSAGE_KEY_LENGTH_SIZE:data.MESSAGE_KEY_LENGTH_SIZE + keylength]
-                if self.reset:
-                    if key in self.to_sync:
-                        self.to_sync.remove(key)
-                value = msg[data.MESSAGE_KEY_LENGTH_SIZE + keylength:]
-                self.db.set(key, value)
-            elif actionbyte == data.ID_GET:
-                rid = msg[:data.MESSAGE_ID_SIZE]
-                key = msg[data.MESSAGE_ID_SIZE:]
-                try:
-                    value = yield self.db.get(key)
-                except KeyError:
-                    self.sendString(data.ID_NOTFOUND + rid)
+            i = 1  # offset of the arguments
+            deadline = None
+            if actionbyte == data.ID_SEQ:
+                # a write tagged with its sequence number
+                self.state.seq = max(self.state.seq, data.SEQ_STRUCT.unpack_from(msg, 1)[0])
+                self.commit_writes += 1
+                actionbyte = msg[1 + data.SEQ_SIZE]
+                i = 2 + data.SEQ_SIZE
+            elif actionbyte == data.ID_DEADLINE:
+                # a read which is dropped if it can not be answered in this many milliseconds
+                budget = data.DEADLINE_STRUCT.unpack_from(msg, 1)[0]
+                deadline = self.reactor.seconds() + budget / 1000.0
+                actionbyte = msg[1 + data.DEADLINE_SIZE]
+                i = 2 + data.DEADLINE_SIZE
+            handler = self.handlers.get(actionbyte, None)
+            if handler is not None:
+                if self.tracer is None:
+                    handler(self, msg, i, deadline)
                 else:
-                    self.sendString(data.ID_ANSWER + rid + str(value))
+                    self.tracer.dispatch(actionbyte, handler, self, msg, i, deadline)
+
+        else:
+            log.err("Received unknown Answer. Losing Connection...")
+            self.mode = data.MODE_ERROR
+            self.callback.errback(Failure(ProtocolError("Unknown Answer!")))
+            self.transport.loseConnection()
+
+    # requests of the router; the arguments start at offset i of msg
+
+    def handle_set(self, msg, i, deadline):
+        """sets a key."""
+        keylength = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from(msg, i)[0]
+        i += data.MESSAGE_KEY_LENGTH_SIZE
+        key = msg[i:i + keylength]
+        if self.reset:
+            if key in self.to_sync:
+                self.to_sync.remove(key)
+        value = msg[i + keylength:]
+        buffer = self.write_buffer()
+        if buffer is not None:
+            buffer[key] = value
+        else:
+            self.db.set(key, value)
+
+    def handle_get(self, msg, i, deadline):
+        """answers a get. Values returned directly by the database are sent without using a deferred."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        key = msg[i + data.MESSAGE_ID_SIZE:]
+        if deadline is None and not getattr(self.db, "deadlines", False):
+            try:
+                value = self.db.get(key)
+            except KeyError:
+                self.sendString(data.ID_NOTFOUND + rid)
+                return
+            except Exception:
+                d = fail()
+            else:
+                if not isinstance(value, Deferred):
+                    utils.send_parts(self, [data.ID_ANSWER, rid, str(value)])
+                    return
+                d = value
+        else:
+            d = self.read(key, deadline)
+        d.addCallbacks(self._send_value, self._send_read_failure, callbackArgs=(rid, ), errbackArgs=(rid, ))
+        return d
 
-            elif actionbyte == data.ID_DEL:
-                key = msg
+    def _send_value(self, value, rid):
+        """sends the answer to a get."""
+        utils.send_parts(self, [data.ID_ANSWER, rid, str(value)])
+
+    def _send_read_failure(self, f, rid):
+        """tells the router that a get failed."""
+        if f.check(KeyError):
+            self.sendString(data.ID_NOTFOUND + rid)
+        elif f.check(TimeoutError):
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            return f
+
+    def handle_del(self, msg, i, deadline):
+        """deletes a key."""
+        key = msg[i:]
+        if key in self.to_sync:
+            self.to_sync.remove(key)
+        buffer = self.write_buffer()
+        if buffer is not None:
+            buffer[key] = None
+        else:
+            try:
+                self.db.delete(key)
+            except:
+                pass
+
+    @inlineCallbacks
+    def handle_mget(self, msg, i, deadline):
+        """answers a batch get."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        keys = utils.keystring2list(msg, i + data.MESSAGE_ID_SIZE)
+        # the database may answer the gets concurrently
+        answers = yield DeferredList([self.read(key, deadline) for key in keys], consumeErrors=True)
+        results = []
+        expired = False
+        for key, (success, value) in zip(keys, answers):
+            if not success:
+                expired = expired or value.check(TimeoutError) is not None
+                value = None
+            results.append((key, value))
+        if expired:
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            utils.send_parts(self, [data.ID_MANSWER, rid, utils.resultlist2string(results)])
+
+    def handle_mset(self, msg, i, deadline):
+        """sets multiple keys."""
+        buffer = self.write_buffer()
+        for key, value in utils.pairstring2list(msg, i):
+            if self.reset:
                 if key in self.to_sync:
                     self.to_sync.remove(key)
+            if buffer is not None:
+                buffer[key] = value
+            else:
+                self.db.set(key, value)
+
+    def handle_mdel(self, msg, i, deadline):
+        """deletes multiple keys."""
+        buffer = self.write_buffer()
+        for key in utils.keystring2list(msg, i):
+            if key in self.to_sync:
+                self.to_sync.remove(key)
+            if buffer is not None:
+                buffer[key] = None
+            else:
                 try:
                     self.db.delete(key)
                 except:
                     pass
 
-            elif actionbyte == data.ID_GETKEYS:
-                rid = msg
-                keys = yield self.db.getkeys()
-                answer = utils.keylist2string(keys)
-                self.sendString(data.ID_ALLKEYS + rid + answer)
-
-            elif actionbyte == data.ID_ALLKEYS:
-                # answer during reset
-                rid = msg[:data.MESSAGE_ID_SIZE]
-                self.free.add(struct.unpack(data.MESSAGE_ID_FORMAT, rid)[0])
-                if rid == self.reset_req_string:
-                    log.msg("Received keylist, starting value requests...")
-                    keystring = msg[data.MESSAGE_ID_SIZE:]
-                    keys = utils.keystring2list(keystring)
-                    if len(keys) == 0:
-                        log.msg("Keylist empty; skipping value requests...")
-                        self.sendString(data.ID_SWITCH)
-                        self.callback.callback(self)
-                        pass
-                    else:
-                        # request all values for key
-                        self.to_sync = keys
-                        del keys  # this list may be big, we should delete it to free some RAM
-                        done = 0
-                        while True:
-                            if len(self.to_sync) == 0:
-                                break
-                            rid = self.get_id()
-                            key = self.to_sync.pop(0)
-                            self.reset_requests[rid] = key
-                            rids = struct.pack(data.MESSAGE_ID_FORMAT, rid)
-                            self.sendString(data.ID_GET + rids + key)
-                            if (done % 128) == 0:
-                                yield utils.dsleep(self.reactor, self.sleep_interval)
-                            done += 1
-                        log.msg("Finished sending value requests.")
-                else:
-                    log.err("Received invalid RID during sync!")
-
-            elif actionbyte == data.ID_ANSWER:
-                # request answer during sync
-                rids = msg[:data.MESSAGE_ID_SIZE]
-                rid = struct.unpack(data.MESSAGE_ID_FORMAT, rids)[0]
-                self.free.add(rid)
-                value = msg[data.MESSAGE_ID_SIZE:]
-                key = self.reset_requests.get(rid, None)
-                if key is None:
-                    log.err("Received non-requested RID. Ignoring...")
-                else:
-                    del self.reset_requests[rid]
-                    self.db.set(key, value)
-                if (len(self.reset_requests) == 0) and (len(self.to_sync) == 0):
-                    # this "if" will only be checked if actionybte == data.ID_ANSWER, which can only be sent during a sync
-                    log.msg("Finished sync.")
-                    self.sendString(data.ID_SWITCH)
-                    self.callback.callback(self)
+    @inlineCallbacks
+    def handle_getkeys(self, msg, i, deadline):
+        """answers a request for all keys."""
+        rid = msg[i:]
+        if self.expired(deadline):
+            self.sendString(data.ID_EXPIRED + rid)
+            return
+        keys = yield self.db.getkeys()
+        utils.send_parts(self, [data.ID_ALLKEYS, rid, utils.keylist2string(keys)])
 
+    @inlineCallbacks
+    def handle_scan(self, msg, i, deadline):
+        """answers the request for a page of a key scan."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        cursor, count = data.SCAN_STRUCT.unpack_from(msg, i + data.MESSAGE_ID_SIZE)
+        if self.expired(deadline):
+            self.sendString(data.ID_EXPIRED + rid)
+            return
+        if cursor == 0:
+            iterator = yield utils.iterkeys(self.db)
+            cursor = self.next_scan
+            self.next_scan += 1
+        else:
+            iterator = self.scans.pop(cursor, None)
+        if iterator is None:
+            # unknown or expired cursor
+            self.sendString(data.ID_NOTFOUND + rid)
+        else:
+            keys = list(itertools.islice(iterator, count))
+            if len(keys) < count:
+                cursor = 0
             else:
-                # ignore errors here
-                pass
+                self.scans[cursor] = iterator
+                if len(self.scans) > data.MAX_OPEN_SCANS:
+                    self.scans.popitem(last=False)
+            utils.send_parts(self, [data.ID_SCANANSWER, rid, data.CURSOR_STRUCT.pack(cursor), utils.keylist2string(keys)])
+
+    @inlineCallbacks
+    def handle_keyrange(self, msg, i, deadline):
+        """answers a request for the sorted keys in a range."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        start, end, limit, reverse = utils.string2keyrange(msg, i + data.MESSAGE_ID_SIZE)
+        if self.expired(deadline):
+            self.sendString(data.ID_EXPIRED + rid)
+            return
+        keys = yield maybeDeferred(utils.keyrange, self.db, start, end, limit, reverse)
+        utils.send_parts(self, [data.ID_ALLKEYS, rid, utils.keylist2string(keys)])
+
+    @inlineCallbacks
+    def handle_stats(self, msg, i, deadline):
+        """answers a request for the statistics of the database with a JSON object."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        stats = {
+            "node_id": self.node_id,
+            "syncing": self.syncing,
+            "seq": self.state.seq,
+            "committed_seq": self.committed_seq,
+            "commits": dict(self.commit_stats),
+            "store_compressed": self.store_compressed,
+            }
+        if hasattr(self.db, "backend_stats"):
+            # a blocking database running in a ThreadedDatabase
+            stats["backend"] = self.db.db.__class__.__name__
+            stats["threads"] = self.db.stats()
+            backend = yield self.db.backend_stats()
+        else:
+            stats["backend"] = self.db.__class__.__name__
+            backend = yield maybeDeferred(getattr(self.db, "stats", dict))
+        stats.update(backend)
+        if self.tracer is not None:
+            stats.update(self.tracer.stats())
+        answer = json.dumps(stats)
+        if self.store_compressed:
+            answer = utils.encode_value(answer)
+        utils.send_parts(self, [data.ID_ANSWER, rid, answer])
 
+    def handle_sync(self, msg, i, deadline):
+        """the router waits for the writes to be durable."""
+        self.commit_requests += 1
+        if self.commit_call is None:
+            self.commit_call = self.reactor.callLater(data.GROUP_COMMIT_WINDOW, self.commit)
+
+    def handle_catchup(self, msg, i, deadline):
+        """the router sent all writes we missed or tells us to reset."""
+        state = msg[i]
+        epoch, seq = data.CATCHUP_STRUCT.unpack_from(msg, i + 1)
+        self.state.seq = seq
+        if self.resetting_elsewhere():
+            # the data is loaded through another router; our writes are applied with the others
+            self.state.epoch = epoch
+            self.set_syncing(True)
+            self.callback.callback(self)
+        elif self.reset or state != data.STATE_OK:
+            if not self.reset:
+                log.msg("Router no longer knows the missed writes, resetting...")
+            # the state is invalid until the reset finished
+            self.state.epoch = 0
+            self.reset_epoch = epoch
+            self.init_reset()
         else:
-            log.err("Received unknown Answer. Losing Connection...")
-            self.mode = data.MODE_ERROR
-            self.callback.errback(Failure(ProtocolError("Unknown Answer!")))
-            self.transport.loseConnection()
+            log.msg("Caught up to write {s}.".format(s=seq))
+            self.state.epoch = epoch
+            self.callback.callback(self)
+
+    def handle_snapshot(self, msg, i, deadline):
+        """the router asks for the contents of this database."""
+        self.send_snapshot(msg[i:i + data.MESSAGE_ID_SIZE])
+
+    def handle_snapshot_chunk(self, msg, i, deadline):
+        """contents of the donor during reset."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        if rid == self.reset_req_string and self.snapshot_stats is not None:
+            self.load_snapshot_chunk(utils.pairstring2list(msg, i + data.MESSAGE_ID_SIZE), len(msg) - i)
+        else:
+            log.err("Received snapshot chunk with invalid RID!")
+
+    def handle_snapshot_end(self, msg, i, deadline):
+        """the snapshot transfer finished or the router stopped a snapshot we are sending."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        if rid == self.reset_req_string and self.snapshot_stats is not None:
+            # snapshot transfer finished
+            self.finish_snapshot()
+        else:
+            # the router stopped a snapshot we are sending
+            self.producer.sending.discard(rid)
+
+    @inlineCallbacks
+    def handle_scan_answer(self, msg, i, deadline):
+        """keys during reset."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        if rid != self.reset_req_string:
+            log.err("Received invalid RID during sync!")
+            return
+        cursor = data.CURSOR_STRUCT.unpack_from(msg, i + data.MESSAGE_ID_SIZE)[0]
+        keys = utils.keystring2list(msg, i + data.MESSAGE_ID_SIZE + data.CURSOR_SIZE)
+        log.msg("Received {n} keys, requesting values...".format(n=len(keys)))
+        # request all values for the keys of this page
+        self.to_sync = keys
+        del keys
+        done = 0
+        while True:
+            if len(self.to_sync) == 0:
+                break
+            rid = self.get_id()
+            key = self.to_sync.pop(0)
+            self.reset_requests[rid] = key
+            rids = data.MESSAGE_ID_STRUCT.pack(rid)
+            self.sendString(data.ID_GET + rids + key)
+            if (done % 128) == 0:
+                yield utils.dsleep(self.reactor, self.sleep_interval)
+            done += 1
+        if cursor == 0:
+            log.msg("Finished sending value requests.")
+            self.sync_scan_done = True
+            self.check_sync_finished()
+        else:
+            self.request_sync_keys(cursor)
+
+    def handle_answer(self, msg, i, deadline):
+        """request answer during sync."""
+        rids = msg[i:i + data.MESSAGE_ID_SIZE]
+        if rids == self.reset_req_string:
+            if self.reset_mode == "snapshot":
+                # the donor was lost, start again.
+                log.msg("Snapshot transfer aborted by router, restarting it...")
+                self.db.reset()
+                self.request_snapshot()
+            else:
+                # the server holding our cursor was lost, start again.
+                log.msg("Key scan aborted by router, restarting it...")
+                self.request_sync_keys(0)
+            return
+        rid = data.MESSAGE_ID_STRUCT.unpack(rids)[0]
+        self.free.add(rid)
+        key = self.reset_requests.get(rid, None)
+        if key is None:
+            log.err("Received non-requested RID. Ignoring...")
+        else:
+            del self.reset_requests[rid]
+            if msg[i - 1] == data.ID_ANSWER:
+                self.db.set(key, msg[i + data.MESSAGE_ID_SIZE:])
+            # otherwise the key was deleted after the keylist was sent.
+        self.check_sync_finished()
+
+    handlers = {
+        data.ID_SET: handle_set,
+        data.ID_GET: handle_get,
+        data.ID_DEL: handle_del,
+        data.ID_MGET: handle_mget,
+        data.ID_MSET: handle_mset,
+        data.ID_MDEL: handle_mdel,
+        data.ID_GETKEYS: handle_getkeys,
+        data.ID_SCAN: handle_scan,
+        data.ID_KEYRANGE: handle_keyrange,
+        data.ID_STATS: handle_stats,
+        data.ID_SYNC: handle_sync,
+        data.ID_CATCHUP: handle_catchup,
+        data.ID_SNAPSHOT: handle_snapshot,
+        data.ID_SNAPSHOTCHUNK: handle_snapshot_chunk,
+        data.ID_SNAPSHOTEND: handle_snapshot_end,
+        data.ID_SCANANSWER: handle_scan_answer,
+        data.ID_ANSWER: handle_answer,
+        data.ID_NOTFOUND: handle_answer,
+        }
+
+    def expired(self, deadline):
+        """returns True if deadline is not None and passed."""
+        return deadline is not None and self.reactor.seconds() >= deadline
+
+    def read(self, key, deadline=None):
+        """returns a deferred for the value for key. Fails with a TimeoutError if deadline passes before the read."""
+        if self.expired(deadline):
+            return fail(TimeoutError())
+        if deadline is not None and getattr(self.db, "deadlines", False):
+            # the read may wait for a thread
+            return self._traced(self.db.get(key, deadline))
+        d = maybeDeferred(self.db.get, key)
+        if deadline is not None and not d.called:
+            # answer in time, so that the router can reuse the request id
+            d.addTimeout(deadline - self.reactor.seconds(), self.reactor)
+        return self._traced(d)
+
+    def _traced(self, d):
+        """marks the end of the backend stage of the request being dispatched once d fired, if requests are timed."""
+        if self.tracer is not None and self.tracer.current is not None:
+            trace = self.tracer.current
+            if hasattr(self.db, "queue_depth"):
+                trace.info["queue_depth"] = self.db.queue_depth
+            d.addBoth(self._backend_done, trace)
+        return d
+
+    def _backend_done(self, result, trace):
+        """called when the database answered a read of the traced request."""
+        self.tracer.mark(trace, "backend")
+        return result
+
+    def _unthrottle(self, result):
+        """continues reading requests once the database caught up."""
+        self.throttled = False
+        if self.transport.connected:
+            self.transport.resumeProducing()
+
+    @inlineCallbacks
+    def commit(self):
+        """syncs all writes received so far with a single sync of the database and acknowledges them."""
+        seq = self.state.seq
+        requests = self.commit_requests
+        writes = self.commit_writes
+        self.commit_requests = 0
+        self.commit_writes = 0
+        started = self.reactor.seconds()
+        try:
+            if hasattr(self.db, "sync"):
+                yield self.db.sync()
+        except Exception:
+            log.err(Failure(), "Syncing the database failed:")
+            # acknowledge the writes with the next successful sync
+            self.commit_requests += requests
+            self.commit_writes += writes
+            if self.transport.connected:
+                self.commit_call = self.reactor.callLater(data.COMMIT_RETRY_INTERVAL, self.commit)
+            else:
+                self.commit_call = None
+            return
+        self.commit_call = None
+        stats = self.commit_stats
+        stats["commits"] += 1
+        stats["requests"] += requests
+        # in sharded mode the sequence numbers count the writes to all shards
+        stats["writes"] += writes
+        stats["last_batch"] = writes
+        stats["max_batch"] = max(stats["max_batch"], stats["last_batch"])
+        stats["sync_time"] += self.reactor.seconds() - started
+        self.committed_seq = seq
+        self.sendString(data.ID_ACK + struct.pack(data.SEQ_FORMAT, seq))
+        if self.commit_requests > 0:
+            # requested while syncing
+            self.commit_call = self.reactor.callLater(data.GROUP_COMMIT_WINDOW, self.commit)
+
+    def write_buffer(self):
+        """returns the dict buffering the writes while a snapshot is loaded or None if the writes can be applied."""
+        if self.buffer is None and self.connector is not None:
+            return self.connector.write_buffer()
+        return self.buffer
+
+    def resetting_elsewhere(self):
+        """returns True if the database is being reset through the connection to another router."""
+        return self.connector is not None and self.connector.resetting not in (None, self)
+
+    def set_syncing(self, syncing):
+        """tells the router whether it may send reads to this database."""
+        if syncing != self.syncing:
+            self.syncing = syncing
+            self.sendString(data.ID_SWITCH)
 
     def init_reset(self):
         """initiates a database reset."""
         log.msg("Initiating database reset...")
+        if self.connector is not None:
+            self.connector.begin_reset(self)
         self.db.reset()
+        self.scans.clear()
         log.msg("Starting sync...")
-        self.sendString(data.ID_SWITCH)
-        self.sendString(data.ID_GETKEYS + self.reset_req_string)
+        self.set_syncing(True)
+        if self.reset_mode == "snapshot":
+            self.buffer = {}
+            self.request_snapshot()
+        else:
+            self.request_sync_keys(0)
+
+    def request_snapshot(self):
+        """asks the router for a snapshot of the other databases during a reset."""
+        now = self.reactor.seconds()
+        self.snapshot_stats = {"started": now, "reported": now, "keys": 0, "bytes": 0}
+        self.sendString(data.ID_SNAPSHOT + self.reset_req_string)
+
+    def load_snapshot_chunk(self, pairs, size):
+        """writes the pairs of a snapshot chunk to the database. Keys written during the transfer are skipped."""
+        for key, value in pairs:
+            if key not in self.buffer:
+                self.db.set(key, value)
+        stats = self.snapshot_stats
+        stats["keys"] += len(pairs)
+        stats["bytes"] += size
+        now = self.reactor.seconds()
+        if now - stats["reported"] >= data.SNAPSHOT_PROGRESS_INTERVAL:
+            stats["reported"] = now
+            log.msg("Snapshot transfer: {s}".format(s=self.format_snapshot_stats(now)))
+
+    def finish_snapshot(self):
+        """applies the writes buffered during the snapshot transfer and finishes the reset."""
+        log.msg("Snapshot transfer finished: {s}".format(s=self.format_snapshot_stats(self.reactor.seconds())))
+        log.msg("Applying {n} buffered writes...".format(n=len(self.buffer)))
+        buffer = self.buffer
+        self.buffer = None
+        self.snapshot_stats = None
+        for key, value in buffer.iteritems():
+            if value is None:
+                try:
+                    self.db.delete(key)
+                except:
+                    pass
+            else:
+                self.db.set(key, value)
+        self.reset_finished()
+
+    def reset_finished(self):
+        """called once all data was loaded during a reset."""
+        log.msg("Finished sync.")
+        self.state.epoch = self.reset_epoch
+        self.reset = False
+        self.set_syncing(False)
+        if self.connector is not None:
+            self.connector.end_reset(self)
+        if not self.callback.called:
+            self.callback.callback(self)
+
+    def format_snapshot_stats(self, now):
+        """returns a description of the progress and throughput of the running snapshot transfer."""
+        stats = self.snapshot_stats
+        duration = max(now - stats["started"], 0.001)
+        return "{k} keys, {m:.1f} MB in {t:.1f}s ({kr:.0f} keys/s, {mr:.2f} MB/s)".format(
+            k=stats["keys"], m=stats["bytes"] / 2.0**20, t=duration,
+            kr=stats["keys"] / duration, mr=stats["bytes"] / 2.0**20 / duration,
+            )
+
+    @inlineCallbacks
+    def send_snapshot(self, rid):
+        """streams the contents of the database to the router as snapshot chunks."""
+        log.msg("Sending snapshot...")
+        sending = self.producer.sending
+        sending.add(rid)
+        if len(sending) == 1:
+            self.transport.registerProducer(self.producer, True)
+        try:
+            chunk = []
+            size = 0
+            n = 0
+            iterator = yield utils.iterkeys(self.db)
+            while True:
+                if rid not in sending:
+                    log.msg("Snapshot stopped by router.")
+                    return
+                keys = list(itertools.islice(iterator, data.SNAPSHOT_READ_BATCH))
+                if len(keys) == 0:
+                    break
+                # the database may answer the gets concurrently
+                answers = yield DeferredList([maybeDeferred(self.db.get, key) for key in keys], consumeErrors=True)
+                for key, (success, value) in zip(keys, answers):
+                    if not success:
+                        # deleted while sending
+                        continue
+                    value = str(value)
+                    chunk.append((key, value))
+                    n += 1
+                    size += data.MESSAGE_KEY_LENGTH_SIZE + len(key) + data.MESSAGE_VALUE_LENGTH_SIZE + len(value)
+                if size >= data.SNAPSHOT_CHUNK_SIZE:
+                    self.sendString(data.ID_SNAPSHOTCHUNK + rid + utils.pairlist2string(chunk))
+                    chunk = []
+                    size = 0
+                    yield self.producer.wait()
+            if rid in sending:
+                if len(chunk) > 0:
+                    self.sendString(data.ID_SNAPSHOTCHUNK + rid + utils.pairlist2string(chunk))
+                self.sendString(data.ID_SNAPSHOTEND + rid)
+                log.msg("Sent snapshot of {n} keys.".format(n=n))
+        finally:
+            sending.discard(rid)
+            if len(sending) == 0 and self.transport.producer is self.producer:
+                self.transport.unregisterProducer()
+
+    def request_sync_keys(self, cursor):
+        """requests the next page of keys to sync during a reset."""
+        if cursor == 0:
+            self.sync_scan_done = False
+        scan = struct.pack(data.SCAN_FORMAT, cursor, data.DEFAULT_SCAN_COUNT)
+        self.sendString(data.ID_SCAN + self.reset_req_string + scan)
+
+    def check_sync_finished(self):
+        """finishes the reset once all keys were scanned and all values were received."""
+        if self.sync_scan_done and (len(self.reset_requests) == 0) and (len(self.to_sync) == 0):
+            self.sync_scan_done = False
+            self.reset_finished()
 
     def get_id(self):
         """returns a request id."""
@@ -252,3 +864,167 @@ class DatabaseClientProtocol(IntNStringReceiver):
                 raise RuntimeError("No ids left.")
             self.cur_id += 1
             return i
+
+
+class RouterLink(object):
+    """The connection of a database to one router."""
+    def __init__(self, endpoint, state):
+        self.endpoint = endpoint
+        self.state = state  # SyncState of the writes received from this router
+        self.proto = None  # the connected protocol
+        self.delay = data.RECONNECT_DELAY
+        self.stopped = False
+
+
+class DatabaseConnector(object):
+    """
+Keeps a database connected to the routers.
+endpoint may be a single endpoint or a list of endpoints of routers serving the same databases.
+When a connection is lost, it is restored and the database catches up on the writes it missed.
+If seq_file is not None and there are several routers, the state of the n-th router is saved to seq_file.n.
+store_compressed and tracer are passed to the DatabaseClientProtocol.
+"""
+    def __init__(
+        self, reactor, endpoint, db, password, reset=False, reset_sleep_interval=0.2, reset_mode=data.DEFAULT_RESET_MODE,
+        seq_file=None, store_compressed=False, tracer=None,
+        ):
+        self.reactor = reactor
+        if not isinstance(endpoint, (list, tuple)):
+            endpoint = [endpoint]
+        self.db = db
+        self.password = password
+        self.reset = reset
+        self.reset_sleep_interval = reset_sleep_interval
+        self.reset_mode = reset_mode
+        self.store_compressed = store_compressed
+        self.tracer = tracer
+        self.links = []
+        for i, ep in enumerate(endpoint):
+            if seq_file is not None and len(endpoint) > 1:
+                path = "{f}.{i}".format(f=seq_file, i=i)
+            else:
+                path = seq_file
+            self.links.append(RouterLink(ep, SyncState(path)))
+        self.node_id = os.urandom(8).encode("hex")  # places the database on the hash rings of the routers
+        self.resetting = None  # the protocol used to reset the database
+        self.stopped = False
+        self.saver = LoopingCall(self.save_state)
+        self.callback = Deferred()  # will be called once the first connection is ready
+
+    def start(self):
+        """connects to the routers."""
+        if any([link.state.path is not None for link in self.links]):
+            self.saver.start(data.SEQ_SAVE_INTERVAL, now=False)
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        for link in self.links:
+            self.connect(link)
+
+    @inlineCallbacks
+    def save_state(self):
+        """saves the states once the writes they include are synced."""
+        states = [(link.state.epoch, link.state.seq) for link in self.links]
+        if hasattr(self.db, "sync"):
+            yield self.db.sync()
+        for link, state in zip(self.links, states):
+            link.state.save(state)
+
+    @inlineCallbacks
+    def stop(self):
+        """stops reconnecting and closes the database."""
+        self.stopped = True
+        if self.saver.running:
+            self.saver.stop()
+        log.msg("Closing database...")
+        states = [(link.state.epoch, link.state.seq) for link in self.links]
+        yield self.db.close()
+        for link, state in zip(self.links, states):
+            link.state.save(state)
+        log.msg("Database closed.")
+
+    def connect(self, link):
+        """opens a connection to the router of link."""
+        if self.stopped or link.stopped:
+            return
+        proto = DatabaseClientProtocol(
+            self.db, self.password, self.reactor, reset_sleep_interval=self.reset_sleep_interval,
+            reset_mode=self.reset_mode, state=link.state, store_compressed=self.store_compressed, tracer=self.tracer,
+            )
+        proto.connector = self
+        proto.node_id = self.node_id
+        proto.callback.addCallbacks(self._ready, self._failed, callbackArgs=(link, ), errbackArgs=(link, ))
+        d = endpoints.connectProtocol(link.endpoint, proto)
+        d.addErrback(self._connect_failed, link)
+
+    def claim_reset(self, proto):
+        """returns True if proto should reset the database."""
+        if self.reset and self.resetting is None:
+            self.resetting = proto
+            return True
+        return False
+
+    def begin_reset(self, proto):
+        """called when proto resets the database. The other routers must not read from it until the reset finished."""
+        self.reset = True
+        self.resetting = proto
+        for link in self.links:
+            if link.proto is not None and link.proto is not proto:
+                link.proto.set_syncing(True)
+
+    def end_reset(self, proto):
+        """called when proto finished the reset of the database."""
+        self.reset = False
+        self.resetting = None
+        for link in self.links:
+            if link.proto is not None and link.proto is not proto:
+                link.proto.set_syncing(False)
+        if not self.callback.called:
+            self.callback.callback(proto)
+
+    def write_buffer(self):
+        """returns the dict buffering writes during a snapshot transfer or None."""
+        if self.resetting is None:
+            return None
+        return self.resetting.buffer
+
+    def _ready(self, proto, link):
+        """called when a connection is ready."""
+        link.delay = data.RECONNECT_DELAY
+        link.proto = proto
+        if not self.callback.called and self.resetting is None:
+            self.callback.callback(proto)
+        return proto
+
+    def _failed(self, f, link):
+        """called when the handshake failed; reconnecting would fail again."""
+        log.err(f)
+        link.stopped = True
+
+    def _connect_failed(self, f, link):
+        """called when the router could not be reached."""
+        log.msg("Could not connect to the router: {e}".format(e=f.getErrorMessage()))
+        self.retry(link)
+
+    def connection_lost(self, proto):
+        """called by the protocol when the connection was lost."""
+        for link in self.links:
+            if link.state is proto.state:
+                link.proto = None
+                self.retry(link)
+        if self.resetting is proto:
+            # continue the reset through another router
+            self.resetting = None
+            for link in self.links:
+                if link.proto is not None:
+                    log.msg("Lost the router used for the reset, resetting through another router...")
+                    link.proto.reset_epoch = link.state.epoch
+                    link.proto.reset = True
+                    link.proto.init_reset()
+                    break
+
+    def retry(self, link):
+        """reconnects to the router of link after a delay."""
+        if self.stopped or link.stopped:
+            return
+        log.msg("Reconnecting in {d} seconds...".format(d=link.delay))
+        self.reactor.callLater(link.delay, self.connect, link)
+        link.delay = min(link.delay * 2, data.MAX_RECONNECT_DELAY)
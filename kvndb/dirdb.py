@@ -1,15 +1,23 @@
 """dirdbm database interface."""
+import os
+import threading
+
 from twisted.persisted import dirdbm
 
 
 class DirdbmDatabase(object):
     """A dirdbm database"""
+    blocking = True
+    threadsafe = True  # every key is a separate file
+
     def __init__(self, args):
         self.args = args
         if len(self.args) != 1:
             raise ValueError, "Expected exactly one argument for the DB."
         self.path = args[0]
         self.db = dirdbm.DirDBM(self.path)
+        self.unsynced = set()  # keys written since the last sync
+        self.lock = threading.Lock()  # protects unsynced
 
     def get(self, key):
         """returns the value for key."""
@@ -21,6 +29,8 @@ class DirdbmDatabase(object):
     def set(self, key, value):
         """sets key to value"""
         self.db[key] = value
+        with self.lock:
+            self.unsynced.add(key)
 
     def delete(self, key):
         """deletes the key/value pair for key."""
@@ -28,11 +38,48 @@ class DirdbmDatabase(object):
             del self.db[key]
         except KeyError:
             pass
+        else:
+            with self.lock:
+                self.unsynced.add(key)
 
     def getkeys(self):
         """returns a list of keys."""
         return self.db.keys()
 
+    def iterkeys(self):
+        """returns an iterator over the keys, decoding the filenames one by one."""
+        for name in os.listdir(self.db.dname):
+            yield self.db._decode(name)
+
+    def stats(self):
+        """returns a dict with the number of keys and the size of their files."""
+        keys = 0
+        size = 0
+        for name in os.listdir(self.db.dname):
+            try:
+                size += os.path.getsize(os.path.join(self.db.dname, name))
+            except OSError:
+                # deleted by a concurrent call
+                continue
+            keys += 1
+        return {"keys": keys, "bytes": size}
+
+    def sync(self):
+        """flushes the files written since the last sync and the directory to the disk."""
+        with self.lock:
+            unsynced = self.unsynced
+            self.unsynced = set()
+        for key in unsynced:
+            path = os.path.join(self.db.dname, self.db._encode(key))
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    os.fsync(f.fileno())
+        fd = os.open(self.db.dname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def reset(self):
         """resets the database."""
         self.db.clear()
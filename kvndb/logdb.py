@@ -0,0 +1,429 @@
+"""log-structured (bitcask-like) database interface."""
+import os
+import mmap
+import zlib
+import struct
+import threading
+
+from twisted.python import log
+
+from . import data, utils
+
+
+RECORD_HEADER_FORMAT = "!IBLL"  # crc32, flags, keylength, valuelength
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+HINT_HEADER_FORMAT = "!BLQL"  # flags, keylength, value offset, valuelength
+HINT_HEADER_SIZE = struct.calcsize(HINT_HEADER_FORMAT)
+
+FLAG_VALUE = 0
+FLAG_TOMBSTONE = 1
+
+DATA_SUFFIX = ".data"
+HINT_SUFFIX = ".hint"
+MERGE_SUFFIX = ".merge"
+
+
+def segment_name(segment_id, suffix):
+    """returns the filename of a segment file."""
+    return "{i:08d}{s}".format(i=segment_id, s=suffix)
+
+
+def pack_record(flags, key, value):
+    """returns a record for the data file."""
+    body = struct.pack("!BLL", flags, len(key), len(value)) + key + value
+    return struct.pack("!I", zlib.crc32(body) & 0xffffffff) + body
+
+
+def read_records(path):
+    """
+iterates over the valid records of a data file.
+Yields tuples (flags, key, offset of the record, offset of the value, valuelength).
+Stops at the first truncated or corrupted record.
+"""
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+            crc, flags, keylength, valuelength = struct.unpack(RECORD_HEADER_FORMAT, header)
+            body = f.read(keylength + valuelength)
+            if len(body) < keylength + valuelength:
+                return
+            if zlib.crc32(header[4:] + body) & 0xffffffff != crc:
+                return
+            key = body[:keylength]
+            yield (flags, key, offset, offset + RECORD_HEADER_SIZE + keylength, valuelength)
+            offset += RECORD_HEADER_SIZE + keylength + valuelength
+
+
+def sync_dir(path):
+    """syncs the entries of the directory path to the disk, e.g. after renaming files in it."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_hints(path):
+    """iterates over the records of a hint file. Yields tuples (flags, key, offset of the value, valuelength)."""
+    with open(path, "rb") as f:
+        content = f.read()
+    i = 0
+    while i + HINT_HEADER_SIZE <= len(content):
+        flags, keylength, offset, valuelength = struct.unpack(HINT_HEADER_FORMAT, content[i:i + HINT_HEADER_SIZE])
+        i += HINT_HEADER_SIZE
+        key = content[i:i + keylength]
+        i += keylength
+        yield (flags, key, offset, valuelength)
+
+
+class LogDatabase(object):
+    """
+A log-structured database.
+All writes are appended to the active segment file; an in-memory keydir maps every key to the
+(segment, value offset, value length) of its latest value. Full segments are read using mmap and
+are merged in a background thread once enough of their space is used by old values.
+Hint files allow rebuilding the keydir without reading the values; the same thread writes them after rotating.
+A sorted index of the keys is built by the first key range request or scan and kept up to date afterwards.
+"""
+    blocking = True
+    threadsafe = True
+
+    def __init__(self, args):
+        self.args = args
+        if len(self.args) not in (1, 2):
+            raise ValueError("Expected the path and optionally the maximum segment size as arguments for the DB.")
+        self.path = args[0]
+        if len(self.args) == 2:
+            self.max_segment_size = int(args[1])
+        else:
+            self.max_segment_size = data.LOGDB_SEGMENT_SIZE
+        self.lock = threading.RLock()
+        self.merging = threading.Lock()  # serializes merges and writing hint files
+        self.worker = None  # thread writing hint files and merging
+        self.open()
+
+    def open(self):
+        """opens the segments in self.path and builds the keydir."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.keydir = {}  # key -> (segment id, value offset, valuelength)
+        self.index = None  # utils.SortedKeys once keys were requested in order
+        self.segments = {}  # segment id -> mmap of immutable segment
+        self.sizes = {}  # segment id -> bytes
+        self.dead = {}  # segment id -> bytes used by old values and tombstones
+        ids = sorted([int(name[:-len(DATA_SUFFIX)]) for name in os.listdir(self.path) if name.endswith(DATA_SUFFIX)])
+        for name in os.listdir(self.path):
+            if name.endswith(MERGE_SUFFIX):
+                # unfinished merge
+                os.remove(os.path.join(self.path, name))
+        for segment_id in ids:
+            self._load_segment(segment_id, is_last=(segment_id == ids[-1]))
+        for segment_id in ids[:-1]:
+            self.segments[segment_id] = self._map(segment_id)
+        if len(ids) > 0:
+            self.active_id = ids[-1]
+        else:
+            self.active_id = 0
+        # immutable segments without a hint file, e.g. after a crash
+        self.unhinted = [i for i in ids[:-1] if not os.path.exists(os.path.join(self.path, segment_name(i, HINT_SUFFIX)))]
+        self._open_active()
+
+    def _load_segment(self, segment_id, is_last=False):
+        """adds the records of a segment to the keydir."""
+        hintpath = os.path.join(self.path, segment_name(segment_id, HINT_SUFFIX))
+        datapath = os.path.join(self.path, segment_name(segment_id, DATA_SUFFIX))
+        if os.path.exists(hintpath) and not is_last:
+            records = read_hints(hintpath)
+        else:
+            records = ((flags, key, voffset, vlength) for flags, key, offset, voffset, vlength in read_records(datapath))
+        end = 0
+        self.sizes[segment_id] = 0
+        self.dead[segment_id] = 0
+        for flags, key, voffset, vlength in records:
+            size = RECORD_HEADER_SIZE + len(key) + vlength
+            self.sizes[segment_id] += size
+            self._drop(key)
+            if flags == FLAG_TOMBSTONE:
+                self.dead[segment_id] += size
+            else:
+                self.keydir[key] = (segment_id, voffset, vlength)
+            end = voffset + vlength
+        if is_last and os.path.getsize(datapath) > end:
+            # incomplete write at the end of the log
+            log.msg("Truncating segment {i} to {n} bytes...".format(i=segment_id, n=end))
+            with open(datapath, "r+b") as f:
+                f.truncate(end)
+
+    def _drop(self, key):
+        """marks the current record of key as dead."""
+        old = self.keydir.pop(key, None)
+        if old is not None:
+            self.dead[old[0]] += RECORD_HEADER_SIZE + len(key) + old[2]
+
+    def _map(self, segment_id):
+        """returns a read-only mmap of a segment or None if the segment is empty."""
+        path = os.path.join(self.path, segment_name(segment_id, DATA_SUFFIX))
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _open_active(self):
+        """opens the active segment for appending."""
+        path = os.path.join(self.path, segment_name(self.active_id, DATA_SUFFIX))
+        self.active = open(path, "ab")
+        self.active.seek(0, os.SEEK_END)
+        self.active_size = self.active.tell()
+        self.sizes[self.active_id] = self.active_size
+        self.dead.setdefault(self.active_id, 0)
+        self.active_reader = open(path, "rb")
+        self.active_dirty = False
+
+    def _rotate(self):
+        """makes the active segment immutable and starts a new one."""
+        self.active.close()
+        self.active_reader.close()
+        self.segments[self.active_id] = self._map(self.active_id)
+        self.unhinted.append(self.active_id)
+        # leaves a free id for merging the segments up to this one
+        self.active_id += 2
+        self._open_active()
+
+    def _write_hints(self, segment_id, hints):
+        """writes the hint file for a segment from a list of hint headers and keys and syncs it to the disk."""
+        hintpath = os.path.join(self.path, segment_name(segment_id, HINT_SUFFIX))
+        with open(hintpath + MERGE_SUFFIX, "wb") as f:
+            f.write("".join(hints))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(hintpath + MERGE_SUFFIX, hintpath)
+
+    def _hint_segment(self, segment_id):
+        """syncs a rotated segment to the disk and writes its hint file."""
+        path = os.path.join(self.path, segment_name(segment_id, DATA_SUFFIX))
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+        hints = []
+        for flags, key, offset, voffset, vlength in read_records(path):
+            hints += [struct.pack(HINT_HEADER_FORMAT, flags, len(key), voffset, vlength), key]
+        self._write_hints(segment_id, hints)
+
+    def _append(self, flags, key, value):
+        """appends a record to the active segment. Returns the offset of the value."""
+        record = pack_record(flags, key, value)
+        offset = self.active_size
+        self.active.write(record)
+        self.active_size += len(record)
+        self.sizes[self.active_id] = self.active_size
+        self.active_dirty = True
+        return offset + RECORD_HEADER_SIZE + len(key)
+
+    def get(self, key):
+        """returns the value for key."""
+        with self.lock:
+            if key not in self.keydir:
+                raise KeyError(key)
+            segment_id, offset, length = self.keydir[key]
+            if segment_id == self.active_id:
+                if self.active_dirty:
+                    self.active.flush()
+                    self.active_dirty = False
+                self.active_reader.seek(offset)
+                return self.active_reader.read(length)
+            return self.segments[segment_id][offset:offset + length]
+
+    def set(self, key, value):
+        """sets key to value"""
+        with self.lock:
+            self._drop(key)
+            offset = self._append(FLAG_VALUE, key, value)
+            self.keydir[key] = (self.active_id, offset, len(value))
+            if self.index is not None:
+                self.index.add(key)
+            self._after_write()
+
+    def delete(self, key):
+        """deletes the key/value pair for key."""
+        with self.lock:
+            if key not in self.keydir:
+                return
+            self._drop(key)
+            if self.index is not None:
+                self.index.discard(key)
+            self._append(FLAG_TOMBSTONE, key, "")
+            self.dead[self.active_id] += RECORD_HEADER_SIZE + len(key)
+            self._after_write()
+
+    def _after_write(self):
+        """rotates the active segment and starts the background thread if required."""
+        if self.active_size >= self.max_segment_size:
+            self._rotate()
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, name="LogDatabase worker")
+                self.worker.daemon = True
+                self.worker.start()
+
+    def _work(self):
+        """writes the hint files of the rotated segments, then merges the segments if enough of their space is dead."""
+        merged = False
+        while True:
+            with self.lock:
+                if len(self.unhinted) > 0:
+                    segment_id = self.unhinted.pop(0)
+                elif not merged and len(self.segments) > 1 and self.dead_ratio() >= data.LOGDB_MERGE_RATIO:
+                    segment_id = None
+                else:
+                    self.worker = None
+                    return
+            if segment_id is None:
+                self.merge()
+                merged = True
+                continue
+            with self.merging:
+                with self.lock:
+                    if segment_id not in self.segments:
+                        # merged meanwhile
+                        continue
+                try:
+                    self._hint_segment(segment_id)
+                except Exception:
+                    log.err()
+
+    def merge(self):
+        """
+merges all immutable segments into a new segment, dropping old values and tombstones.
+The new segment and its hint file are synced to the disk before the old segments are removed, so that
+after a crash in between the old segments and their tombstones are still loaded.
+"""
+        with self.merging:
+            with self.lock:
+                ids = sorted(self.segments.keys())
+                if len(ids) > 0 and ids[-1] + 1 == self.active_id:
+                    # the newest segment was merged before and nothing was rotated since
+                    self._rotate()
+                    ids.append(self.active_id - 2)
+            if len(ids) == 0:
+                return
+            try:
+                self._merge(ids)
+            except Exception:
+                log.err()
+
+    def _merge(self, ids):
+        """merges the immutable segments with the given sorted ids into the free segment following the last one."""
+        target = ids[-1] + 1
+        mergepath = os.path.join(self.path, segment_name(target, DATA_SUFFIX + MERGE_SUFFIX))
+        hints = []
+        moved = []  # (key, old location, new location)
+        offset = 0
+        with open(mergepath, "wb") as out:
+            for segment_id in ids:
+                path = os.path.join(self.path, segment_name(segment_id, DATA_SUFFIX))
+                mm = self.segments[segment_id]
+                for flags, key, roffset, voffset, vlength in read_records(path):
+                    location = (segment_id, voffset, vlength)
+                    with self.lock:
+                        live = (flags == FLAG_VALUE and self.keydir.get(key, None) == location)
+                    if not live:
+                        continue
+                    record = pack_record(FLAG_VALUE, key, mm[voffset:voffset + vlength])
+                    out.write(record)
+                    voffset = offset + RECORD_HEADER_SIZE + len(key)
+                    hints += [struct.pack(HINT_HEADER_FORMAT, FLAG_VALUE, len(key), voffset, vlength), key]
+                    moved.append((key, location, (target, voffset, vlength)))
+                    offset += len(record)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(mergepath, os.path.join(self.path, segment_name(target, DATA_SUFFIX)))
+        self._write_hints(target, hints)
+        sync_dir(self.path)
+        with self.lock:
+            for segment_id in ids:
+                mm = self.segments.pop(segment_id)
+                if mm is not None:
+                    mm.close()
+                for suffix in (DATA_SUFFIX, HINT_SUFFIX):
+                    path = os.path.join(self.path, segment_name(segment_id, suffix))
+                    if os.path.exists(path):
+                        os.remove(path)
+            self.segments[target] = self._map(target)
+            for segment_id in ids:
+                del self.sizes[segment_id]
+                del self.dead[segment_id]
+            self.sizes[target] = offset
+            self.dead[target] = 0
+            for key, old, new in moved:
+                if self.keydir.get(key, None) == old:
+                    self.keydir[key] = new
+                else:
+                    # overwritten or deleted while merging
+                    self.dead[target] += RECORD_HEADER_SIZE + len(key) + new[2]
+            log.msg("Merged {n} segments, {b} bytes left.".format(n=len(ids), b=offset))
+
+    def dead_ratio(self):
+        """returns the ratio of space in the immutable segments used by old values and tombstones."""
+        with self.lock:
+            size = sum([self.sizes[i] for i in self.segments])
+            if size == 0:
+                return 0.0
+            return float(sum([self.dead[i] for i in self.segments])) / size
+
+    def stats(self):
+        """returns a dict with the number of keys, the size of the segments and the bytes used by old values."""
+        with self.lock:
+            return {
+                "keys": len(self.keydir),
+                "bytes": sum(self.sizes.values()),
+                "dead_bytes": sum(self.dead.values()),
+                "segments": len(self.sizes),
+                }
+
+    def sync(self):
+        """flushes the active segment to the disk."""
+        with self.lock:
+            self.active.flush()
+            self.active_dirty = False
+            os.fsync(self.active.fileno())
+
+    def getkeys(self):
+        """returns a list of keys."""
+        with self.lock:
+            return self.keydir.keys()
+
+    def iterkeys(self):
+        """returns an iterator over the keys in sorted order, reading them from the sorted index in batches."""
+        return utils.iter_sorted(self.keyrange)
+
+    def keyrange(self, start, end=None, limit=0, reverse=False):
+        """returns a sorted list of the keys in [start, end). See utils.filter_keyrange()."""
+        with self.lock:
+            if self.index is None:
+                self.index = utils.SortedKeys(self.keydir)
+            return self.index.range(start, end, limit, reverse)
+
+    def reset(self):
+        """resets the database."""
+        self.close()
+        with self.lock:
+            for name in os.listdir(self.path):
+                if name.endswith(DATA_SUFFIX) or name.endswith(HINT_SUFFIX):
+                    os.remove(os.path.join(self.path, name))
+            self.open()
+
+    def close(self):
+        """waits for the background thread and closes the segments."""
+        worker = self.worker
+        if worker is not None:
+            worker.join()
+        with self.lock:
+            self.active.close()
+            self.active_reader.close()
+            for mm in self.segments.values():
+                if mm is not None:
+                    mm.close()
+            self.segments = {}
+            self.sizes = {}
+            self.dead = {}
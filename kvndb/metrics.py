@@ -0,0 +1,104 @@
+"""plain text metrics of a router for monitoring systems scraping them over http."""
+from twisted.internet import endpoints
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.python import log
+
+from . import data
+
+
+def escape_label(value):
+    """escapes value for use as the value of a label."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def metric(lines, name, value, **labels):
+    """appends a sample of the metric name to lines."""
+    if labels:
+        name += "{" + ",".join(['{k}="{v}"'.format(k=k, v=escape_label(v)) for k, v in sorted(labels.items())]) + "}"
+    lines.append("{n} {v}".format(n=name, v=float(value)))
+
+
+def format_metrics(stats):
+    """formats the result of RouterFactory.collect_stats() in the text exposition format of prometheus."""
+    lines = []
+    metric(lines, "kvndb_uptime_seconds", stats["uptime"])
+    metric(lines, "kvndb_seq", stats["seq"])
+    for opcode, n in sorted(stats["requests"].items()):
+        metric(lines, "kvndb_requests_total", n, opcode=opcode)
+    for opcode, rate in sorted(stats["rates"].items()):
+        metric(lines, "kvndb_request_rate", rate, opcode=opcode)
+    for opcode, latencies in sorted(stats.get("timings", {}).items()):
+        for p in data.HISTOGRAM_PERCENTILES:
+            name = "p" + str(p).replace(".", "")
+            metric(lines, "kvndb_request_latency_seconds", latencies[name] / 1000.0, opcode=opcode, quantile=p / 100.0)
+        metric(lines, "kvndb_request_latency_seconds_count", latencies["count"], opcode=opcode)
+    metric(lines, "kvndb_pending_calls", stats["pending_calls"])
+    metric(lines, "kvndb_pending_acks", stats["pending_acks"])
+    for state, n in sorted(stats["nodes"].items()):
+        metric(lines, "kvndb_nodes", n, state=state)
+    metric(lines, "kvndb_gets_total", stats["gets"])
+    metric(lines, "kvndb_hedges_total", stats["hedges"])
+    metric(lines, "kvndb_acked_writes_total", stats["acked_writes"])
+    metric(lines, "kvndb_failed_writes_total", stats["failed_writes"])
+    metric(lines, "kvndb_write_log_bytes", stats["write_log"]["bytes"])
+    if stats["cache"] is not None:
+        metric(lines, "kvndb_cache_bytes", stats["cache"]["bytes"])
+        metric(lines, "kvndb_cache_hit_ratio", stats["cache"]["hit_ratio"])
+    for server, s in sorted(stats["servers"].items()):
+        metric(lines, "kvndb_server_syncing", int(s["syncing"]), server=server)
+        metric(lines, "kvndb_server_outstanding", s["outstanding"], server=server)
+        metric(lines, "kvndb_server_queue_bytes", s["queue"]["bytes"], server=server)
+        latencies = s["latencies"]
+        for p in data.HISTOGRAM_PERCENTILES:
+            name = "p" + str(p).replace(".", "")
+            metric(lines, "kvndb_server_latency_seconds", latencies[name] / 1000.0, server=server, quantile=p / 100.0)
+        metric(lines, "kvndb_server_latency_seconds_count", latencies["count"], server=server)
+    for server, s in sorted(stats.get("databases", {}).items()):
+        metric(lines, "kvndb_database_up", int("error" not in s), server=server)
+        if "keys" in s:
+            metric(lines, "kvndb_database_keys", s["keys"], server=server)
+        if "bytes" in s:
+            metric(lines, "kvndb_database_bytes", s["bytes"], server=server)
+        if "evictions" in s:
+            metric(lines, "kvndb_database_memory_bytes", s["memory"], server=server)
+            metric(lines, "kvndb_database_evictions_total", s["evictions"], server=server)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsResource(Resource):
+    """serves the statistics of a router and its databases as plain text."""
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render_GET(self, request):
+        """collects the statistics and answers once all databases answered."""
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = self.factory.collect_stats()
+        d.addCallback(format_metrics)
+        d.addCallbacks(self._write, self._failed, callbackArgs=(request, finished), errbackArgs=(request, finished))
+        return NOT_DONE_YET
+
+    def _write(self, text, request, finished):
+        """sends the metrics unless the request was closed."""
+        if not finished:
+            request.write(text)
+            request.finish()
+
+    def _failed(self, f, request, finished):
+        """logs f and reports the error."""
+        log.err(f, "Collecting metrics failed:")
+        if not finished:
+            request.setResponseCode(500)
+            request.finish()
+
+
+def listen(reactor, factory, description):
+    """serves the metrics of the router factory on the server endpoint description. Returns a deferred for the port."""
+    endpoint = endpoints.serverFromString(reactor, description)
+    return endpoint.listen(Site(MetricsResource(factory)))
@@ -0,0 +1,140 @@
+"""optional timing of the requests of routers and databases, a log of slow requests and a profiler toggled by a signal."""
+import time
+import signal
+import cProfile
+import collections
+
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from . import data, utils
+
+
+class Trace(object):
+    """The stages of a request. Every mark is the time at which a stage ended."""
+    __slots__ = ("opcode", "started", "marks", "info", "finished")
+
+    def __init__(self, opcode, started):
+        self.opcode = opcode
+        self.started = started
+        self.marks = []  # [stage, time]
+        self.info = {}  # details included in the slow log
+        self.finished = False
+
+    def stages(self):
+        """returns a list of (stage, seconds spent in it)."""
+        stages = []
+        last = self.started
+        for stage, t in self.marks:
+            stages.append((stage, t - last))
+            last = t
+        return stages
+
+
+class RequestTracer(object):
+    """
+Times the requests handled by a router or database by opcode, from receiving a request until it was answered.
+While a request is dispatched, it is available as current, so that the code handling it can mark the end of a stage.
+If slow_threshold is not None, requests which took at least this many seconds are logged with the time spent
+in every stage and the last slow_log_size of them are kept.
+"""
+    def __init__(self, clock, slow_threshold=None, slow_log_size=data.SLOW_LOG_SIZE):
+        self.clock = clock
+        self.slow_threshold = slow_threshold
+        self.timings = {}  # opcode name -> Histogram
+        self.slow = collections.deque(maxlen=slow_log_size)
+        self.current = None  # Trace of the request being dispatched
+
+    def dispatch(self, opcode, handler, *args):
+        """calls handler with args. If it returns a deferred, the request is answered once it fired."""
+        trace = Trace(opcode, self.clock())
+        self.current = trace
+        try:
+            result = handler(*args)
+        finally:
+            self.current = None
+        self.mark(trace, "dispatch")
+        if isinstance(result, Deferred) and not result.called:
+            result.addBoth(self._answered, trace)
+        else:
+            self.finish(trace)
+        return result
+
+    def mark(self, trace, stage):
+        """marks the end of stage of the request trace. Consecutive marks of the same stage are merged."""
+        if trace.finished:
+            return
+        now = self.clock()
+        if len(trace.marks) > 0 and trace.marks[-1][0] == stage:
+            trace.marks[-1][1] = now
+        else:
+            trace.marks.append([stage, now])
+
+    def _answered(self, result, trace):
+        """called once the request trace was answered."""
+        self.mark(trace, "reply")
+        self.finish(trace)
+        return result
+
+    def finish(self, trace):
+        """records the time taken by the request trace."""
+        trace.finished = True
+        total = trace.marks[-1][1] - trace.started
+        name = data.OPCODE_NAMES.get(trace.opcode, repr(trace.opcode))
+        if name not in self.timings:
+            self.timings[name] = utils.Histogram()
+        self.timings[name].add(total)
+        if self.slow_threshold is not None and total >= self.slow_threshold:
+            stages = [(stage, round(seconds * 1000, 3)) for stage, seconds in trace.stages()]
+            entry = {"time": time.time(), "opcode": name, "total": round(total * 1000, 3), "stages": stages}
+            entry.update(trace.info)
+            self.slow.append(entry)
+            log.msg("Slow request: {o} took {t} ms ({s}).".format(
+                o=name, t=entry["total"], s=", ".join(["{n} {ms} ms".format(n=n, ms=ms) for n, ms in stages]),
+                ))
+
+    def stats(self):
+        """returns a dict with the latency percentiles by opcode and the slow log."""
+        return {
+            "timings": dict([(name, histogram.summary()) for name, histogram in self.timings.items()]),
+            "slow_log": list(self.slow),
+            }
+
+
+class Profiler(object):
+    """Profiles the reactor thread with cProfile while running. The statistics are written to path when it stops."""
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    @property
+    def running(self):
+        """True while profiling."""
+        return self.profile is not None
+
+    def start(self):
+        """starts profiling."""
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            log.msg("Profiling started.")
+
+    def stop(self):
+        """stops profiling and writes the statistics, which can be read using the pstats module."""
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+            log.msg("Profiling stopped, statistics written to '{p}'.".format(p=self.path))
+
+    def toggle(self):
+        """starts profiling if stopped, otherwise stops it."""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def install(self, reactor, signame=data.PROFILE_SIGNAL):
+        """toggles the profiler when the process receives the signal signame and stops it when the reactor shuts down."""
+        signal.signal(getattr(signal, signame), lambda signum, frame: reactor.callFromThread(self.toggle))
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
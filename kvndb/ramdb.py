@@ -1,37 +1,162 @@
 """A in memory database."""
+import random
+import collections
+
+from . import data, utils
 
 
 class RamDatabase(object):
-    """A database living in the memory"""
+    """
+A database living in the memory.
+The optional arguments are the maximum memory in bytes and the eviction policy, one of data.RAMDB_EVICTION_POLICIES.
+Once the keys and values use more memory, keys are evicted: 'lru' evicts the least recently used key, 'lfu' the
+least frequently used one of data.RAMDB_LFU_SAMPLES random keys and 'random' a random key.
+The memory is approximated by the size of the keys and values plus data.RAMDB_ENTRY_OVERHEAD bytes per key.
+A database which evicts keys is lossy; the router reads keys missing on it from the databases which are not.
+A sorted index of the keys is built by the first key range request or scan and kept up to date afterwards.
+"""
+    blocking = False  # calls return immediately; no need for a thread pool
+
     def __init__(self, args):
         self.args = args
-        self.db = {}
+        if len(self.args) > 2:
+            raise ValueError("Expected the maximum memory and optionally the eviction policy as arguments for the DB.")
+        if len(self.args) > 0:
+            self.maxmemory = int(args[0])
+        else:
+            self.maxmemory = None
+        if len(self.args) > 1:
+            self.policy = args[1]
+        else:
+            self.policy = data.DEFAULT_RAMDB_EVICTION_POLICY
+        if self.policy not in data.RAMDB_EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy: '{p}'!".format(p=self.policy))
+        self.lossy = self.maxmemory is not None
+        self.threadsafe = not self.lossy  # reads change the eviction order
+        self.sampled = self.lossy and self.policy != "lru"
+        self.rng = random.Random()
+        self.evictions = 0
+        self.reset()
 
     def get(self, key):
         """returns the value for key."""
         if key in self.db:
+            if self.lossy:
+                self._accessed(key)
             return self.db[key]
         else:
             raise KeyError(key)
 
     def set(self, key, value):
         """sets key to value"""
+        if key in self.db:
+            self.bytes -= len(self.db[key])
+            if self.lossy:
+                self._accessed(key)
+        else:
+            self.bytes += len(key)
+            if self.sampled:
+                self.positions[key] = len(self.keys)
+                self.keys.append(key)
+            if self.index is not None:
+                self.index.add(key)
         self.db[key] = value
+        self.bytes += len(value)
+        if self.lossy:
+            self._evict(key)
 
     def delete(self, key):
         """deletes the key/value pair for key."""
-        try:
-            del self.db[key]
-        except KeyError:
-            pass
+        if key in self.db:
+            self._remove(key)
+
+    def _accessed(self, key):
+        """updates the eviction order after a read or write of key."""
+        if self.policy == "lru":
+            # move key to the end
+            self.db[key] = self.db.pop(key)
+        elif self.policy == "lfu":
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _remove(self, key):
+        """removes key in O(1)."""
+        self.bytes -= len(key) + len(self.db.pop(key))
+        if self.index is not None:
+            self.index.discard(key)
+        if self.sampled:
+            # move the last key into the gap
+            i = self.positions.pop(key)
+            last = self.keys.pop()
+            if last != key:
+                self.keys[i] = last
+                self.positions[last] = i
+            self.counts.pop(key, None)
+
+    def memory(self):
+        """returns the approximate memory used by the keys and values."""
+        return self.bytes + len(self.db) * data.RAMDB_ENTRY_OVERHEAD
+
+    def _evict(self, keep):
+        """evicts keys other than keep until the memory is below the maximum."""
+        while self.memory() > self.maxmemory and len(self.db) > 1:
+            if self.policy == "lru":
+                victim = next(iter(self.db))
+            elif self.policy == "lfu":
+                victim = None
+                for i in xrange(data.RAMDB_LFU_SAMPLES):
+                    key = self.keys[self.rng.randrange(len(self.keys))]
+                    if key != keep and (victim is None or self.counts.get(key, 0) < self.counts.get(victim, 0)):
+                        victim = key
+                if victim is None:
+                    continue
+            else:
+                victim = self.keys[self.rng.randrange(len(self.keys))]
+                if victim == keep:
+                    continue
+            self._remove(victim)
+            self.evictions += 1
 
     def getkeys(self):
         """returns a list of keys."""
         return self.db.keys()
 
+    def iterkeys(self):
+        """returns an iterator over the keys in sorted order, reading them from the sorted index in batches."""
+        return utils.iter_sorted(self.keyrange)
+
+    def keyrange(self, start, end=None, limit=0, reverse=False):
+        """returns a sorted list of the keys in [start, end). See utils.filter_keyrange()."""
+        if self.index is None:
+            self.index = utils.SortedKeys(self.db)
+        return self.index.range(start, end, limit, reverse)
+
+    def stats(self):
+        """returns a dict with the number of keys, the bytes stored and the number of evicted keys."""
+        stats = {"keys": len(self.db), "bytes": self.bytes}
+        if self.lossy:
+            stats.update({
+                "memory": self.memory(),
+                "maxmemory": self.maxmemory,
+                "policy": self.policy,
+                "evictions": self.evictions,
+                })
+        return stats
+
+    def sync(self):
+        """no-op."""
+        pass
+
     def reset(self):
         """resets the database."""
-        self.db = {}
+        if self.lossy and self.policy == "lru":
+            self.db = collections.OrderedDict()  # least recently used first
+        else:
+            self.db = {}
+        self.bytes = 0  # size of the keys and values
+        self.keys = []  # keys of the sampled policies, so that random keys are chosen in O(1)
+        self.positions = {}  # key -> index in self.keys
+        self.counts = {}  # key -> accesses, for 'lfu'
+        self.index = None  # utils.SortedKeys once keys were requested in order
 
     def close(self):
         """no-op."""
@@ -0,0 +1,74 @@
+"""consistent hashing used by the router to place keys on the databases."""
+import struct
+import bisect
+import hashlib
+
+from . import data
+
+
+def hash_key(key):
+    """returns the position of key on the ring."""
+    return struct.unpack(data.RING_HASH_FORMAT, hashlib.md5(key).digest()[:data.RING_HASH_SIZE])[0]
+
+
+class HashRing(object):
+    """
+A consistent hash ring with virtual nodes.
+Every node is placed on the ring 'vnodes' times, so that a join or a leave
+only moves the ranges adjacent to the points of that node.
+Nodes must have a 'node_id' attribute, which is used to place them on the ring.
+"""
+    def __init__(self, vnodes=data.DEFAULT_VNODES, nodes=()):
+        self.vnodes = vnodes
+        self.points = []
+        self.owners = []
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def add(self, node):
+        """adds node to the ring."""
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in xrange(self.vnodes):
+            point = hash_key("{n}#{i}".format(n=node.node_id, i=i))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        """removes node from the ring."""
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        keep = [i for i in xrange(len(self.owners)) if self.owners[i] is not node]
+        self.points = [self.points[i] for i in keep]
+        self.owners = [self.owners[i] for i in keep]
+
+    def get_nodes(self, key, n, allowed=None):
+        """
+returns up to n distinct nodes responsible for key, in ring order.
+If allowed is not None, nodes not in allowed are skipped.
+"""
+        found = []
+        if len(self.points) == 0:
+            return found
+        if allowed is not None:
+            n = min(n, len([node for node in self.nodes if node in allowed]))
+        else:
+            n = min(n, len(self.nodes))
+        start = bisect.bisect(self.points, hash_key(key))
+        i = 0
+        while len(found) < n and i < len(self.points):
+            node = self.owners[(start + i) % len(self.points)]
+            if (node not in found) and (allowed is None or node in allowed):
+                found.append(node)
+            i += 1
+        return found
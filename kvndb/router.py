@@ -1,119 +1,1394 @@
 """The KVNDB Router coordinates the databases and requestss"""
+import os
+import json
 import struct
 import random
+import functools
+import collections
 
 
+from zope.interface import implementer
 from twisted.internet.protocol import Factory
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, fail, Deferred, DeferredList
+from twisted.internet.defer import CancelledError, TimeoutError
 from twisted.python.failure import Failure
 from twisted.python import log
 from twisted.protocols.basic import IntNStringReceiver
 
-from . import data, utils
+from . import data, utils, ring, cache
 
 
 class RouterFactory(Factory):
-    """A twisted.internet.protocol.Factory for the request routing."""
-    def __init__(self, reactor, pswd):
+    """
+A twisted.internet.protocol.Factory for the request routing.
+If replication is None, every database holds the full dataset.
+Otherwise the keys are partitioned on a consistent hash ring and every key is stored on 'replication' databases.
+If cache_size is not 0, up to cache_size bytes of values are cached by the router, for at most cache_max_age
+seconds if it is not None. Writes through other routers do not update the cache.
+read_policy is one of data.READ_POLICIES and selects how reads are spread between the servers:
+'random' picks a random server, 'least' picks the server with the least outstanding requests and
+'p2c' picks the less loaded one of two random servers, weighting outstanding requests by the latency.
+If hedge_percentile is not None, a get which was not answered within this percentile of the recent
+get latencies is also sent to a second server, but only for up to hedge_budget of all gets.
+Every write gets a sequence number; the last write_log_size bytes of writes are kept, so that a
+database which reconnects only needs to receive the writes it missed.
+Several routers may serve the same databases. Each of them needs a distinct router_id below data.MAX_ROUTERS,
+so that the rid ranges of their connections do not overlap. peers is a list of the client endpoint
+descriptions of all routers, which is sent to clients asking for the available routers.
+Writes to a database whose connection can not keep up are queued. Once a queue holds more than queue_high
+bytes, the router stops reading from the clients until all queues are below queue_low bytes again.
+Values are kept in the form of connections with data.CAP_COMPRESSION, so that compressed values are
+forwarded as they are. They are only converted for clients and databases which do not support it.
+The requests of the clients are counted by opcode; their rates are measured every data.STATS_RATE_INTERVAL seconds.
+If tracer is a kvndb.profiling.RequestTracer, it times the requests and the answers of the databases.
+Databases with data.CAP_LOSSY evict keys. Keys missing on them are read from the other databases, which are
+also preferred for listing the keys and as donors of snapshots.
+Key ranges are answered by databases with data.CAP_KEYRANGE in order; in sharded mode the sorted answers of all
+databases are merged. The keys of other databases are sorted by the router.
+"""
+    def __init__(
+        self, reactor, pswd, replication=None, vnodes=data.DEFAULT_VNODES, cache_size=0, read_policy=data.DEFAULT_READ_POLICY,
+        cache_max_age=None, hedge_percentile=None, hedge_budget=data.DEFAULT_HEDGE_BUDGET, write_log_size=data.DEFAULT_WRITE_LOG_SIZE,
+        router_id=0, peers=(), queue_high=data.DEFAULT_QUEUE_HIGH, queue_low=data.DEFAULT_QUEUE_LOW, tracer=None,
+        ):
         if hasattr(Factory, "__init__"):
             # call __init__ if required
             Factory.__init__(self)
         self.reactor = reactor
         self.pswd = pswd
+        self.replication = replication
+        if read_policy not in data.READ_POLICIES:
+            raise ValueError("Unknown read policy: '{p}'!".format(p=read_policy))
+        self.read_policy = read_policy
+        if not 0 <= router_id < data.MAX_ROUTERS:
+            raise ValueError("Router id must be between 0 and {m}!".format(m=data.MAX_ROUTERS - 1))
+        self.router_id = router_id
+        self.peers = list(peers)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_delay = None  # None until enough latencies are known
+        self.latencies = collections.deque(maxlen=data.HEDGE_SAMPLES)
+        self.samples = 0
+        self.gets = 0
+        self.hedges = 0
+        if cache_size > 0:
+            self.cache = cache.LRUCache(cache_size, max_age=cache_max_age)
+        else:
+            self.cache = None
         self.servers = []
         self.syncing = []
         self.all = []
-        self.free_ranges = []
-        self.calls = {}
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.congested = set()  # write queues above the high water mark
+        self.free_ranges = []  # indexes of the rid ranges of closed connections
+        self.next_range = 0
+        self.ring = ring.HashRing(vnodes)
+        self.placement = []  # the servers the data is completely placed on
+        self.placement_ring = ring.HashRing(vnodes)
+        self.rebalancing = False
+        self.rebalance_ring = None  # the placement the running rebalance copies the data to
+        self.rebalance_scheduled = False
+        self.rebalance_dirty = set()
+        self.scans = collections.OrderedDict()  # cursor -> KeyScan
+        self.snapshots = {}  # rid of a donor -> SnapshotTransfer
+        self.next_snapshot = 1
+        # the epoch changes when the router restarts, invalidating the sequence numbers known by the databases
+        self.epoch = struct.unpack(data.SEQ_FORMAT, os.urandom(data.SEQ_SIZE))[0] | 1
+        self.seq = 0
+        self.write_log = collections.deque()  # (seq, deleted, [(key, value)])
+        self.write_log_size = write_log_size
+        self.write_log_bytes = 0
+        self.pending_acks = []  # PendingAck, ordered by seq
+        self.acked_writes = 0
+        self.failed_writes = 0
+        self.ack_latency = None  # EWMA of the time until a write was acknowledged
+        self.tracked = {}  # key -> set of clients which may have cached key
+        self.next_scan = 1
+        self.started = reactor.seconds()
+        self.requests = collections.Counter()  # opcode -> requests received from clients
+        self.rates = {}  # opcode name -> requests per second during the last data.STATS_RATE_INTERVAL
+        self.rate_sample = (None, {})  # (time, copy of self.requests) of the last rate measurement
+        self.rate_loop = None
+        self.tracer = tracer
+
+    def startFactory(self):
+        """starts measuring the request rates."""
+        self.rate_loop = LoopingCall(self.update_rates)
+        self.rate_loop.clock = self.reactor
+        self.rate_loop.start(data.STATS_RATE_INTERVAL, now=True)
+
+    def stopFactory(self):
+        """stops measuring the request rates."""
+        if self.rate_loop is not None and self.rate_loop.running:
+            self.rate_loop.stop()
+        self.rate_loop = None
+
+    @property
+    def sharded(self):
+        """True if the keys are partitioned between the databases."""
+        return self.replication is not None
 
     def buildProtocol(self, addr):
         """builds the protocol."""
         log.msg("Building protocol for connection with client '{a}'...".format(a=addr))
         return RouterProtocol(self)
 
-    def got_answer(self, proto, actionbyte, msg):
-        """a server answered a request."""
-        rid = struct.unpack(data.MESSAGE_ID_FORMAT, msg[:data.MESSAGE_ID_SIZE])[0]
-        if rid not in self.calls:
-            # request already answered by another server
+    def got_answer(self, proto, msg):
+        """a server answered a request. msg is the whole message."""
+        actionbyte = msg[0]
+        rid = data.MESSAGE_ID_STRUCT.unpack_from(msg, 1)[0]
+        call = proto.pop_call(rid)
+        if call is None:
+            # request already failed
             return
-        elif actionbyte == data.ID_ANSWER:
-            value = msg[data.MESSAGE_ID_SIZE:]
-            d = self.calls[rid]
-            try:
-                d.callback(value)
-            finally:
-                del self.calls[rid]
+        self.finish_call(call)
+        d = call.d
+        if d.called:
+            # cancelled by the client or the deadline passed
+            return
+        if actionbyte == data.ID_ANSWER:
+            d.callback(proto.encode(msg[1 + data.MESSAGE_ID_SIZE:]))
+        elif actionbyte == data.ID_MANSWER:
+            d.callback(proto.encode_results(msg[1 + data.MESSAGE_ID_SIZE:]))
+        elif actionbyte in (data.ID_ALLKEYS, data.ID_SCANANSWER):
+            d.callback(msg[1 + data.MESSAGE_ID_SIZE:])
         elif actionbyte == data.ID_NOTFOUND:
-            d = self.calls[rid]
             fail = Failure(KeyError())
-            try:
-                d.errback(fail)
-            finally:
-                del self.calls[rid]
-        elif actionbyte == data.ID_ALLKEYS:
-            keylist = msg[data.MESSAGE_ID_SIZE:]
-            d = self.calls[rid]
-            try:
-                d.callback(keylist)
-            finally:
-                del self.calls[rid]
+            d.errback(fail)
+        elif actionbyte == data.ID_EXPIRED:
+            d.errback(Failure(TimeoutError()))
         else:
             raise RuntimeError("Invalid Answer!")
 
-    def get(self, request_id, key):
-        """returns the value for key."""
-        rid = struct.unpack(data.MESSAGE_ID_FORMAT, request_id)[0]
+    def register_call(self, server, sample=False, retry=None):
+        """
+registers a request to server. Returns a tuple (rid string, Call); the answer fires call.d.
+The rid is an index into the pending calls of server, not the rid used by the client.
+If sample is True, the latency is used to calculate the hedging delay.
+If retry is not None, it is called if server is lost and should return a deferred for the answer of another server.
+"""
+        call = Call(Deferred(), server, self.reactor.seconds(), sample, retry)
+        rid = server.add_call(call)
+        server.outstanding += 1
+        if self.tracer is not None and self.tracer.current is not None:
+            call.trace = self.tracer.current
+            call.trace.info.setdefault("servers", []).append([server.node_id, server.outstanding])
+        return data.MESSAGE_ID_STRUCT.pack(rid), call
+
+    def finish_call(self, call):
+        """updates the load statistics of the server of call once it answered."""
+        server = call.server
+        server.outstanding -= 1
+        latency = self.reactor.seconds() - call.started
+        server.latencies.add(latency)
+        if server.latency is None:
+            server.latency = latency
+        else:
+            server.latency += data.LATENCY_EWMA_ALPHA * (latency - server.latency)
+        if call.timer is not None and call.timer.active():
+            call.timer.cancel()
+        if call.trace is not None:
+            self.tracer.mark(call.trace, "server")
+        if call.sample and self.hedge_percentile is not None:
+            self.latencies.append(latency)
+            self.samples += 1
+            if self.samples % data.HEDGE_RECOMPUTE_INTERVAL == 0 and len(self.latencies) >= data.HEDGE_MIN_SAMPLES:
+                latencies = sorted(self.latencies)
+                index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100.0))
+                self.hedge_delay = latencies[index]
+
+    def expired(self, deadline):
+        """returns True if deadline is not None and passed."""
+        return deadline is not None and self.reactor.seconds() >= deadline
+
+    def hedge(self, call, key, targets, d, deadline=None):
+        """sends a get, which was not answered in time, to a second server if the hedging budget allows it."""
+        if d.called:
+            return
+        if self.hedges + 1 > self.hedge_budget * self.gets:
+            return
+        targets = [server for server in targets if server is not call.server and server in self.servers]
+        if len(targets) == 0:
+            return
+        self.hedges += 1
+        server = self.choose_server(targets)
+        self.request_value(server, key, deadline).addBoth(self._hedge_answer, d)
+
+    def _hedge_answer(self, result, d):
+        """passes the answer to a hedgable get to the client request, unless it was already answered."""
+        if not d.called:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def choose_server(self, servers):
+        """chooses the server to send a read to according to the read policy."""
+        if len(servers) == 1 or self.read_policy == "random":
+            return random.choice(servers)
+        elif self.read_policy == "least":
+            least = min([server.outstanding for server in servers])
+            return random.choice([server for server in servers if server.outstanding == least])
+        else:
+            # power of two choices
+            a, b = random.sample(servers, 2)
+            if b.load() < a.load():
+                return b
+            return a
+
+    def authoritative(self, servers):
+        """returns the servers which do not evict keys or all servers if all of them do."""
+        complete = [server for server in servers if not server.lossy]
+        if len(complete) == 0:
+            return servers
+        return complete
+
+    def read_targets(self, key):
+        """returns a list of servers which may answer a read of key."""
+        if not self.sharded:
+            return self.servers
+        # until a rebalance finished, only the owners in the old placement are guaranteed to have the key.
+        targets = [server for server in self.placement_ring.get_nodes(key, self.replication) if server in self.servers]
+        if len(targets) == 0:
+            targets = self.ring.get_nodes(key, self.replication, allowed=self.servers)
+        return targets
+
+    def write_targets(self, key):
+        """returns a list of servers and syncing databases which need to receive a write of key."""
+        if not self.sharded:
+            return self.servers + self.syncing
+        # until a rebalance finished, both the old and the new owners receive the writes.
+        targets = self.ring.get_nodes(key, self.replication)
+        owners = self.ring.get_nodes(key, self.replication, allowed=self.servers)
+        owners += self.placement_ring.get_nodes(key, self.replication)
+        if self.rebalance_ring is not None:
+            # the running rebalance may copy the key from these owners
+            owners += self.rebalance_ring.get_nodes(key, self.replication)
+        for server in owners:
+            if (server not in targets) and (server in self.servers or server in self.syncing):
+                targets.append(server)
+        return targets
+
+    def get(self, key, deadline=None):
+        """returns the value for key. If deadline is not None, the servers drop the request once it passed."""
+        if self.cache is not None:
+            try:
+                return succeed(self.cache.get(key))
+            except KeyError:
+                pass
         d = Deferred()
-        if len(self.servers) == 0:
+        targets = self.read_targets(key)
+        if len(targets) == 0:
             # no server available; raise KeyError to deferred
             f = Failure(KeyError())
             d.errback(f)
             return d
-        self.calls[rid] = d
-        server = random.choice(self.servers)
-        server.send_get(request_id, key)
+        if self.expired(deadline):
+            return fail(TimeoutError())
+        server = self.choose_server(targets)
+        if key in server.queue.writes:
+            # the server did not receive the latest write yet
+            return server.queue.lookup(key)
+        self.gets += 1
+        request_id, call = self.register_call(server, sample=True, retry=functools.partial(self.retry_get, key, deadline))
+        d = call.d
+        if server.lossy:
+            d.addErrback(self._authoritative_get, key, deadline)
+        if self.hedge_percentile is not None:
+            # the first answer of the servers is used
+            d = Deferred()
+            call.d.addBoth(self._hedge_answer, d)
+            if self.hedge_delay is not None and len(targets) > 1:
+                call.timer = self.reactor.callLater(self.hedge_delay, self.hedge, call, key, targets, d, deadline)
+        if self.cache is not None:
+            d.addBoth(self._fill_cache, key, self.cache.begin_fill(key))
+        server.send_get(request_id, key, deadline)
         return d
 
-    def set(self, key, value):
-        """sets the value for key."""
-        for server in self.servers + self.syncing:
-            server.send_set(key, value)
+    def retry_get(self, key, deadline=None):
+        """sends a get, whose server was lost, to another server. Returns a deferred for the value."""
+        targets = self.read_targets(key)
+        if len(targets) == 0:
+            return fail(KeyError())
+        if self.expired(deadline):
+            return fail(TimeoutError())
+        return self.request_value(self.choose_server(targets), key, deadline, retry=True)
 
-    def delete(self, key):
-        """deletes the value for key."""
-        for server in self.servers + self.syncing:
-            server.send_del(key)
+    def _authoritative_get(self, f, key, deadline=None):
+        """reads key from the databases which do not evict keys if it was not found on a lossy one."""
+        f.trap(KeyError)
+        servers = [server for server in self.read_targets(key) if not server.lossy]
+        if len(servers) == 0:
+            return f
+        if self.expired(deadline):
+            raise TimeoutError()
+        return self.request_value(self.choose_server(servers), key, deadline, retry=True)
+
+    def _fill_cache(self, result, key, token):
+        """adds the result of a get to the cache."""
+        if isinstance(result, Failure):
+            self.cache.end_fill(key, token)
+        else:
+            self.cache.end_fill(key, token, result)
+        return result
 
-    def getkeys(self, request_id,):
-        """returns a list of keys."""
+    def log_write(self, deleted, pairs):
+        """adds a write to the write log and returns its sequence number. pairs is a list of (key, value) tuples."""
+        self.seq += 1
+        if self.write_log_size > 0:
+            self.write_log.append((self.seq, deleted, pairs))
+            self.write_log_bytes += sum([len(key) + len(value or "") for key, value in pairs])
+            while self.write_log_bytes > self.write_log_size:
+                seq, olddeleted, oldpairs = self.write_log.popleft()
+                self.write_log_bytes -= sum([len(key) + len(value or "") for key, value in oldpairs])
+        return self.seq
+
+    def acked_write(self, proto, acks, msg):
+        """
+performs the set or delete in msg sent by the client proto.
+Returns a deferred which will be called with True once acks databases synced the write
+or with False if not enough databases are available.
+"""
+        actionbyte = msg[0]
+        if actionbyte == data.ID_SET:
+            keysize = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from(msg, 1)[0]
+            key = msg[1 + data.MESSAGE_KEY_LENGTH_SIZE:1 + data.MESSAGE_KEY_LENGTH_SIZE + keysize]
+            value = proto.encode(msg[1 + data.MESSAGE_KEY_LENGTH_SIZE + keysize:])
+        elif actionbyte == data.ID_DEL:
+            key = msg[1:]
+        else:
+            # only sets and deletes can be acknowledged
+            log.err("Client requested acknowledgement of an unsupported write!")
+            return succeed(False)
+        # syncing databases buffer writes, so only serving databases can confirm them
+        servers = [server for server in self.write_targets(key) if server in self.servers]
+        if actionbyte == data.ID_SET:
+            seq = self.set(key, value, proto)
+        else:
+            seq = self.delete(key, proto)
+        if len(servers) < acks:
+            self.failed_writes += 1
+            return succeed(False)
+        pending = PendingAck(seq, acks, servers, self.reactor.seconds())
+        self.pending_acks.append(pending)
+        for server in servers:
+            server.send_sync()
+        return pending.d
+
+    def got_ack(self, proto, seq):
+        """the database proto synced all writes up to seq."""
+        done = []
+        for pending in self.pending_acks:
+            if pending.seq > seq:
+                break
+            if proto in pending.servers:
+                pending.servers.remove(proto)
+                pending.needed -= 1
+                if pending.needed <= 0:
+                    done.append(pending)
+        for pending in done:
+            self.pending_acks.remove(pending)
+            self.acked_writes += 1
+            latency = self.reactor.seconds() - pending.started
+            if self.ack_latency is None:
+                self.ack_latency = latency
+            else:
+                self.ack_latency += data.LATENCY_EWMA_ALPHA * (latency - self.ack_latency)
+            pending.d.callback(True)
+
+    def catchup(self, proto, epoch, seq):
+        """
+sends the writes after seq to the reconnected database proto.
+Returns False if proto needs to be reset because the writes are no longer in the write log
+or because it has no state (epoch 0), unless there is no other database to load the data from.
+"""
+        # if there is no other database, the data of proto is the best we have.
+        alone = len([server for server in self.servers if server is not proto]) == 0
+        if epoch == 0:
+            # a new database or one which is resetting
+            return alone
+        if epoch != self.epoch:
+            # the state is from before the router restarted; the database may have missed every write since then
+            seq = 0
+        if seq >= self.seq:
+            # the database is up to date
+            return True
+        if len(self.write_log) == 0 or self.write_log[0][0] > seq + 1:
+            # log truncated
+            return alone
+        n = 0
+        for logseq, deleted, pairs in self.write_log:
+            if logseq <= seq:
+                continue
+            if self.sharded:
+                pairs = [(key, value) for key, value in pairs if proto in self.write_targets(key)]
+                if len(pairs) == 0:
+                    continue
+            if deleted:
+                proto.send_mdel([key for key, value in pairs], logseq)
+            else:
+                proto.send_mset(pairs, logseq)
+            n += 1
+        log.msg("Sent {n} writes to {p} to catch up.".format(n=n, p=proto.node_id))
+        return True
+
+    def set(self, key, value, source=None):
+        """sets the value for key and returns the sequence number of the write. source is the client which sent the request."""
+        if self.rebalancing:
+            self.rebalance_dirty.add(key)
+        if self.cache is not None:
+            self.cache.set(key, value)
+        if len(self.tracked) > 0:
+            self.invalidate_tracked([key], source)
+        if source is not None and source.tracking:
+            # the client caches the values it writes
+            self.track(source, key)
+        seq = self.log_write(False, [(key, value)])
+        for server in self.write_targets(key):
+            server.send_set(key, value, seq)
+        return seq
+
+    def delete(self, key, source=None):
+        """deletes the value for key and returns the sequence number of the write. source is the client which sent the request."""
+        if self.rebalancing:
+            self.rebalance_dirty.add(key)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if len(self.tracked) > 0:
+            self.invalidate_tracked([key], source)
+        seq = self.log_write(True, [(key, None)])
+        for server in self.write_targets(key):
+            server.send_del(key, seq)
+        return seq
+
+    def group_writes(self, keys):
+        """returns a dict mapping each target server to the subset of keys it needs to receive."""
+        groups = {}
+        for key in keys:
+            if self.rebalancing:
+                self.rebalance_dirty.add(key)
+            for server in self.write_targets(key):
+                groups.setdefault(server, []).append(key)
+        return groups
+
+    @inlineCallbacks
+    def mget(self, keys, deadline=None):
+        """returns the answer string for a batch get of keys, splitting the batch per server."""
+        found = {}
+        tokens = {}
+        missing = []
+        for key in keys:
+            if self.cache is not None:
+                if key in found or key in tokens:
+                    continue
+                try:
+                    found[key] = self.cache.get(key)
+                    continue
+                except KeyError:
+                    tokens[key] = self.cache.begin_fill(key)
+            missing.append(key)
+        try:
+            resultstring = yield self.fetch_values(missing, deadline)
+        except Exception:
+            for key, token in tokens.items():
+                self.cache.end_fill(key, token)
+            raise
+        for key, value in utils.resultstring2list(resultstring):
+            if value is not None:
+                found[key] = value
+        for key, token in tokens.items():
+            self.cache.end_fill(key, token, found.get(key, None))
+        returnValue(utils.resultlist2string([(key, found.get(key, None)) for key in keys]))
+
+    @inlineCallbacks
+    def fetch_values(self, keys, deadline=None, authoritative=False):
+        """
+returns the answer string for a batch get of keys without using the cache, splitting the batch per server.
+If a server is lost, its keys are requested from the other servers.
+If authoritative is True, only servers which do not evict keys are asked.
+"""
+        if self.expired(deadline):
+            raise TimeoutError()
+        groups = {}
+        for key in keys:
+            targets = self.read_targets(key)
+            if authoritative:
+                targets = [server for server in targets if not server.lossy]
+            if len(targets) > 0:
+                groups.setdefault(self.choose_server(targets), []).append(key)
+        ds = [self.request_values(server, serverkeys, deadline, retry=True) for server, serverkeys in groups.items()]
+        results = yield DeferredList(ds, consumeErrors=True)
+        found = {}
+        for success, result in results:
+            if success:
+                for key, value in utils.resultstring2list(result):
+                    if value is not None:
+                        found[key] = value
+            elif result.check(CancelledError, TimeoutError):
+                raise TimeoutError()
+        returnValue(utils.resultlist2string([(key, found.get(key, None)) for key in keys]))
+
+    def mset(self, pairs, source=None):
+        """sets the values for multiple keys, splitting the batch per server."""
+        values = dict(pairs)
+        if self.cache is not None:
+            for key, value in values.items():
+                self.cache.set(key, value)
+        if len(self.tracked) > 0:
+            self.invalidate_tracked(values.keys(), source)
+        if source is not None and source.tracking:
+            for key in values:
+                self.track(source, key)
+        seq = self.log_write(False, values.items())
+        for server, keys in self.group_writes(values.keys()).items():
+            server.send_mset([(key, values[key]) for key in keys], seq)
+
+    def mdelete(self, keys, source=None):
+        """deletes the values for multiple keys, splitting the batch per server."""
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key)
+        if len(self.tracked) > 0:
+            self.invalidate_tracked(keys, source)
+        seq = self.log_write(True, [(key, None) for key in keys])
+        for server, serverkeys in self.group_writes(keys).items():
+            server.send_mdel(serverkeys, seq)
+
+    def track(self, proto, key):
+        """remembers that the client proto may cache the value of key."""
+        if key in proto.tracked:
+            return
+        if len(proto.tracked) >= data.MAX_TRACKED_KEYS:
+            # too many keys; let the client drop its whole cache instead
+            self.untrack(proto)
+            proto.send_flush()
+        proto.tracked.add(key)
+        self.tracked.setdefault(key, set()).add(proto)
+
+    def untrack(self, proto):
+        """forgets all keys tracked for the client proto."""
+        for key in proto.tracked:
+            protos = self.tracked.get(key, None)
+            if protos is not None:
+                protos.discard(proto)
+                if len(protos) == 0:
+                    del self.tracked[key]
+        proto.tracked = set()
+
+    def invalidate_tracked(self, keys, source=None):
+        """tells all clients which may have cached one of keys to drop it. source already knows the new value."""
+        invalid = {}  # proto -> keys
+        for key in keys:
+            protos = self.tracked.pop(key, None)
+            if protos is None:
+                continue
+            for proto in protos:
+                if proto is source:
+                    self.tracked[key] = set([source])
+                else:
+                    proto.tracked.discard(key)
+                    invalid.setdefault(proto, []).append(key)
+        for proto, protokeys in invalid.items():
+            proto.send_invalidate(protokeys)
+
+    def getkeys(self, proto=None, deadline=None):
+        """
+returns a list of keys.
+If proto is a syncing database in sharded mode, only the keys it owns are returned.
+"""
         if len(self.servers) == 0:
             # no servers, but client expects sync
             keys = []  # because there are no databases connected.
             answer = utils.keylist2string(keys)
-            return answer
-        server = random.choice(self.servers)
-        rid = struct.unpack(data.MESSAGE_ID_FORMAT, request_id)[0]
-        d = Deferred()
-        self.calls[rid] = d
-        server.send_getkeys(request_id)
-        return d
+            return succeed(answer)
+        if self.sharded:
+            return self.getkeys_sharded(proto, deadline)
+        return self.request_keys(self.choose_server(self.authoritative(self.servers)), deadline, retry=True)
 
-    def get_range(self):
-        """returns a rid range for a client."""
-        i = 0
+    def retry_getkeys(self, deadline=None):
+        """requests the keys, whose server was lost, from another server. Returns a deferred for the keystring."""
+        if len(self.servers) == 0:
+            return succeed("")
+        if self.expired(deadline):
+            return fail(TimeoutError())
+        return self.request_keys(self.choose_server(self.authoritative(self.servers)), deadline, retry=True)
+
+    @inlineCallbacks
+    def getkeys_sharded(self, proto=None, deadline=None):
+        """asks all shards for their keys and merges the answers."""
+        ds = [self.request_keys(server, deadline) for server in self.servers]
+        results = yield DeferredList(ds, consumeErrors=True)
+        keys = set()
+        for success, result in results:
+            if success:
+                keys.update(utils.keystring2list(result))
+            elif result.check(CancelledError, TimeoutError):
+                raise TimeoutError()
+        if proto is not None and proto in self.syncing:
+            keys = [key for key in keys if proto in self.ring.get_nodes(key, self.replication)]
+        returnValue(utils.keylist2string(keys))
+
+    @inlineCallbacks
+    def scan(self, cursor, count, proto=None, deadline=None):
+        """
+returns a tuple (next cursor, keys) for the next page of a key scan.
+A cursor of 0 starts a new scan; a next cursor of 0 means the scan is finished.
+Raises KeyError if the cursor is unknown or the server holding it was lost.
+"""
+        if cursor == 0:
+            if len(self.servers) == 0:
+                returnValue((0, []))
+            if self.sharded:
+                servers = list(self.servers)
+            else:
+                servers = [self.choose_server(self.authoritative(self.servers))]
+            scan = KeyScan(servers, proto)
+            cursor = self.next_scan
+            self.next_scan += 1
+        else:
+            scan = self.scans.pop(cursor, None)
+            if scan is None:
+                raise KeyError(cursor)
+        keys = []
+        while len(keys) == 0 and len(scan.servers) > 0:
+            server = scan.servers[0]
+            if server not in self.servers:
+                raise KeyError(cursor)
+            scan.cursor, page = yield self.request_scan(server, scan.cursor, count, deadline)
+            if self.sharded:
+                # every key is reported by its first owner only
+                for key in page:
+                    targets = self.authoritative(self.read_targets(key))
+                    if len(targets) == 0 or targets[0] is not server:
+                        continue
+                    if proto in self.syncing and proto not in self.ring.get_nodes(key, self.replication):
+                        continue
+                    keys.append(key)
+            else:
+                keys = page
+            if scan.cursor == 0:
+                scan.servers.pop(0)
+        if len(scan.servers) == 0:
+            returnValue((0, keys))
+        self.scans[cursor] = scan
+        if len(self.scans) > data.MAX_OPEN_SCANS:
+            self.scans.popitem(last=False)
+        returnValue((cursor, keys))
+
+    def keyrange(self, start, end=None, limit=0, reverse=False, deadline=None):
+        """
+returns a deferred for a sorted list of up to limit keys in [start, end), the largest first if reverse is True.
+end None means no upper bound and a limit of 0 means no limit.
+"""
+        if len(self.servers) == 0:
+            return succeed([])
+        if self.sharded:
+            return self.keyrange_sharded(start, end, limit, reverse, deadline)
+        server = self.choose_server(self.authoritative(self.servers))
+        d = self.request_keyrange(server, start, end, limit, reverse, deadline, retry=True)
+        return d.addCallback(utils.keystring2list)
+
+    def retry_keyrange(self, start, end, limit, reverse, deadline=None):
+        """requests a key range, whose server was lost, from another server. Returns a deferred for the keystring."""
+        if len(self.servers) == 0:
+            return succeed("")
+        if self.expired(deadline):
+            return fail(TimeoutError())
+        server = self.choose_server(self.authoritative(self.servers))
+        return self.request_keyrange(server, start, end, limit, reverse, deadline, retry=True)
+
+    @inlineCallbacks
+    def keyrange_sharded(self, start, end, limit, reverse, deadline=None):
+        """
+asks all shards for their keys in the range and merges the sorted answers; every key is reported by its first owner only.
+The merged keys are only complete up to the last key of a shard which sent limit keys, so the shards are asked
+again after it until limit keys were found.
+"""
+        keys = []
+        servers = list(self.servers)
         while True:
-            start = data.RANGE * i
-            end = start + data.RANGE
-            found = True
-            for client in self.all:
-                cs = client.range_start
-                if cs == start:
-                    found = False
+            ds = [self.request_keyrange(server, start, end, limit, reverse, deadline) for server in servers]
+            results = yield DeferredList(ds, consumeErrors=True)
+            pages = []
+            bound = None  # the merged keys are complete up to this key
+            for server, (success, result) in zip(servers, results):
+                if not success:
+                    if result.check(CancelledError, TimeoutError):
+                        raise TimeoutError()
+                    result.raiseException()
+                page = utils.keystring2list(result)
+                if limit > 0 and len(page) == limit:
+                    last = page[-1]
+                    if bound is None or (last > bound if reverse else last < bound):
+                        bound = last
+                owned = []
+                for key in page:
+                    targets = self.authoritative(self.read_targets(key))
+                    if len(targets) > 0 and targets[0] is server:
+                        owned.append(key)
+                pages.append(owned)
+            merged = utils.merge_keys(pages, reverse)
+            if bound is not None:
+                merged = [key for key in merged if (key >= bound if reverse else key <= bound)]
+            keys += merged
+            if bound is None or len(keys) >= limit:
+                break
+            # continue after the last complete key
+            if reverse:
+                end = bound
+            else:
+                start = bound + "\x00"
+        if limit > 0:
+            del keys[limit:]
+        returnValue(keys)
+
+    def drop_scans(self, proto):
+        """forgets all open key scans of proto."""
+        for cursor, scan in self.scans.items():
+            if scan.owner is proto:
+                del self.scans[cursor]
+
+    def snapshot(self, proto, request_id):
+        """
+streams a snapshot of the data to the syncing database proto.
+In sharded mode, every server is a donor and only the keys owned by proto are forwarded.
+"""
+        donors = list(self.servers)
+        if not self.sharded and len(donors) > 0:
+            donors = [self.choose_server(self.authoritative(donors))]
+        transfer = SnapshotTransfer(proto, request_id, self.placement_ring)
+        if len(donors) == 0:
+            proto.sendString(data.ID_SNAPSHOTEND + request_id)
+            return
+        log.msg("Sending a snapshot from {n} databases to {p}...".format(n=len(donors), p=proto.node_id))
+        for server in donors:
+            rid = self.next_snapshot
+            self.next_snapshot += 1
+            rids = struct.pack(data.MESSAGE_ID_FORMAT, rid)
+            transfer.donors[rid] = server
+            self.snapshots[rid] = transfer
+            server.sendString(data.ID_SNAPSHOT + rids)
+        proto.queue.snapshot = transfer
+        if proto.queue.blocked:
+            transfer.pauseProducing()
+
+    def got_snapshot(self, proto, msg):
+        """a donor sent a part of a snapshot. msg is the whole message."""
+        actionbyte = msg[0]
+        rid = data.MESSAGE_ID_STRUCT.unpack_from(msg, 1)[0]
+        transfer = self.snapshots.get(rid, None)
+        if transfer is None or transfer.donors.get(rid, None) is not proto:
+            # transfer already aborted
+            return
+        if self.sharded and transfer.placement_ring is not self.placement_ring:
+            # owners changed during the transfer; the donors may have skipped keys
+            log.msg("Placement changed during snapshot transfer, aborting it...")
+            self.abort_snapshot(transfer)
+            return
+        target = transfer.target
+        if actionbyte == data.ID_SNAPSHOTCHUNK:
+            convert = proto.compressed != target.compressed
+            if not (self.sharded or convert):
+                utils.send_parts(target, [data.ID_SNAPSHOTCHUNK, transfer.rid, msg[1 + data.MESSAGE_ID_SIZE:]])
+                return
+            pairs = []
+            for key, value in utils.pairstring2list(msg, 1 + data.MESSAGE_ID_SIZE):
+                if self.sharded:
+                    # every key is sent by its first owner only
+                    targets = self.authoritative(self.read_targets(key))
+                    if len(targets) == 0 or targets[0] is not proto:
+                        continue
+                    if target not in self.ring.get_nodes(key, self.replication):
+                        continue
+                if convert:
+                    value = target.decode(proto.encode(value))
+                pairs.append((key, value))
+            if len(pairs) > 0:
+                utils.send_parts(target, [data.ID_SNAPSHOTCHUNK, transfer.rid, utils.pairlist2string(pairs)])
+        elif actionbyte == data.ID_SNAPSHOTEND:
+            if transfer.paused:
+                proto.transport.resumeProducing()
+            del transfer.donors[rid]
+            del self.snapshots[rid]
+            if len(transfer.donors) == 0:
+                log.msg("Snapshot transfer to {p} finished.".format(p=target.node_id))
+                target.sendString(data.ID_SNAPSHOTEND + transfer.rid)
+                self._unregister_snapshot(transfer)
+
+    def abort_snapshot(self, transfer, notify=True):
+        """stops a snapshot transfer. If notify is True, the target is told to request a new snapshot."""
+        self._unregister_snapshot(transfer)
+        for rid, server in transfer.donors.items():
+            del self.snapshots[rid]
+            if server in self.servers:
+                server.sendString(data.ID_SNAPSHOTEND + struct.pack(data.MESSAGE_ID_FORMAT, rid))
+        transfer.donors = {}
+        if notify:
+            transfer.target.sendString(data.ID_NOTFOUND + transfer.rid)
+
+    def _unregister_snapshot(self, transfer):
+        """stops pausing the donors of transfer when the send buffer of its target is full."""
+        transfer.resumeProducing()
+        if transfer.target.queue.snapshot is transfer:
+            transfer.target.queue.snapshot = None
+
+    def request_keys(self, server, deadline=None, retry=False):
+        """
+returns a deferred which will be called with the keystring of server.
+If retry is True, the keys are requested from another server if server is lost.
+"""
+        failover = None
+        if retry:
+            failover = functools.partial(self.retry_getkeys, deadline)
+        rids, call = self.register_call(server, retry=failover)
+        server.send_getkeys(rids, deadline)
+        return call.d
+
+    def request_value(self, server, key, deadline=None, retry=False):
+        """
+returns a deferred which will be called with the value for key stored on server.
+If retry is True, the value is requested from another server if server is lost.
+"""
+        if key in server.queue.writes:
+            return server.queue.lookup(key)
+        failover = None
+        if retry:
+            failover = functools.partial(self.retry_get, key, deadline)
+        rids, call = self.register_call(server, retry=failover)
+        server.send_get(rids, key, deadline)
+        if server.lossy:
+            call.d.addErrback(self._authoritative_get, key, deadline)
+        return call.d
+
+    def request_scan(self, server, cursor, count, deadline=None):
+        """returns a deferred which will be called with a tuple (next cursor, keys) of a page of keys stored on server."""
+        rids, call = self.register_call(server)
+        server.send_scan(rids, cursor, count, deadline)
+        return call.d.addCallback(self._parse_scan)
+
+    def _parse_scan(self, page):
+        """parses the answer to a scan request."""
+        cursor = data.CURSOR_STRUCT.unpack_from(page)[0]
+        return (cursor, utils.keystring2list(page, data.CURSOR_SIZE))
+
+    def request_keyrange(self, server, start, end=None, limit=0, reverse=False, deadline=None, retry=False):
+        """
+returns a deferred which will be called with the keystring of the sorted keys of server in [start, end).
+The keys of databases without data.CAP_KEYRANGE are requested as a whole and sorted by the router.
+If retry is True, the keys are requested from another server if server is lost.
+"""
+        if not server.keyranges:
+            d = self.request_keys(server, deadline, retry)
+            return d.addCallback(self._filter_keyrange, start, end, limit, reverse)
+        failover = None
+        if retry:
+            failover = functools.partial(self.retry_keyrange, start, end, limit, reverse, deadline)
+        rids, call = self.register_call(server, retry=failover)
+        server.send_keyrange(rids, start, end, limit, reverse, deadline)
+        return call.d
+
+    def _filter_keyrange(self, keystring, start, end, limit, reverse):
+        """returns the keystring of the sorted keys of keystring in [start, end)."""
+        return utils.keylist2string(utils.filter_keyrange(utils.keystring2list(keystring), start, end, limit, reverse))
+
+    def request_values(self, server, keys, deadline=None, retry=False):
+        """
+returns a deferred which will be called with the answer of server to a batch get of keys.
+If retry is True, the values are requested from the other servers if server is lost.
+"""
+        queued = [key for key in keys if key in server.queue.writes]
+        if len(queued) > 0:
+            # the server did not receive the latest writes to these keys yet
+            results = utils.resultlist2string([(key, server.queue.writes[key][1]) for key in queued])
+            keys = [key for key in keys if key not in server.queue.writes]
+            if len(keys) == 0:
+                return succeed(results)
+            return self.request_values(server, keys, deadline, retry).addCallback(lambda answer: answer + results)
+        failover = None
+        if retry:
+            failover = functools.partial(self.fetch_values, keys, deadline)
+        rids, call = self.register_call(server, retry=failover)
+        server.send_mget(rids, keys, deadline)
+        if server.lossy:
+            call.d.addCallback(self._authoritative_values, deadline)
+        return call.d
+
+    def _authoritative_values(self, results, deadline=None):
+        """reads the keys not found on a lossy database from the databases which do not evict keys."""
+        pairs = utils.resultstring2list(results)
+        missing = [key for key, value in pairs if value is None]
+        if len(missing) == 0:
+            return results
+        found = utils.resultlist2string([(key, value) for key, value in pairs if value is not None])
+        d = self.fetch_values(missing, deadline, authoritative=True)
+        return d.addCallback(lambda answer: found + answer)
+
+    def request_stats(self, server):
+        """returns a deferred which will be called with the dict of statistics reported by server."""
+        rids, call = self.register_call(server)
+        server.send_request(data.ID_STATS + rids)
+        d = call.d
+        d.addTimeout(data.STATS_TIMEOUT, self.reactor)
+        d.addCallback(lambda value: json.loads(utils.decode_value(value)))
+        return d
+
+    def add_server(self, proto):
+        """adds proto to the serving databases."""
+        if proto in self.syncing:
+            self.syncing.remove(proto)
+        if proto not in self.servers:
+            self.servers.append(proto)
+        self.ring.add(proto)
+        self.schedule_rebalance()
+
+    def add_syncing(self, proto):
+        """adds proto to the syncing databases."""
+        if proto in self.servers:
+            self.servers.remove(proto)
+        if proto not in self.syncing:
+            self.syncing.append(proto)
+        self.ring.add(proto)
+        self.schedule_rebalance()
+
+    def remove_node(self, proto):
+        """removes proto from the serving and syncing databases."""
+        changed = proto in self.servers
+        if proto in self.servers:
+            self.servers.remove(proto)
+        if proto in self.syncing:
+            self.syncing.remove(proto)
+        self.ring.remove(proto)
+        if proto.queue is not None:
+            proto.queue.clear()
+        for rid, call in enumerate(proto.slots):
+            if call is not None:
+                proto.pop_call(rid)
+                if call.timer is not None and call.timer.active():
+                    call.timer.cancel()
+                if call.d.called:
+                    continue
+                if call.retry is not None:
+                    # fail over to the other servers
+                    call.retry().chainDeferred(call.d)
+                else:
+                    call.d.errback(Failure(KeyError()))
+        for pending in self.pending_acks[:]:
+            if proto in pending.servers:
+                pending.servers.remove(proto)
+                if len(pending.servers) < pending.needed:
+                    self.pending_acks.remove(pending)
+                    self.failed_writes += 1
+                    pending.d.callback(False)
+        for transfer in set(self.snapshots.values()):
+            if transfer.target is proto:
+                self.abort_snapshot(transfer, notify=False)
+            elif proto in transfer.donors.values():
+                log.msg("Lost a donor during snapshot transfer, aborting it...")
+                self.abort_snapshot(transfer)
+        if changed:
+            self.schedule_rebalance()
+
+    def schedule_rebalance(self):
+        """schedules a rebalance of the data if the set of serving databases changed."""
+        if (not self.sharded) or self.rebalance_scheduled:
+            return
+        self.rebalance_scheduled = True
+        # wait a bit, so that joins/leaves happening at the same time (and databases switching to
+        # syncing right after the handshake) only trigger a single rebalance.
+        self.reactor.callLater(data.REBALANCE_DELAY, self.start_rebalance)
+
+    def start_rebalance(self):
+        """starts a rebalance unless one is running already."""
+        self.rebalance_scheduled = False
+        if self.rebalancing:
+            # the running rebalance will check for changes when it is finished.
+            return
+        new = list(self.servers)
+        if set(self.placement) == set(new):
+            return
+        self.rebalancing = True
+        self.rebalance_dirty = set()
+        d = self.rebalance(self.placement, new)
+        d.addErrback(log.err)
+        d.addBoth(self._rebalance_finished)
+
+    def _rebalance_finished(self, result):
+        """called when a rebalance finished."""
+        self.rebalancing = False
+        self.rebalance_ring = None
+        self.rebalance_dirty = set()
+        if set(self.placement) != set(self.servers):
+            self.schedule_rebalance()
+
+    @inlineCallbacks
+    def rebalance(self, old, new):
+        """
+copies the keys whose owners changed between the server lists old and new to their new owners.
+Only the first alive old owner of a key copies it, preferring the owners which do not evict keys.
+Once all keys are copied, new becomes the placement and the keys are removed from the databases which do not own them anymore.
+Databases which do not evict keys only drop a key once an owner which does not evict keys either has it or received
+a write to it from a client.
+"""
+        log.msg("Rebalancing data from {o} to {n} databases...".format(o=len(old), n=len(new)))
+        old_ring = self.placement_ring
+        new_ring = ring.HashRing(self.ring.vnodes, new)
+        self.rebalance_ring = new_ring
+        moved = 0
+        for server in new:
+            cursor = 0
+            while server in self.servers:
+                try:
+                    cursor, keys = yield self.request_scan(server, cursor, data.DEFAULT_SCAN_COUNT)
+                except KeyError:
+                    # server lost
+                    break
+                tocopy = {}
+                for key in keys:
+                    if key in self.rebalance_dirty:
+                        # the new owners already received a newer value
+                        continue
+                    old_owners = old_ring.get_nodes(key, self.replication)
+                    alive = self.authoritative([s for s in old_owners if s in self.servers])
+                    if len(old_owners) > 0 and (len(alive) == 0 or alive[0] is not server):
+                        continue
+                    targets = [s for s in new_ring.get_nodes(key, self.replication) if s not in old_owners]
+                    if len(targets) > 0:
+                        tocopy[key] = targets
+                if len(tocopy) > 0:
+                    try:
+                        resultstring = yield self.request_values(server, tocopy.keys())
+                    except KeyError:
+                        break
+                    for key, value in utils.resultstring2list(resultstring):
+                        if value is None or key in self.rebalance_dirty:
+                            continue
+                        for target in tocopy[key]:
+                            if target in self.servers or target in self.syncing:
+                                target.send_set(key, value)
+                        moved += 1
+                if cursor == 0:
+                    break
+        if set(new) != set(self.servers):
+            # membership changed while copying; try again with the new members.
+            log.msg("Databases changed during rebalance, restarting...")
+            return
+        self.placement = new
+        self.placement_ring = new_ring
+        log.msg("Rebalance finished, moved {m} keys. Removing old copies...".format(m=moved))
+        for server in new:
+            cursor = 0
+            while server in self.servers:
+                try:
+                    cursor, keys = yield self.request_scan(server, cursor, data.DEFAULT_SCAN_COUNT)
+                except KeyError:
+                    break
+                remove = [key for key in keys if server not in self.placement_ring.get_nodes(key, self.replication)]
+                if len(remove) > 0 and not server.lossy:
+                    # this may be the last complete copy of the keys
+                    confirmed = yield self.confirm_copies([key for key in remove if key not in self.rebalance_dirty])
+                    kept = len([key for key in remove if key not in self.rebalance_dirty and key not in confirmed])
+                    if kept > 0:
+                        log.msg("Keeping {n} keys on {p} which were not found on their new owners.".format(n=kept, p=server.node_id))
+                    remove = [key for key in remove if key in self.rebalance_dirty or key in confirmed]
+                if len(remove) > 0:
+                    server.send_mdel(remove)
+                if cursor == 0:
                     break
-            if found:
-                return (start, end)
-            i += 1
+
+    @inlineCallbacks
+    def confirm_copies(self, keys):
+        """returns a set of the keys which are stored on their first alive owner which does not evict keys."""
+        groups = {}
+        for key in keys:
+            owners = self.placement_ring.get_nodes(key, self.replication)
+            owners = [server for server in owners if server in self.servers and not server.lossy]
+            if len(owners) > 0:
+                groups.setdefault(owners[0], []).append(key)
+        confirmed = set()
+        for server, serverkeys in groups.items():
+            try:
+                resultstring = yield self.request_values(server, serverkeys)
+            except KeyError:
+                # server lost
+                continue
+            confirmed.update([key for key, value in utils.resultstring2list(resultstring) if value is not None])
+        returnValue(confirmed)
+
+    def queue_changed(self, queue):
+        """stops reading from the clients while the write queue of a database is above the high water mark."""
+        if queue.bytes > self.queue_high:
+            if queue not in self.congested:
+                self.congested.add(queue)
+                if len(self.congested) == 1:
+                    log.msg("Write queue of {p} is full, pausing clients...".format(p=queue.proto.node_id))
+                    self.pause_clients(True)
+        elif queue.bytes <= self.queue_low and queue in self.congested:
+            self.congested.remove(queue)
+            if len(self.congested) == 0:
+                log.msg("Write queues drained, resuming clients.")
+                self.pause_clients(False)
+
+    def pause_clients(self, paused):
+        """pauses or resumes reading from all clients."""
+        for proto in self.all:
+            if proto.mode == data.MODE_CLIENT and not proto.can_switch:
+                if paused:
+                    proto.transport.pauseProducing()
+                else:
+                    proto.transport.resumeProducing()
+
+    def queue_stats(self):
+        """returns a dict mapping the names of the databases to the stats of their write queues."""
+        return dict([(proto.node_id, proto.queue.stats()) for proto in self.servers + self.syncing])
+
+    def update_rates(self):
+        """measures the request rates since the last call."""
+        now = self.reactor.seconds()
+        last, counts = self.rate_sample
+        if last is not None and now > last:
+            self.rates = dict([
+                (data.OPCODE_NAMES.get(op, repr(op)), (n - counts.get(op, 0)) / (now - last)) for op, n in self.requests.items()
+                ])
+        self.rate_sample = (now, dict(self.requests))
+
+    def stats(self):
+        """returns a dict with the statistics of the router and its connections, which can be serialized to JSON."""
+        servers = {}
+        for proto in self.servers + self.syncing:
+            servers[proto.node_id] = {
+                "syncing": proto in self.syncing,
+                "outstanding": proto.outstanding,
+                "latency": round((proto.latency or 0.0) * 1000, 3),
+                "latencies": proto.latencies.summary(),
+                "queue": proto.queue.stats(),
+                "compressed": proto.compressed,
+                "lossy": proto.lossy,
+                "keyranges": proto.keyranges,
+                }
+        clients = len([proto for proto in self.all if proto.mode == data.MODE_CLIENT and not proto.can_switch])
+        stats = {
+            "router_id": self.router_id,
+            "uptime": self.reactor.seconds() - self.started,
+            "seq": self.seq,
+            "requests": dict([(data.OPCODE_NAMES.get(op, repr(op)), n) for op, n in self.requests.items()]),
+            "rates": dict(self.rates),
+            "pending_calls": sum([proto.outstanding for proto in self.servers + self.syncing]),
+            "pending_acks": len(self.pending_acks),
+            "nodes": {"serving": len(self.servers), "syncing": len(self.syncing), "clients": clients},
+            "servers": servers,
+            "gets": self.gets,
+            "hedges": self.hedges,
+            "acked_writes": self.acked_writes,
+            "failed_writes": self.failed_writes,
+            "ack_latency": round((self.ack_latency or 0.0) * 1000, 3),
+            "write_log": {"writes": len(self.write_log), "bytes": self.write_log_bytes},
+            "rebalancing": self.rebalancing,
+            "snapshots": len(set(self.snapshots.values())),
+            "cache": None,
+            }
+        if self.cache is not None:
+            stats["cache"] = {
+                "entries": len(self.cache),
+                "bytes": self.cache.size,
+                "hit_ratio": self.cache.hit_ratio(),
+                "evictions": self.cache.evictions,
+                }
+        if self.tracer is not None:
+            stats.update(self.tracer.stats())
+        return stats
+
+    @inlineCallbacks
+    def collect_stats(self):
+        """returns a deferred for stats() including the statistics reported by every database."""
+        stats = self.stats()
+        nodes = self.servers + self.syncing
+        results = yield DeferredList([self.request_stats(proto) for proto in nodes], consumeErrors=True)
+        databases = {}
+        for proto, (success, result) in zip(nodes, results):
+            if success:
+                databases[proto.node_id] = result
+            else:
+                databases[proto.node_id] = {"error": result.getErrorMessage() or result.type.__name__}
+        stats["databases"] = databases
+        returnValue(stats)
+
+    def get_range(self):
+        """returns a free rid range for a connection. The ranges of the routers are interleaved by their router_id."""
+        if len(self.free_ranges) > 0:
+            i = self.free_ranges.pop()
+        else:
+            i = self.next_range
+            self.next_range += 1
+        start = data.RANGE * (i * data.MAX_ROUTERS + self.router_id)
+        end = start + data.RANGE
+        if end > 2**(8 * data.MESSAGE_ID_SIZE):
+            raise RuntimeError("No ranges left.")
+        return (start, end)
+
+    def release_range(self, start):
+        """marks the rid range starting at start as free."""
+        self.free_ranges.append((start // data.RANGE - self.router_id) // data.MAX_ROUTERS)
+
+
+class Call(object):
+    """A request sent to a server."""
+    __slots__ = ("d", "server", "started", "sample", "timer", "retry", "trace")
+
+    def __init__(self, d, server, started, sample=False, retry=None):
+        self.d = d
+        self.server = server
+        self.started = started
+        self.sample = sample
+        self.timer = None  # delayed call for hedging
+        self.retry = retry  # returns a deferred for the answer of another server if server is lost
+        self.trace = None  # profiling.Trace of the request of the client
+
+
+class PendingAck(object):
+    """A write waiting for the acknowledgements of the databases."""
+    __slots__ = ("seq", "needed", "servers", "started", "d")
+
+    def __init__(self, seq, needed, servers, started):
+        self.seq = seq
+        self.needed = needed
+        self.servers = set(servers)  # servers which did not acknowledge the write yet
+        self.started = started
+        self.d = Deferred()
+
+
+class KeyScan(object):
+    """State of a key scan of a client."""
+    def __init__(self, servers, owner):
+        self.servers = servers  # servers left to scan
+        self.owner = owner
+        self.cursor = 0  # cursor of the current server
+
+
+@implementer(IPushProducer)
+class SnapshotTransfer(object):
+    """
+A snapshot sent from the donors to the syncing database target.
+Paused by the WriteQueue of the target, so that the donors are paused if the target can not keep up.
+"""
+    def __init__(self, target, rid, placement_ring):
+        self.target = target
+        self.rid = rid  # rid used by the target
+        self.placement_ring = placement_ring
+        self.donors = {}  # rid -> donor
+        self.paused = False
+
+    def pauseProducing(self):
+        """stops reading from the donors."""
+        self.paused = True
+        for server in self.donors.values():
+            server.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """continues reading from the donors."""
+        if not self.paused:
+            return
+        self.paused = False
+        for server in self.donors.values():
+            server.transport.resumeProducing()
+
+    def stopProducing(self):
+        """called when the target was lost."""
+        self.resumeProducing()
+
+
+@implementer(IPushProducer)
+class WriteQueue(object):
+    """
+The writes to a database which can not be sent yet, because the send buffer of its connection is full.
+Registered as the producer of the connection, so that the transport tells it when to stop and continue sending.
+Queued writes to the same key are coalesced, keeping only the latest value. A queued key moves to the end of
+the queue, so that the writes are still sent in the order of their sequence numbers.
+"""
+    def __init__(self, proto):
+        self.proto = proto
+        self.writes = collections.OrderedDict()  # key -> (seq, value or None for a delete)
+        self.bytes = 0
+        self.max_bytes = 0
+        self.coalesced = 0
+        self.blocked = False
+        self.sync = False  # True if the database should sync once the queued writes are sent
+        self.snapshot = None  # SnapshotTransfer to the database, paused while the buffer is full
+
+    @property
+    def active(self):
+        """True if writes have to be queued to keep them in order."""
+        return self.blocked or len(self.writes) > 0
+
+    def add(self, key, value, seq):
+        """queues a write of key. value is None for a delete."""
+        old = self.writes.pop(key, None)
+        if old is not None:
+            self.coalesced += 1
+            self.bytes -= len(key) + len(old[1] or "")
+        self.writes[key] = (seq, value)
+        self.bytes += len(key) + len(value or "")
+        self.max_bytes = max(self.max_bytes, self.bytes)
+        self.proto.factory.queue_changed(self)
+
+    def lookup(self, key):
+        """returns a deferred for the queued value of key, which the database does not know yet."""
+        value = self.writes[key][1]
+        if value is None:
+            return fail(KeyError())
+        return succeed(value)
+
+    def flush(self):
+        """sends the queued writes until the send buffer is full again."""
+        while len(self.writes) > 0 and not self.blocked:
+            key, (seq, value) = self.writes.popitem(last=False)
+            self.bytes -= len(key) + len(value or "")
+            if value is None:
+                self.proto.send_write([data.ID_DEL, key], seq)
+            else:
+                self.proto.send_write([data.ID_SET, data.MESSAGE_KEY_LENGTH_STRUCT.pack(len(key)), key, self.proto.decode(value)], seq)
+        if len(self.writes) == 0 and self.sync:
+            self.sync = False
+            self.proto.sendString(data.ID_SYNC)
+        self.proto.factory.queue_changed(self)
+
+    def clear(self):
+        """drops the queued writes; the database catches up once it reconnects."""
+        self.writes.clear()
+        self.bytes = 0
+        self.sync = False
+        self.proto.factory.queue_changed(self)
+
+    def stats(self):
+        """returns a dict describing the queue."""
+        return {
+            "writes": len(self.writes),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "coalesced": self.coalesced,
+            "blocked": self.blocked,
+            }
+
+    def pauseProducing(self):
+        """called when the send buffer is full."""
+        self.blocked = True
+        if self.snapshot is not None:
+            self.snapshot.pauseProducing()
+
+    def resumeProducing(self):
+        """called when the send buffer was drained."""
+        self.blocked = False
+        self.flush()
+        if self.snapshot is not None and not self.blocked:
+            self.snapshot.resumeProducing()
+
+    def stopProducing(self):
+        """called when the connection was lost."""
+        self.blocked = False
+        if self.snapshot is not None:
+            self.snapshot.resumeProducing()
 
 
 class RouterProtocol(IntNStringReceiver):
@@ -124,21 +1399,38 @@ class RouterProtocol(IntNStringReceiver):
         self.factory = factory
         self.structFormat = data.MESSAGE_LENGTH_FORMAT
         self.prefixLength = data.MESSAGE_LENGTH_SIZE
+        self.MAX_LENGTH = data.MAX_MESSAGE_LENGTH
         self.mode = data.MODE_CONNECTING
         self.can_switch = False
         self.range_start = None
         self.range_end = None
+        self.node_id = None
+        self.tracking = False  # True if the client has a near cache
+        self.tracked = set()
+        self.outstanding = 0  # requests sent to the server, but not yet answered
+        self.slots = []  # rid -> Call of a request sent to the server or None if the rid is free
+        self.free_slots = []
+        self.pending = {}  # rid string -> deferred of a read of the client, which may be cancelled
+        self.queue = None  # WriteQueue of a database connection
+        self.compressed = False  # True if the values sent over this connection carry a flag byte
+        self.lossy = False  # True if the database evicts keys
+        self.keyranges = False  # True if the database answers key range requests
+        self.latency = None  # EWMA of the response time of the server
+        self.latencies = utils.Histogram()  # response times of the server
 
     def connectionMade(self):
         """called when the connection was established."""
         if hasattr(IntNStringReceiver, "connectionMade"):
             IntNStringReceiver.connectionMade(self)
         self.mode = data.MODE_VERSION
+        self.node_id = str(self.transport.getPeer())
         log.msg("Starting Handshake...")
 
-    @inlineCallbacks
     def stringReceived(self, msg):
-        """called when a string was received."""
+        """
+called when a string was received.
+Requests are dispatched by their first byte; only the handlers which wait for an answer use deferreds.
+"""
         if self.mode == data.MODE_VERSION:
             # check version
             if len(msg) != data.VERSION_LENGTH:
@@ -164,33 +1456,31 @@ class RouterProtocol(IntNStringReceiver):
                     self.mode = data.MODE_UNKNOWN
 
         elif self.mode == data.MODE_PASSWORD:
-            # check password
-            if msg != self.factory.pswd:
-                # invalid password
-                yield utils.dsleep(self.factory.reactor, data.INVALID_PASSWORD_SLEEP_INTERVAL)  # sleep to prevent high speed attacks.
-                log.msg("Client sent invalid password. Losing connection...")
-                self.sendString(data.STATE_ERROR)
-                self.transport.loseConnection()
-                self.mode = data.MODE_ERROR
-            else:
-                # password correct
-                log.msg("Password OK, asking for mode...")
-                self.sendString(data.STATE_OK)
-                self.mode = data.MODE_UNKNOWN
+            self.check_password(msg)
 
         elif self.mode == data.MODE_UNKNOWN:
-            # handle client mode
-            if msg == data.MODE_SERVER:
+            # handle client mode; newer peers append the capabilities they support
+            mode = msg[:1]
+            caps = None
+            if len(msg) > 1:
+                caps = data.CAPS_STRUCT.unpack_from(msg, 1)[0] & data.SUPPORTED_CAPS
+                self.compressed = bool(caps & data.CAP_COMPRESSION)
+                self.lossy = bool(caps & data.CAP_LOSSY)
+                self.keyranges = bool(caps & data.CAP_KEYRANGE)
+            if mode == data.MODE_SERVER:
                 # client host db
                 log.msg("Client identified as a database. Sending range...")
                 self.mode = data.MODE_SERVER
-                self.factory.servers.append(self)
                 self.can_switch = True
-            elif msg == data.MODE_CLIENT:
+                self.queue = WriteQueue(self)
+                self.transport.registerProducer(self.queue, True)
+            elif mode == data.MODE_CLIENT:
                 # client wants to access database
                 log.msg("Client identified as a client. Sending range...")
                 self.mode = data.MODE_CLIENT
                 self.can_switch = False
+                if len(self.factory.congested) > 0:
+                    self.transport.pauseProducing()
             else:
                 # protocol violation
                 log.err("Client sent invalid mode. Aborting connection...")
@@ -199,96 +1489,457 @@ class RouterProtocol(IntNStringReceiver):
             # now set rid range start and send int
             self.range_start, self.range_end = self.factory.get_range()
             rangestring = struct.pack(data.RANGE_FORMAT, self.range_start, self.range_end)
+            if caps is not None:
+                # the capabilities used on this connection
+                rangestring += data.CAPS_STRUCT.pack(caps)
             self.sendString(rangestring)
             self.factory.all.append(self)
 
         elif self.mode == data.MODE_SERVER:
             # message from the server
-            actionbyte = msg[0]
-            if actionbyte in (data.ID_ANSWER, data.ID_NOTFOUND, data.ID_ALLKEYS):
-                self.factory.got_answer(self, actionbyte, msg[1:])
-            elif actionbyte == data.ID_SWITCH:
-                self.switch_mode()
+            handler = self.server_handlers.get(msg[0], None)
+            if handler is not None:
+                if self.factory.tracer is None:
+                    handler(self, msg)
+                else:
+                    self.factory.tracer.dispatch(msg[0], handler, self, msg)
 
         elif self.mode == data.MODE_CLIENT:
             # request from client
+            deadline = None
+            i = 1  # offset of the arguments
             actionbyte = msg[0]
-            if actionbyte == data.ID_SET:
-                # set
-                keysize = struct.unpack(data.MESSAGE_KEY_LENGTH_FORMAT, msg[1:1 + data.MESSAGE_KEY_LENGTH_SIZE])[0]
-                key = msg[1 + data.MESSAGE_KEY_LENGTH_SIZE:1 + data.MESSAGE_KEY_LENGTH_SIZE + keysize]
-                value = msg[1 + data.MESSAGE_KEY_LENGTH_SIZE + keysize:]
-                self.factory.set(key, value)
-            elif actionbyte == data.ID_GET:
-                # get
-                request_id = msg[1:1 + data.MESSAGE_ID_SIZE]
-                key = msg[1 + data.MESSAGE_ID_SIZE:]
-                try:
-                    value = yield self.factory.get(request_id, key)
-                    self.sendString(data.ID_ANSWER + request_id + value)
-                except KeyError:
-                    self.sendString(data.ID_NOTFOUND + request_id)
-            elif actionbyte == data.ID_DEL:
-                # del
-                key = msg[1:]
-                self.factory.delete(key)
-            elif actionbyte == data.ID_GETKEYS:
-                rid = msg[1:]
-                keystring = yield self.factory.getkeys(rid)
-                self.sendString(data.ID_ALLKEYS + rid + keystring)
-            elif actionbyte == data.ID_SWITCH:
-                self.switch_mode()
+            if actionbyte == data.ID_DEADLINE:
+                # the client is not interested in the answer after this many milliseconds
+                budget = data.DEADLINE_STRUCT.unpack_from(msg, 1)[0]
+                deadline = self.factory.reactor.seconds() + budget / 1000.0
+                actionbyte = msg[1 + data.DEADLINE_SIZE]
+                i = 2 + data.DEADLINE_SIZE
+            handler = self.client_handlers.get(actionbyte, None)
+            if handler is not None:
+                self.factory.requests[actionbyte] += 1
+                if self.factory.tracer is None:
+                    handler(self, msg, i, deadline)
+                else:
+                    self.factory.tracer.dispatch(actionbyte, handler, self, msg, i, deadline)
+            elif self.can_switch and actionbyte in self.server_handlers:
+                # a syncing database answers the requests sent before it started syncing
+                self.server_handlers[actionbyte](self, msg)
 
         else:
             # unknown mode; server side error
             raise RuntimeError("Invalid Mode")
 
+    @inlineCallbacks
+    def check_password(self, msg):
+        """checks the password sent by the client."""
+        if msg != self.factory.pswd:
+            # invalid password
+            yield utils.dsleep(self.factory.reactor, data.INVALID_PASSWORD_SLEEP_INTERVAL)  # sleep to prevent high speed attacks.
+            log.msg("Client sent invalid password. Losing connection...")
+            self.sendString(data.STATE_ERROR)
+            self.transport.loseConnection()
+            self.mode = data.MODE_ERROR
+        else:
+            # password correct
+            log.msg("Password OK, asking for mode...")
+            self.sendString(data.STATE_OK)
+            self.mode = data.MODE_UNKNOWN
+
+    # messages from databases; msg is the whole message
+
+    def server_answer(self, msg):
+        """a database answered a request."""
+        self.factory.got_answer(self, msg)
+
+    def server_snapshot(self, msg):
+        """a database sent a part of a snapshot."""
+        self.factory.got_snapshot(self, msg)
+
+    def server_ack(self, msg):
+        """a database synced the writes up to a sequence number."""
+        self.factory.got_ack(self, data.SEQ_STRUCT.unpack_from(msg, 1)[0])
+
+    def server_catchup(self, msg):
+        """the database (re)connected and tells us the last write it applied and its name."""
+        epoch, seq = data.CATCHUP_STRUCT.unpack_from(msg, 1)
+        if len(msg) > 1 + data.CATCHUP_SIZE:
+            # the position on the hash ring must be the same on all routers
+            self.node_id = msg[1 + data.CATCHUP_SIZE:]
+        # added as syncing before catching up, so that the missed writes to its keys are known,
+        # but no reads are sent to it until it caught up or finished its reset.
+        self.factory.add_syncing(self)
+        if self.factory.catchup(self, epoch, seq):
+            state = data.STATE_OK
+            self.factory.add_server(self)
+        else:
+            log.msg("Write log does not reach back to {p}, it needs to be reset.".format(p=self.node_id))
+            state = data.STATE_ERROR
+        self.sendString(data.ID_CATCHUP + state + data.CATCHUP_STRUCT.pack(self.factory.epoch, self.factory.seq))
+
+    def server_switch(self, msg):
+        """the database starts or stops syncing."""
+        self.switch_mode()
+
+    server_handlers = {
+        data.ID_ANSWER: server_answer,
+        data.ID_NOTFOUND: server_answer,
+        data.ID_ALLKEYS: server_answer,
+        data.ID_MANSWER: server_answer,
+        data.ID_SCANANSWER: server_answer,
+        data.ID_EXPIRED: server_answer,
+        data.ID_SNAPSHOTCHUNK: server_snapshot,
+        data.ID_SNAPSHOTEND: server_snapshot,
+        data.ID_ACK: server_ack,
+        data.ID_CATCHUP: server_catchup,
+        data.ID_SWITCH: server_switch,
+        }
+
+    # requests of clients; the arguments start at offset i of msg
+
+    def client_set(self, msg, i, deadline):
+        """sets a key."""
+        keysize = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from(msg, i)[0]
+        i += data.MESSAGE_KEY_LENGTH_SIZE
+        self.factory.set(msg[i:i + keysize], self.encode(msg[i + keysize:]), self)
+
+    def client_del(self, msg, i, deadline):
+        """deletes a key."""
+        self.factory.delete(msg[i:], self)
+
+    def client_get(self, msg, i, deadline):
+        """answers a get."""
+        request_id = msg[i:i + data.MESSAGE_ID_SIZE]
+        key = msg[i + data.MESSAGE_ID_SIZE:]
+        if self.tracking:
+            self.factory.track(self, key)
+        d = self.track_request(request_id, self.factory.get(key, deadline), deadline)
+        d.addCallbacks(self._send_value, self._send_read_failure, callbackArgs=(request_id, ), errbackArgs=(request_id, ))
+        return d
+
+    def _send_value(self, value, request_id):
+        """sends the answer to a get."""
+        utils.send_parts(self, [data.ID_ANSWER, request_id, self.decode(value)])
+
+    def _send_read_failure(self, f, request_id):
+        """tells the client that a read failed."""
+        if f.check(KeyError):
+            self.sendString(data.ID_NOTFOUND + request_id)
+        elif f.check(CancelledError, TimeoutError):
+            self.sendString(data.ID_EXPIRED + request_id)
+        else:
+            return f
+
+    @inlineCallbacks
+    def client_ackwrite(self, msg, i, deadline):
+        """performs a set/del which needs to be acknowledged."""
+        request_id = msg[i:i + data.MESSAGE_ID_SIZE]
+        acks = ord(msg[i + data.MESSAGE_ID_SIZE])
+        success = yield self.factory.acked_write(self, acks, msg[i + 1 + data.MESSAGE_ID_SIZE:])
+        if success:
+            self.sendString(data.ID_ACK + request_id + data.STATE_OK)
+        else:
+            self.sendString(data.ID_ACK + request_id + data.STATE_ERROR)
+
+    @inlineCallbacks
+    def client_getkeys(self, msg, i, deadline):
+        """answers a request for all keys."""
+        rid = msg[i:]
+        try:
+            keystring = yield self.track_request(rid, self.factory.getkeys(self, deadline), deadline)
+        except (CancelledError, TimeoutError):
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            utils.send_parts(self, [data.ID_ALLKEYS, rid, keystring])
+
+    @inlineCallbacks
+    def client_mget(self, msg, i, deadline):
+        """answers a batch get."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        keys = utils.keystring2list(msg, i + data.MESSAGE_ID_SIZE)
+        if self.tracking:
+            for key in keys:
+                self.factory.track(self, key)
+        try:
+            results = yield self.track_request(rid, self.factory.mget(keys, deadline), deadline)
+        except (CancelledError, TimeoutError):
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            utils.send_parts(self, [data.ID_MANSWER, rid, self.decode_results(results)])
+
+    @inlineCallbacks
+    def client_scan(self, msg, i, deadline):
+        """answers the request for a page of a key scan."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        cursor, count = data.SCAN_STRUCT.unpack_from(msg, i + data.MESSAGE_ID_SIZE)
+        try:
+            cursor, keys = yield self.track_request(rid, self.factory.scan(cursor, count, self, deadline), deadline)
+        except KeyError:
+            self.sendString(data.ID_NOTFOUND + rid)
+        except (CancelledError, TimeoutError):
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            utils.send_parts(self, [data.ID_SCANANSWER, rid, data.CURSOR_STRUCT.pack(cursor), utils.keylist2string(keys)])
+
+    @inlineCallbacks
+    def client_keyrange(self, msg, i, deadline):
+        """answers a request for the sorted keys in a range."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        start, end, limit, reverse = utils.string2keyrange(msg, i + data.MESSAGE_ID_SIZE)
+        try:
+            keys = yield self.track_request(rid, self.factory.keyrange(start, end, limit, reverse, deadline), deadline)
+        except KeyError:
+            self.sendString(data.ID_NOTFOUND + rid)
+        except (CancelledError, TimeoutError):
+            self.sendString(data.ID_EXPIRED + rid)
+        else:
+            utils.send_parts(self, [data.ID_ALLKEYS, rid, utils.keylist2string(keys)])
+
+    def client_mset(self, msg, i, deadline):
+        """sets multiple keys."""
+        pairs = utils.pairstring2list(msg, i)
+        if not self.compressed:
+            pairs = [(key, self.encode(value)) for key, value in pairs]
+        self.factory.mset(pairs, self)
+
+    def client_mdel(self, msg, i, deadline):
+        """deletes multiple keys."""
+        self.factory.mdelete(utils.keystring2list(msg, i), self)
+
+    def client_snapshot(self, msg, i, deadline):
+        """a syncing database requests the data."""
+        if self.can_switch:
+            self.factory.snapshot(self, msg[i:i + data.MESSAGE_ID_SIZE])
+
+    def client_track(self, msg, i, deadline):
+        """the client enabled its near cache."""
+        self.tracking = True
+
+    def client_cancel(self, msg, i, deadline):
+        """the client is no longer interested in the answer to a read."""
+        d = self.pending.get(msg[i:i + data.MESSAGE_ID_SIZE], None)
+        if d is not None:
+            d.cancel()
+
+    def client_routers(self, msg, i, deadline):
+        """the client asks for the available routers."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        self.sendString(data.ID_ALLKEYS + rid + utils.keylist2string(self.factory.peers))
+
+    @inlineCallbacks
+    def client_stats(self, msg, i, deadline):
+        """the client asks for the statistics of the router and the databases."""
+        rid = msg[i:i + data.MESSAGE_ID_SIZE]
+        stats = yield self.factory.collect_stats()
+        self._send_value(data.VALUE_RAW + json.dumps(stats), rid)
+
+    def client_switch(self, msg, i, deadline):
+        """a syncing database finished syncing."""
+        self.switch_mode()
+
+    client_handlers = {
+        data.ID_SET: client_set,
+        data.ID_DEL: client_del,
+        data.ID_GET: client_get,
+        data.ID_ACKWRITE: client_ackwrite,
+        data.ID_GETKEYS: client_getkeys,
+        data.ID_MGET: client_mget,
+        data.ID_SCAN: client_scan,
+        data.ID_KEYRANGE: client_keyrange,
+        data.ID_MSET: client_mset,
+        data.ID_MDEL: client_mdel,
+        data.ID_SNAPSHOT: client_snapshot,
+        data.ID_TRACK: client_track,
+        data.ID_CANCEL: client_cancel,
+        data.ID_ROUTERS: client_routers,
+        data.ID_SWITCH: client_switch,
+        data.ID_STATS: client_stats,
+        }
+
     def connectionLost(self, reason):
         """called when the connection was lost."""
         log.msg("Connection lost. Reason: {r}".format(r=reason))
-        if self in self.factory.servers:
-            self.factory.servers.remove(self)
-        if self in self.factory.syncing:
-            self.factory.syncing.remove(self)
+        self.factory.remove_node(self)
+        self.factory.drop_scans(self)
+        self.factory.untrack(self)
+        for d in self.pending.values():
+            # nobody is waiting for the answers anymore
+            d.cancel()
+        if self.range_start is not None:
+            self.factory.release_range(self.range_start)
+            self.range_start = None
 
         if self in self.factory.all:
             self.factory.all.remove(self)
 
-    def send_get(self, rid, key):
+    def track_request(self, request_id, d, deadline):
+        """allows the client to cancel the read d with the id request_id. If deadline is not None, d is cancelled once it passed."""
+        if d.called:
+            return d
+        timer = None
+        if deadline is not None:
+            timer = self.factory.reactor.callLater(max(0, deadline - self.factory.reactor.seconds()), d.cancel)
+        self.pending[request_id] = d
+        d.addBoth(self._request_finished, request_id, timer)
+        return d
+
+    def _request_finished(self, result, request_id, timer):
+        """called when a read of the client finished."""
+        self.pending.pop(request_id, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        return result
+
+    def add_call(self, call):
+        """stores call as pending and returns the rid for the request to the server."""
+        if len(self.free_slots) > 0:
+            rid = self.free_slots.pop()
+            self.slots[rid] = call
+        else:
+            rid = len(self.slots)
+            self.slots.append(call)
+        return rid
+
+    def pop_call(self, rid):
+        """removes and returns the pending call for rid or None if there is none."""
+        if rid >= len(self.slots):
+            return None
+        call = self.slots[rid]
+        if call is not None:
+            self.slots[rid] = None
+            self.free_slots.append(rid)
+        return call
+
+    def load(self):
+        """returns the load score of the server used for choosing a server to read from."""
+        if self.latency is None:
+            # no answers yet; try this server
+            return 0
+        return (self.outstanding + 1) * self.latency
+
+    def encode(self, value):
+        """returns value received from the peer in the form used by the router."""
+        if self.compressed:
+            return value
+        return data.VALUE_RAW + value
+
+    def decode(self, value):
+        """returns value in the form used by the router converted for the peer."""
+        if self.compressed:
+            return value
+        return utils.decode_value(value)
+
+    def encode_results(self, results):
+        """encode() for all values in the answer to a batch get."""
+        if self.compressed:
+            return results
+        return utils.convert_results(results, self.encode)
+
+    def decode_results(self, results):
+        """decode() for all values in the answer to a batch get."""
+        if self.compressed:
+            return results
+        return utils.convert_results(results, self.decode)
+
+    def send_request(self, msg, deadline=None):
+        """sends a read to the db-server. If deadline is not None, the time left until it passes is sent along."""
+        if deadline is not None:
+            budget = max(0, int((deadline - self.factory.reactor.seconds()) * 1000))
+            msg = data.ID_DEADLINE + data.DEADLINE_STRUCT.pack(budget) + msg
+        self.sendString(msg)
+
+    def send_get(self, rid, key, deadline=None):
         """if in server mode, request the value for key from the db-server. otherwise, raise AssertionError"""
         assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
-        self.sendString(data.ID_GET + rid + key)
+        self.send_request(data.ID_GET + rid + key, deadline)
 
-    def send_set(self, key, value):
+    def send_write(self, parts, seq=None):
+        """sends a write consisting of the strings in parts to the db-server. If seq is not None, the write is tagged with this sequence number."""
+        if seq is not None:
+            parts = [data.ID_SEQ, data.SEQ_STRUCT.pack(seq)] + parts
+        utils.send_parts(self, parts)
+
+    def send_set(self, key, value, seq=None):
         """if in server mode, tell the db-server to set key to value. otherwise, raise AssertionError"""
         assert self.mode == data.MODE_SERVER or self.can_switch, "This protocol is not connected to a database!"
-        keylength = struct.pack(data.MESSAGE_KEY_LENGTH_FORMAT, len(key))
-        self.sendString(data.ID_SET + keylength + key + value)
+        if self.queue.active:
+            self.queue.add(key, value, seq)
+            return
+        self.send_write([data.ID_SET, data.MESSAGE_KEY_LENGTH_STRUCT.pack(len(key)), key, self.decode(value)], seq)
 
-    def send_del(self, key):
+    def send_del(self, key, seq=None):
         """if in server mode, tell the db-server to delete the value for key. otherwise, raise AssertionError"""
         assert self.mode == data.MODE_SERVER or self.can_switch, "This protocol is not connected to a database!"
-        self.sendString(data.ID_DEL + key)
+        if self.queue.active:
+            self.queue.add(key, None, seq)
+            return
+        self.send_write([data.ID_DEL, key], seq)
+
+    def send_mget(self, rid, keys, deadline=None):
+        """if in server mode, request the values for keys from the db-server. otherwise, raise AssertionError"""
+        assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
+        self.send_request(data.ID_MGET + rid + utils.keylist2string(keys), deadline)
+
+    def send_mset(self, pairs, seq=None):
+        """if in server mode, tell the db-server to set the (key, value) pairs. otherwise, raise AssertionError"""
+        assert self.mode == data.MODE_SERVER or self.can_switch, "This protocol is not connected to a database!"
+        if self.queue.active:
+            for key, value in pairs:
+                self.queue.add(key, value, seq)
+            return
+        if not self.compressed:
+            pairs = [(key, self.decode(value)) for key, value in pairs]
+        self.send_write([data.ID_MSET, utils.pairlist2string(pairs)], seq)
+
+    def send_mdel(self, keys, seq=None):
+        """if in server mode, tell the db-server to delete the values for keys. otherwise, raise AssertionError"""
+        assert self.mode == data.MODE_SERVER or self.can_switch, "This protocol is not connected to a database!"
+        if self.queue.active:
+            for key in keys:
+                self.queue.add(key, None, seq)
+            return
+        self.send_write([data.ID_MDEL, utils.keylist2string(keys)], seq)
+
+    def send_scan(self, rid, cursor, count, deadline=None):
+        """if in server mode, requests a page of keys from the db-server. otherwise, raise AssertionError"""
+        assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
+        self.send_request(data.ID_SCAN + rid + data.SCAN_STRUCT.pack(cursor, count), deadline)
 
-    def send_getkeys(self, rid):
+    def send_keyrange(self, rid, start, end=None, limit=0, reverse=False, deadline=None):
+        """if in server mode, requests the sorted keys in [start, end) from the db-server. otherwise, raise AssertionError"""
+        assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
+        self.send_request(data.ID_KEYRANGE + rid + utils.keyrange2string(start, end, limit, reverse), deadline)
+
+    def send_getkeys(self, rid, deadline=None):
         """if in server mode, requests a list of keys from the db-server. otherwise, raise AssertionError"""
         assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
-        self.sendString(data.ID_GETKEYS + rid)
+        self.send_request(data.ID_GETKEYS + rid, deadline)
+
+    def send_sync(self):
+        """asks the db-server to sync the writes and acknowledge them."""
+        assert self.mode == data.MODE_SERVER, "This protocol is not connected to a database!"
+        if self.queue.active:
+            # sync once the queued writes were sent
+            self.queue.sync = True
+            return
+        self.sendString(data.ID_SYNC)
+
+    def send_invalidate(self, keys):
+        """tells the client to drop keys from its near cache."""
+        self.sendString(data.ID_INVALIDATE + utils.keylist2string(keys))
+
+    def send_flush(self):
+        """tells the client to drop its whole near cache."""
+        self.sendString(data.ID_FLUSH)
 
     def switch_mode(self):
         """switch between client/server mode."""
         if self.can_switch:
             if self.mode == data.MODE_SERVER:
-                if self in self.factory.servers:
-                    self.factory.servers.remove(self)
-                if self not in self.factory.syncing:
-                    self.factory.syncing.append(self)
+                self.factory.add_syncing(self)
                 self.mode = data.MODE_CLIENT
             elif self.mode == data.MODE_CLIENT:
-                if self not in self.factory.servers:
-                    self.factory.servers.append(self)
-                if self in self.factory.syncing:
-                    self.factory.syncing.remove(self)
+                self.factory.add_server(self)
                 self.mode = data.MODE_SERVER
 
     # DEBUG FUNCTIONS
@@ -1,30 +1,94 @@
 #!/usr/bin/env python2
 """The command line interface"""
+import os
 import sys
 import argparse
 
 from twisted.internet import endpoints, reactor
+from twisted.internet.protocol import Factory, ProcessProtocol
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import ReactorNotRunning
 from twisted.python import log
 
 from .ramdb import RamDatabase
+from .compactdb import CompactDatabase
 from .dbmdb import DbmDatabase
 from .dirdb import DirdbmDatabase
-from . import router, data, dbproto, cmdclient, txclient
+from .logdb import LogDatabase
+from .asyncdb import ThreadedDatabase
+from . import router, data, dbproto, cmdclient, txclient, bench, profiling
 
 DATABASES = {  # name -> Database
     "ram": RamDatabase,
+    "compact": CompactDatabase,
     "dbm": DbmDatabase,
     "dir": DirdbmDatabase,
+    "log": LogDatabase,
 }
 
 
+class WorkerProtocol(ProcessProtocol):
+    """watches a worker process of a router. ended is called once it exited."""
+    def __init__(self, index):
+        self.index = index
+        self.ended = Deferred()
+
+    def processEnded(self, reason):
+        """called when the process exited."""
+        log.msg("Router worker {i} exited: {r}".format(i=self.index, r=reason.getErrorMessage()))
+        self.ended.callback(None)
+
+
+def start_workers(ns, args):
+    """
+listens on the port of the router and starts ns.workers router processes accepting the connections to it.
+args are the command line arguments, which are passed on to the workers.
+"""
+    port = reactor.listenTCP(ns.port, Factory(), interface=ns.host)
+    # the workers accept the connections
+    port.stopReading()
+    fd = port.fileno()
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([path] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    workers = []
+    for i in range(ns.workers):
+        worker = WorkerProtocol(i)
+        wargs = [sys.executable, "-m", "kvndb"] + list(args) + [
+            "--workers", "0", "--worker-index", str(i), "--worker-fd", str(fd), "--worker-family", str(port.addressFamily),
+            ]
+        reactor.spawnProcess(worker, sys.executable, wargs, env=env, childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+        workers.append(worker)
+    reactor.addSystemEventTrigger("before", "shutdown", stop_workers, workers)
+    DeferredList([w.ended for w in workers]).addCallback(workers_ended)
+
+
+def workers_ended(ignored):
+    """stops the router once all of its workers exited."""
+    try:
+        reactor.stop()
+    except ReactorNotRunning:
+        # already shutting down
+        pass
+
+
+def stop_workers(workers):
+    """stops the worker processes of a router. Returns a deferred which will be called once they exited."""
+    running = []
+    for worker in workers:
+        if not worker.ended.called:
+            worker.transport.signalProcess("TERM")
+            running.append(worker.ended)
+    return DeferredList(running)
+
+
 def run(args=None):
     """runs the command line interface."""
     if args is None:
         args = sys.argv[1:]
     parser = argparse.ArgumentParser(description="Key/Value Network Database")
     parser.add_argument(
-        "mode", choices=["router", "cmd"] + DATABASES.keys(), action="store",
+        "mode", choices=["router", "cmd", "bench"] + DATABASES.keys(), action="store",
         help="What mode the server should operate in",
         )
     parser.add_argument(
@@ -63,27 +127,286 @@ def run(args=None):
         "--reset-sleep", action="store", required=False, type=float, default=0.2, dest="sleep_interval",
         help="wait every 128 requests this many seconds before sending the next requests.",
         )
+    parser.add_argument(
+        "--reset-mode", action="store", required=False, choices=data.RESET_MODES, default=data.DEFAULT_RESET_MODE,
+        dest="reset_mode",
+        help="how to load the db on reset: stream a snapshot from another database or request every key [default: snapshot]",
+        )
+    parser.add_argument(
+        "--seq-file", action="store", required=False, default=None, dest="seq_file",
+        help="save the number of the last applied write to this file, so that a restarted db only needs the missed writes",
+        )
+    parser.add_argument(
+        "--threads", action="store", required=False, type=int, default=data.DEFAULT_THREADS, dest="threads",
+        help="run the calls to blocking databases in this many threads; 0 runs them in the main thread [default: {n}]".format(
+            n=data.DEFAULT_THREADS,
+            ),
+        )
+    parser.add_argument(
+        "--store-compressed", action="store_true", required=False, dest="store_compressed",
+        help="store the values in the form sent by the clients, compressed if they compress them; requires a reset to change",
+        )
+    parser.add_argument(
+        "--compression", action="store", required=False, type=int, default=None, dest="compression", choices=range(10),
+        help="[cmd, bench] compress values with zlib at this level before sending them [default: no compression]",
+        )
+    parser.add_argument(
+        "--compression-threshold", action="store", required=False, type=int, default=data.DEFAULT_COMPRESSION_THRESHOLD,
+        dest="compression_threshold",
+        help="[cmd] only compress values of at least this many bytes",
+        )
+    parser.add_argument(
+        "--timing", action="store_true", required=False, dest="timing",
+        help="[router, databases] time the requests by opcode; the percentiles are part of the stats",
+        )
+    parser.add_argument(
+        "--slow-log", action="store", required=False, type=float, default=None, dest="slow_log",
+        help="[router, databases] log requests taking at least this many milliseconds with the time of each stage; implies --timing",
+        )
+    parser.add_argument(
+        "--profile", action="store", required=False, default=None, dest="profile",
+        help="[router, databases] toggle cProfile on {s} and write the statistics to this file when it stops".format(
+            s=data.PROFILE_SIGNAL,
+            ),
+        )
+    parser.add_argument(
+        "--router", action="append", required=False, default=[], dest="routers",
+        help="also connect the database to the router at this endpoint; may be given multiple times",
+        )
+    parser.add_argument(
+        "--write-log", action="store", required=False, type=int, default=data.DEFAULT_WRITE_LOG_SIZE, dest="write_log_size",
+        help="[router] bytes of recent writes to keep for reconnecting databases",
+        )
+    parser.add_argument(
+        "--queue-high", action="store", required=False, type=int, default=data.DEFAULT_QUEUE_HIGH, dest="queue_high",
+        help="[router] stop reading from clients once this many bytes of writes to a database are queued",
+        )
+    parser.add_argument(
+        "--queue-low", action="store", required=False, type=int, default=data.DEFAULT_QUEUE_LOW, dest="queue_low",
+        help="[router] continue reading from clients once all queues are below this many bytes",
+        )
+    parser.add_argument(
+        "--metrics", action="store", required=False, default=None, dest="metrics",
+        help="[router] serve plain text metrics over http on this server endpoint, e.g. tcp:9100 [default: no metrics]",
+        )
+    parser.add_argument(
+        "--workers", action="store", required=False, type=int, default=0, dest="workers",
+        help="[router] run this many router processes accepting the connections to the port [default: a single process]",
+        )
+    parser.add_argument(
+        "--worker-port", action="store", required=False, type=int, default=None, dest="worker_port",
+        help="[router] with --workers, worker n also listens on this port plus n, e.g. for databases [default: port + 1]",
+        )
+    parser.add_argument(
+        "--worker-index", action="store", required=False, type=int, default=None, dest="worker_index",
+        help=argparse.SUPPRESS,  # used by the workers of a router
+        )
+    parser.add_argument(
+        "--worker-fd", action="store", required=False, type=int, default=None, dest="worker_fd",
+        help=argparse.SUPPRESS,
+        )
+    parser.add_argument(
+        "--worker-family", action="store", required=False, type=int, default=None, dest="worker_family",
+        help=argparse.SUPPRESS,
+        )
+    parser.add_argument(
+        "--router-id", action="store", required=False, type=int, default=0, dest="router_id",
+        help="[router] distinct id of this router if several routers serve the same databases [default: 0]",
+        )
+    parser.add_argument(
+        "--peer", action="append", required=False, default=[], dest="peers",
+        help="[router] client endpoint of a router serving the same databases, announced to clients; may be given multiple times",
+        )
+    parser.add_argument(
+        "--replication", action="store", required=False, type=int, default=None, dest="replication",
+        help="[router] partition the keys and store each key on this many databases [default: store all keys on all databases]",
+        )
+    parser.add_argument(
+        "--vnodes", action="store", required=False, type=int, default=data.DEFAULT_VNODES, dest="vnodes",
+        help="[router] number of points per database on the hash ring when partitioning",
+        )
+    parser.add_argument(
+        "--cache-size", action="store", required=False, type=int, default=0, dest="cache_size",
+        help="[router] cache up to this many bytes of values in the router [default: no cache]",
+        )
+    parser.add_argument(
+        "--read-policy", action="store", required=False, default=data.DEFAULT_READ_POLICY, dest="read_policy",
+        choices=data.READ_POLICIES,
+        help="[router] how to choose the database to read from",
+        )
+    parser.add_argument(
+        "--hedge-percentile", action="store", required=False, type=float, default=None, dest="hedge_percentile",
+        help="[router] send gets not answered within this latency percentile to a second database [default: no hedging]",
+        )
+    parser.add_argument(
+        "--hedge-budget", action="store", required=False, type=float, default=data.DEFAULT_HEDGE_BUDGET, dest="hedge_budget",
+        help="[router] ratio of gets which may be hedged",
+        )
+    parser.add_argument(
+        "--bench-db", action="store", required=False, default="ram", dest="bench_db", choices=DATABASES.keys(),
+        help="[bench] database interface to benchmark; the arguments are passed to it [default: ram]",
+        )
+    parser.add_argument(
+        "--bench-dbs", action="store", required=False, type=int, default=2, dest="bench_dbs",
+        help="[bench] number of databases",
+        )
+    parser.add_argument(
+        "--bench-clients", action="store", required=False, type=int, default=4, dest="bench_clients",
+        help="[bench] number of load generating clients",
+        )
+    parser.add_argument(
+        "--bench-processes", action="store_true", required=False, dest="bench_processes",
+        help="[bench] run the databases and clients in subprocesses instead of this process",
+        )
+    parser.add_argument(
+        "--bench-duration", action="store", required=False, type=float, default=10.0, dest="bench_duration",
+        help="[bench] seconds to measure",
+        )
+    parser.add_argument(
+        "--bench-warmup", action="store", required=False, type=float, default=1.0, dest="bench_warmup",
+        help="[bench] seconds of load before measuring",
+        )
+    parser.add_argument(
+        "--bench-keys", action="store", required=False, type=int, default=10000, dest="bench_keys",
+        help="[bench] number of keys",
+        )
+    parser.add_argument(
+        "--bench-reads", action="store", required=False, type=float, default=0.9, dest="bench_reads",
+        help="[bench] ratio of requests which are gets; the others are sets",
+        )
+    parser.add_argument(
+        "--bench-distribution", action="store", required=False, default="uniform", dest="bench_distribution",
+        choices=data.BENCH_DISTRIBUTIONS,
+        help="[bench] how the keys are chosen",
+        )
+    parser.add_argument(
+        "--bench-zipf-exponent", action="store", required=False, type=float, default=data.DEFAULT_ZIPF_EXPONENT,
+        dest="bench_zipf_exponent",
+        help="[bench] exponent of the zipfian distribution",
+        )
+    parser.add_argument(
+        "--bench-value-size", action="store", required=False, type=int, default=1024, dest="bench_value_size",
+        help="[bench] bytes per value",
+        )
+    parser.add_argument(
+        "--bench-pipeline", action="store", required=False, type=int, default=16, dest="bench_pipeline",
+        help="[bench] requests each client keeps outstanding",
+        )
+    parser.add_argument(
+        "--bench-acks", action="store", required=False, type=int, default=1, dest="bench_acks",
+        help="[bench] databases which need to acknowledge a set",
+        )
+    parser.add_argument(
+        "--bench-resync", action="store_true", required=False, dest="bench_resync",
+        help="[bench] reset another database during the benchmark and measure the time it takes",
+        )
+    parser.add_argument(
+        "--bench-seed", action="store", required=False, type=int, default=None, dest="bench_seed",
+        help="[bench] seed of the random choices",
+        )
+    parser.add_argument(
+        "--bench-output", action="store", required=False, default=None, dest="bench_output",
+        help="[bench] write the JSON results to this file [default: stdout]",
+        )
+    parser.add_argument(
+        "--bench-role", action="store", required=False, default=None, dest="bench_role", choices=("client", ),
+        help=argparse.SUPPRESS,  # used by the subprocesses of a benchmark
+        )
     parser.add_argument(
         "arguments", action="store", nargs="*",
         help="arguments to pass to database interface",
         )
     ns = parser.parse_args(args)
+    if ns.bench_acks < 1:
+        parser.error("--bench-acks must be at least 1, so that the latency of sets can be measured.")
+    if ns.workers > 0:
+        if ns.mode != "router":
+            parser.error("--workers can only be used with the router.")
+        if ns.endpoint is not None or ns.type not in ("tcp", "tcp6"):
+            parser.error("--workers requires a tcp port.")
+        if ns.router_id + ns.workers > data.MAX_ROUTERS:
+            parser.error("Every worker needs a router id below {m}.".format(m=data.MAX_ROUTERS))
+    worker_suffix = ""
+    if ns.worker_index is not None:
+        # the files of the workers are distinguished by their router id
+        ns.router_id += ns.worker_index
+        worker_suffix = ".{i}".format(i=ns.router_id)
 
     if ns.verbose:
         if ns.logfile is None:
             log.startLogging(sys.stdout)
         else:
-            logfile = open(ns.logfile, "w")
+            logfile = open(ns.logfile + worker_suffix, "w")
             log.startLogging(logfile)
 
-    if ns.mode == "router":
+    tracer = None
+    if ns.timing or ns.slow_log is not None:
+        slow_threshold = None
+        if ns.slow_log is not None:
+            slow_threshold = ns.slow_log / 1000.0
+        tracer = profiling.RequestTracer(reactor.seconds, slow_threshold=slow_threshold)
+    if ns.profile is not None:
+        profiling.Profiler(ns.profile + worker_suffix).install(reactor)
+
+    if ns.mode == "bench":
+        if ns.bench_role == "client":
+            # load generator of a benchmark running in another process
+            es = "{type}:host={host}:port={port}".format(type=ns.type, port=ns.port, host=ns.host)
+            d = bench.run_load(
+                reactor, endpoints.clientFromString(reactor, es), ns.password, duration=ns.bench_duration,
+                warmup=ns.bench_warmup, keys=ns.bench_keys, read_ratio=ns.bench_reads, distribution=ns.bench_distribution,
+                exponent=ns.bench_zipf_exponent, value_size=ns.bench_value_size, pipeline=ns.bench_pipeline,
+                acks=ns.bench_acks, compression=ns.compression, seed=ns.bench_seed,
+                )
+        else:
+            benchmark = bench.Benchmark(
+                reactor, ns.bench_db, DATABASES[ns.bench_db], ns.arguments, databases=ns.bench_dbs, clients=ns.bench_clients,
+                duration=ns.bench_duration, warmup=ns.bench_warmup, keys=ns.bench_keys, read_ratio=ns.bench_reads,
+                distribution=ns.bench_distribution, exponent=ns.bench_zipf_exponent, value_size=ns.bench_value_size,
+                pipeline=ns.bench_pipeline, acks=ns.bench_acks, resync=ns.bench_resync, processes=ns.bench_processes,
+                threads=ns.threads, compression=ns.compression, store_compressed=ns.store_compressed,
+                router_kwargs=dict(
+                    replication=ns.replication, vnodes=ns.vnodes, cache_size=ns.cache_size, read_policy=ns.read_policy,
+                    hedge_percentile=ns.hedge_percentile, hedge_budget=ns.hedge_budget, write_log_size=ns.write_log_size,
+                    queue_high=ns.queue_high, queue_low=ns.queue_low,
+                    ),
+                seed=ns.bench_seed,
+                )
+            d = benchmark.run()
+        d.addCallback(bench.write_result, ns.bench_output)
+        d.addErrback(log.err)
+        d.addBoth(lambda ignored: reactor.stop())
+    elif ns.mode == "router" and ns.workers > 0:
+        start_workers(ns, args)
+    elif ns.mode == "router":
         if ns.endpoint is None:
             es = "{type}:port={port}:interface={host}".format(type=ns.type, port=ns.port, host=ns.host)
         else:
             es = ns.endpoint
-        factory = router.RouterFactory(reactor, ns.password)
-        endpoint = endpoints.serverFromString(reactor, es)
-        endpoint.listen(factory)
+        cache_max_age = None
+        if ns.worker_index is not None or len(ns.peers) > 1:
+            # writes through the other routers do not update the cache
+            cache_max_age = data.ROUTER_CACHE_MAX_AGE
+        factory = router.RouterFactory(
+            reactor, ns.password, replication=ns.replication, vnodes=ns.vnodes, cache_size=ns.cache_size,
+            cache_max_age=cache_max_age, read_policy=ns.read_policy, hedge_percentile=ns.hedge_percentile, hedge_budget=ns.hedge_budget,
+            write_log_size=ns.write_log_size, router_id=ns.router_id, peers=ns.peers,
+            queue_high=ns.queue_high, queue_low=ns.queue_low, tracer=tracer,
+            )
+        if ns.worker_index is None:
+            endpoint = endpoints.serverFromString(reactor, es)
+            endpoint.listen(factory)
+        else:
+            # accept the connections to the port shared with the other workers and to a port of our own
+            reactor.adoptStreamPort(ns.worker_fd, ns.worker_family, factory)
+            if ns.worker_port is None:
+                ns.worker_port = ns.port + 1
+            es = "{type}:port={port}:interface={host}".format(type=ns.type, port=ns.worker_port + ns.worker_index, host=ns.host)
+            endpoints.serverFromString(reactor, es).listen(factory).addErrback(log.err)
+        if ns.metrics is not None and not ns.worker_index:
+            # twisted.web is only needed for the metrics; of several workers, the first one serves them
+            from . import metrics
+            metrics.listen(reactor, factory, ns.metrics).addErrback(log.err)
     else:
         if ns.endpoint is None:
             es = "{type}:host={host}:port={port}".format(type=ns.type, port=ns.port, host=ns.host)
@@ -92,12 +415,21 @@ def run(args=None):
         endpoint = endpoints.clientFromString(reactor, es)
         if ns.mode == "cmd":
             cmd = cmdclient.KVNDBCmdClient(reactor)
-            protocol = txclient.ClientProtocol(ns.password)
+            protocol = txclient.ClientProtocol(
+                ns.password, compression=ns.compression, compression_threshold=ns.compression_threshold,
+                )
             protocol.callback.addCallback(cmd.defer_entry)
+            endpoints.connectProtocol(endpoint, protocol)
         else:
             db = DATABASES[ns.mode](ns.arguments)
-            protocol = dbproto.DatabaseClientProtocol(db, ns.password, reactor, reset=ns.reset, reset_sleep_interval=ns.sleep_interval)
-        endpoints.connectProtocol(endpoint, protocol)
+            if ns.threads > 0 and getattr(db, "blocking", True):
+                db = ThreadedDatabase(db, reactor, threads=ns.threads)
+            routers = [endpoint] + [endpoints.clientFromString(reactor, address) for address in ns.routers]
+            connector = dbproto.DatabaseConnector(
+                reactor, routers, db, ns.password, reset=ns.reset, reset_sleep_interval=ns.sleep_interval,
+                reset_mode=ns.reset_mode, seq_file=ns.seq_file, store_compressed=ns.store_compressed, tracer=tracer,
+                )
+            connector.start()
     reactor.run()
 
 
@@ -1,12 +1,18 @@
 """asynchronous clientside protocol for twisted."""
+import json
 import struct
+import random
+import functools
+import collections
 
 from twisted.protocols.basic import IntNStringReceiver
-from twisted.internet.defer import Deferred
+from twisted.internet import endpoints
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue, succeed, fail, TimeoutError
 from twisted.python.failure import Failure
 from twisted.python import log
 
-from . import data, utils
+from . import data, utils, cache, ring
 
 
 class VersionMismatch(Exception):
@@ -24,22 +30,57 @@ class IncorrectPassword(ValueError):
     pass
 
 
+class WriteFailed(Exception):
+    """A write could not be acknowledged by enough databases."""
+    pass
+
+
+class NotConnected(Exception):
+    """No router is available."""
+    pass
+
+
 class ClientProtocol(IntNStringReceiver):
     """
 This protocol connects to the router.
 You can use the 'callback' attribute to get a deferred which will be called once the handshake is finished.
+If cache_size is not 0, up to cache_size bytes of values are cached locally.
+The router tells the client when a cached key is written by another client; cached values are
+used for at most cache_max_age seconds in case such a message gets lost or the key is written
+through another router.
+The deferreds of requests can be cancelled. Reads also take a timeout in seconds, after which they fail
+with a TimeoutError; the timeout is sent along, so that the router and the databases drop the read too.
+reactor is used for the timeouts and defaults to the global reactor.
+If compression is not None, values of at least compression_threshold bytes are compressed with zlib at
+this level before they are sent, if the router supports it. The databases may store them compressed.
 """
-    def __init__(self, password):
+    def __init__(
+        self, password, cache_size=0, cache_max_age=data.DEFAULT_NEAR_CACHE_MAX_AGE, reactor=None,
+        compression=None, compression_threshold=data.DEFAULT_COMPRESSION_THRESHOLD,
+        ):
         if hasattr(IntNStringReceiver, "__init__"):
             IntNStringReceiver.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
         self.password = password
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compressed = False  # True if the values sent over the connection carry a flag byte
+        self.keyranges = False  # True if the router answers key range requests
+        if cache_size > 0:
+            self.cache = cache.LRUCache(cache_size, max_age=cache_max_age)
+        else:
+            self.cache = None
         self.requests = {}
         self.free = set()
         self.range_start = None
         self.range_end = None
         self.mode = data.MODE_CONNECTING
+        self.pool = None  # the ClientPool this connection belongs to
         self.structFormat = data.MESSAGE_LENGTH_FORMAT
         self.prefixLength = data.MESSAGE_LENGTH_SIZE
+        self.MAX_LENGTH = data.MAX_MESSAGE_LENGTH
         self.callback = Deferred()  # will be called once the handshake is finished
 
     def connectionMade(self):
@@ -51,6 +92,13 @@ You can use the 'callback' attribute to get a deferred which will be called once
         self.mode = data.MODE_VERSION
         self.sendString(struct.pack(data.VERSION_FORMAT, data.VERSION))
 
+    def send_mode(self):
+        """tells the router that this is a client and which capabilities it supports."""
+        caps = data.CAP_KEYRANGE
+        if self.compression is not None:
+            caps |= data.CAP_COMPRESSION
+        self.sendString(data.MODE_CLIENT + data.CAPS_STRUCT.pack(caps))
+
     def stringReceived(self, msg):
         """called when a message was received."""
         if self.mode == data.MODE_ERROR:
@@ -63,7 +111,7 @@ You can use the 'callback' attribute to get a deferred which will be called once
             if msg == data.STATE_OK:
                 # Version OK, continue
                 log.msg("Version OK, sending mode and requesting range...")
-                self.sendString(data.MODE_CLIENT)
+                self.send_mode()
                 self.mode = data.MODE_RANGE
             elif msg == data.STATE_ERROR:
                 # Version mismatch
@@ -100,7 +148,7 @@ You can use the 'callback' attribute to get a deferred which will be called once
                 # Password OK, continue
                 log.msg("Password OK, sending mode and requesting range...")
                 self.mode = data.MODE_RANGE
-                self.sendString(data.MODE_CLIENT)  # < -- this is correct
+                self.send_mode()  # < -- this is correct
             elif msg == data.STATE_ERROR:
                 # Password invalid
                 log.err("Invalid password!")
@@ -114,37 +162,24 @@ You can use the 'callback' attribute to get a deferred which will be called once
                 self.transport.loseConnection()
 
         elif self.mode == data.MODE_RANGE:
-            self.range_start, self.range_end = struct.unpack(data.RANGE_FORMAT, msg)
+            self.range_start, self.range_end = struct.unpack_from(data.RANGE_FORMAT, msg)
             log.msg("Range is {s} to {e}.".format(s=self.range_start, e=self.range_end))
+            if len(msg) > data.RANGE_SIZE:
+                caps = data.CAPS_STRUCT.unpack_from(msg, data.RANGE_SIZE)[0]
+                self.compressed = bool(caps & data.CAP_COMPRESSION)
+                self.keyranges = bool(caps & data.CAP_KEYRANGE)
             self.cur_id = self.range_start
             self.mode = data.MODE_CLIENT
+            if self.cache is not None:
+                # ask the router for invalidations
+                self.sendString(data.ID_TRACK)
             self.callback.callback(self)
 
         elif self.mode == data.MODE_CLIENT:
             # handle answers
-            actionbyte = msg[0]
-            msg = msg[1:]
-            if actionbyte in (data.ID_ALLKEYS, data.ID_ANSWER, data.ID_NOTFOUND):
-                rids = msg[:data.MESSAGE_ID_SIZE]
-                rid = struct.unpack(data.MESSAGE_ID_FORMAT, rids)[0]
-                self.free.add(rid)
-                if rid not in self.requests:
-                    pass
-                else:
-                    d = self.requests[rid]
-                    del self.requests[rid]
-                    if actionbyte == data.ID_ANSWER:
-                        value = msg[data.MESSAGE_ID_SIZE:]
-                        d.callback(value)
-                    elif actionbyte == data.ID_NOTFOUND:
-                        f = Failure(KeyError("Key not found!"))
-                        d.errback(f)
-                    elif actionbyte == data.ID_ALLKEYS:
-                        keystring = msg[data.MESSAGE_ID_SIZE:]
-                        keylist = utils.keystring2list(keystring)
-                        d.callback(keylist)
-                    else:
-                        log.err("Logic Error! Expected all answer IDs to have been checked!")
+            handler = self.handlers.get(msg[0], None)
+            if handler is not None:
+                handler(self, msg)
             else:
                 log.err("Error: Unexpected Answer from server! Losing Connection...")
                 self.mode = data.MODE_ERROR
@@ -154,6 +189,93 @@ You can use the 'callback' attribute to get a deferred which will be called once
         else:
             log.err("Logic Error: set protocol to unknown mode!")
 
+    # answers of the router; the request id follows the first byte
+
+    def _pop_request(self, msg):
+        """frees the request id of the answer msg and returns the deferred of the request or None."""
+        rid = data.MESSAGE_ID_STRUCT.unpack_from(msg, 1)[0]
+        self.free.add(rid)
+        return self.requests.pop(rid, None)
+
+    def handle_answer(self, msg):
+        """the value of a get."""
+        d = self._pop_request(msg)
+        if d is not None:
+            value = msg[1 + data.MESSAGE_ID_SIZE:]
+            if self.compressed:
+                value = utils.decode_value(value)
+            d.callback(value)
+
+    def handle_notfound(self, msg):
+        """the key of a get does not exist."""
+        d = self._pop_request(msg)
+        if d is not None:
+            d.errback(Failure(KeyError("Key not found!")))
+
+    def handle_expired(self, msg):
+        """the deadline of a read passed."""
+        d = self._pop_request(msg)
+        if d is not None:
+            d.errback(Failure(TimeoutError("Deadline passed!")))
+
+    def handle_allkeys(self, msg):
+        """the keys of the database."""
+        d = self._pop_request(msg)
+        if d is not None:
+            d.callback(utils.keystring2list(msg, 1 + data.MESSAGE_ID_SIZE))
+
+    def handle_manswer(self, msg):
+        """the answer to a batch get."""
+        d = self._pop_request(msg)
+        if d is not None:
+            found = {}
+            for key, value in utils.resultstring2list(msg, 1 + data.MESSAGE_ID_SIZE):
+                if value is not None:
+                    if self.compressed:
+                        value = utils.decode_value(value)
+                    found[key] = value
+            d.callback(found)
+
+    def handle_scan_answer(self, msg):
+        """a page of a key scan."""
+        d = self._pop_request(msg)
+        if d is not None:
+            i = 1 + data.MESSAGE_ID_SIZE
+            cursor = data.CURSOR_STRUCT.unpack_from(msg, i)[0]
+            d.callback((cursor, utils.keystring2list(msg, i + data.CURSOR_SIZE)))
+
+    def handle_ack(self, msg):
+        """the answer to an acknowledged write."""
+        d = self._pop_request(msg)
+        if d is not None:
+            if msg[1 + data.MESSAGE_ID_SIZE] == data.STATE_OK:
+                d.callback(None)
+            else:
+                d.errback(Failure(WriteFailed("Not enough databases acknowledged the write!")))
+
+    def handle_invalidate(self, msg):
+        """keys in the near cache changed."""
+        if self.cache is not None:
+            for key in utils.keystring2list(msg, 1):
+                self.cache.invalidate(key)
+
+    def handle_flush(self, msg):
+        """the near cache is no longer valid."""
+        if self.cache is not None:
+            self.cache.clear()
+
+    handlers = {
+        data.ID_ANSWER: handle_answer,
+        data.ID_NOTFOUND: handle_notfound,
+        data.ID_EXPIRED: handle_expired,
+        data.ID_ALLKEYS: handle_allkeys,
+        data.ID_MANSWER: handle_manswer,
+        data.ID_SCANANSWER: handle_scan_answer,
+        data.ID_ACK: handle_ack,
+        data.ID_INVALIDATE: handle_invalidate,
+        data.ID_FLUSH: handle_flush,
+        }
+
     def get_id(self):
         """returns a request id."""
         if len(self.free) > 0:
@@ -165,33 +287,458 @@ You can use the 'callback' attribute to get a deferred which will be called once
             self.cur_id += 1
             return i
 
-    def get(self, key):
-        """returns a deferred which will be fired with the value of key."""
-        assert isinstance(key, str), "Expected key to be a string!"
-        d = Deferred()
+    def _request(self, actionbyte, body, timeout=None):
+        """
+sends a request and returns a cancellable deferred for the answer.
+If timeout is not None, the request is sent with a deadline and the deferred fails with a TimeoutError once it passed.
+"""
         rid = self.get_id()
-        rids = struct.pack(data.MESSAGE_ID_FORMAT, rid)
+        rids = data.MESSAGE_ID_STRUCT.pack(rid)
+        d = Deferred(functools.partial(self._cancel, rid))
         self.requests[rid] = d
-        self.sendString(data.ID_GET + rids + key)
+        msg = actionbyte + rids + body
+        if timeout is not None:
+            budget = min(int(timeout * 1000), data.MAX_DEADLINE)
+            msg = data.ID_DEADLINE + data.DEADLINE_STRUCT.pack(budget) + msg
+            d.addTimeout(timeout, self.reactor)
+        self.sendString(msg)
+        return d
+
+    def _cancel(self, rid, d):
+        """called when the deferred d of the request rid was cancelled."""
+        if self.requests.pop(rid, None) is not None and self.mode == data.MODE_CLIENT:
+            # the router still answers, which frees rid
+            self.sendString(data.ID_CANCEL + data.MESSAGE_ID_STRUCT.pack(rid))
+
+    def connectionLost(self, reason=None):
+        """called when the connection was lost."""
+        if self.cache is not None:
+            # invalidations can not be received anymore
+            self.cache.clear()
+        if self.pool is not None:
+            self.pool.connection_lost(self)
+
+    def get(self, key, timeout=None):
+        """returns a deferred which will be fired with the value of key."""
+        assert isinstance(key, str), "Expected key to be a string!"
+        if self.cache is not None:
+            try:
+                return succeed(self.cache.get(key))
+            except KeyError:
+                pass
+        d = self._request(data.ID_GET, key, timeout)
+        if self.cache is not None:
+            d.addBoth(self._fill_cache, {key: self.cache.begin_fill(key)})
         return d
 
-    def set(self, key, value):
-        """sets key to value."""
+    def _fill_cache(self, result, tokens, found=None):
+        """
+adds the result of a get or batch get to the cache.
+tokens maps the requested keys to their fill tokens. found contains the values already found in the cache.
+"""
+        if isinstance(result, Failure):
+            for key, token in tokens.items():
+                self.cache.end_fill(key, token)
+            return result
+        if found is None:
+            # single get
+            key, token = tokens.items()[0]
+            self.cache.end_fill(key, token, result)
+            return result
+        for key, token in tokens.items():
+            self.cache.end_fill(key, token, result.get(key, None))
+        found.update(result)
+        return found
+
+    def hit_ratio(self):
+        """returns the ratio of gets answered by the near cache."""
+        if self.cache is None:
+            return 0.0
+        return self.cache.hit_ratio()
+
+    def set(self, key, value, acks=0, timeout=None):
+        """
+sets key to value.
+If acks is not 0, returns a deferred which will be fired once acks databases synced the write to the disk.
+"""
         assert isinstance(key, str) and isinstance(value, str), "Expected key/value to be strings!"
+        if self.cache is not None:
+            self.cache.set(key, value)
         keylength = len(key)
-        keylengthstring = struct.pack(data.MESSAGE_KEY_LENGTH_FORMAT, keylength)
-        self.sendString(data.ID_SET + keylengthstring + key + value)
+        keylengthstring = data.MESSAGE_KEY_LENGTH_STRUCT.pack(keylength)
+        if self.compressed:
+            value = utils.encode_value(value, self.compression, self.compression_threshold)
+        if acks > 0:
+            return self._acked_write(data.ID_SET + keylengthstring + key + value, acks, timeout)
+        # the value is not copied into the message
+        utils.send_parts(self, [data.ID_SET, keylengthstring, key, value])
 
-    def delete(self, key):
-        """deletes the value for key and key."""
+    def delete(self, key, acks=0, timeout=None):
+        """
+deletes the value for key and key.
+If acks is not 0, returns a deferred which will be fired once acks databases synced the delete to the disk.
+"""
         assert isinstance(key, str), "Expected key to be a string!"
-        self.sendString(data.ID_DEL + key)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        msg = data.ID_DEL + key
+        if acks > 0:
+            return self._acked_write(msg, acks, timeout)
+        self.sendString(msg)
+
+    def _acked_write(self, msg, acks, timeout=None):
+        """
+sends the write msg, asking for acks acknowledgements. Returns a deferred for the acknowledgement.
+A timeout only stops waiting for the acknowledgement; the write is performed anyway.
+"""
+        assert acks < 256, "Expected acks to be less than 256!"
+        d = self._request(data.ID_ACKWRITE, chr(acks) + msg)
+        if timeout is not None:
+            d.addTimeout(timeout, self.reactor)
+        return d
+
+    def routers(self):
+        """returns a deferred which will be fired with a list of the endpoint descriptions of all routers."""
+        return self._request(data.ID_ROUTERS, "")
+
+    def stats(self, timeout=None):
+        """returns a deferred which will be fired with a dict of the statistics of the router and its databases."""
+        return self._request(data.ID_STATS, "", timeout).addCallback(json.loads)
 
-    def getkeys(self):
+    def getkeys(self, timeout=None):
         """returns a deferred which will be fired with a list of all keys"""
-        d = Deferred()
-        rid = self.get_id()
-        rids = struct.pack(data.MESSAGE_ID_FORMAT, rid)
-        self.requests[rid] = d
-        self.sendString(data.ID_GETKEYS + rids)
+        return self._request(data.ID_GETKEYS, "", timeout)
+
+    def mget(self, keys, timeout=None):
+        """returns a deferred which will be fired with a dict mapping the found keys to their values."""
+        assert all(isinstance(key, str) for key in keys), "Expected keys to be strings!"
+        if self.cache is not None:
+            found = {}
+            missing = []
+            for key in keys:
+                try:
+                    found[key] = self.cache.get(key)
+                except KeyError:
+                    missing.append(key)
+            if len(missing) == 0:
+                return succeed(found)
+            keys = missing
+        d = self._request(data.ID_MGET, utils.keylist2string(keys), timeout)
+        if self.cache is not None:
+            tokens = dict([(key, self.cache.begin_fill(key)) for key in keys])
+            d.addBoth(self._fill_cache, tokens, found)
         return d
+
+    def mset(self, pairs):
+        """sets multiple keys. pairs may be a dict or a list of (key, value) tuples."""
+        if isinstance(pairs, dict):
+            pairs = pairs.items()
+        assert all(isinstance(key, str) and isinstance(value, str) for key, value in pairs), "Expected keys/values to be strings!"
+        if self.cache is not None:
+            for key, value in pairs:
+                self.cache.set(key, value)
+        if self.compressed:
+            pairs = [(key, utils.encode_value(value, self.compression, self.compression_threshold)) for key, value in pairs]
+        self.sendString(data.ID_MSET + utils.pairlist2string(pairs))
+
+    def mdelete(self, keys):
+        """deletes the values for multiple keys."""
+        assert all(isinstance(key, str) for key in keys), "Expected keys to be strings!"
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key)
+        self.sendString(data.ID_MDEL + utils.keylist2string(keys))
+
+    def scan(self, cursor=0, count=data.DEFAULT_SCAN_COUNT, timeout=None):
+        """
+returns a deferred which will be fired with a tuple (next cursor, keys) containing up to count keys.
+Start with a cursor of 0 and pass the returned cursor to the next call until it is 0 again.
+Fails with a KeyError if the scan can not be continued.
+"""
+        return self._request(data.ID_SCAN, data.SCAN_STRUCT.pack(cursor, count), timeout)
+
+    def keyrange(self, start="", end=None, limit=data.DEFAULT_SCAN_COUNT, reverse=False, timeout=None):
+        """
+returns a deferred which will be fired with a sorted list of up to limit keys in [start, end), the largest first
+if reverse is True. end None means no upper bound and a limit of 0 means no limit.
+To get the next page, pass the last key + '\\x00' as start or, if reverse is True, the last key as end.
+Fails with a KeyError if a database was lost during the request.
+"""
+        assert isinstance(start, str) and (end is None or isinstance(end, str)), "Expected keys to be strings!"
+        if not self.keyranges:
+            return fail(ProtocolError("The router does not support key ranges!"))
+        return self._request(data.ID_KEYRANGE, utils.keyrange2string(start, end, limit, reverse), timeout)
+
+    def prefix(self, prefix, limit=data.DEFAULT_SCAN_COUNT, reverse=False, timeout=None):
+        """returns a deferred which will be fired with a sorted list of up to limit keys starting with prefix. See keyrange()."""
+        return self.keyrange(prefix, utils.prefix_end(prefix), limit, reverse, timeout)
+
+    @inlineCallbacks
+    def stream_keys(self, callback, count=data.DEFAULT_SCAN_COUNT):
+        """
+calls callback with a list of keys for every chunk of keys.
+Unlike getkeys(), the keys are never transferred as a whole.
+Returns a deferred which will be fired once all chunks were received.
+"""
+        cursor = 0
+        while True:
+            cursor, keys = yield self.scan(cursor, count)
+            if len(keys) > 0:
+                yield callback(keys)
+            if cursor == 0:
+                break
+
+
+class RouterConnection(object):
+    """The connection of a ClientPool to one router."""
+    def __init__(self, name, index):
+        self.name = name  # endpoint description
+        self.index = index  # position in the pool; used to route scan cursors
+        self.proto = None  # the connected protocol
+        self.delay = data.RECONNECT_DELAY
+        self.stopped = False
+
+
+class ClientPool(object):
+    """
+Spreads the requests of a client over several routers.
+endpoints is a list of endpoint descriptions of routers. More routers are discovered by asking the connected
+routers for their peers; lost routers are reconnected.
+All requests for a key are sent to the same router while it is available, so that the writes to a key
+keep their order. The routers are chosen by rendezvous hashing over the connected routers, so clients
+should use the same descriptions the routers were started with.
+The other arguments are passed to the ClientProtocol of every router.
+Use start() to get a deferred which will be called once the first router is connected.
+"""
+    def __init__(
+        self, reactor, endpoints, password, cache_size=0, cache_max_age=data.DEFAULT_NEAR_CACHE_MAX_AGE,
+        compression=None, compression_threshold=data.DEFAULT_COMPRESSION_THRESHOLD,
+        ):
+        self.reactor = reactor
+        self.password = password
+        self.cache_size = cache_size
+        self.cache_max_age = cache_max_age
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.seeds = list(endpoints)
+        self.routers = collections.OrderedDict()  # name -> RouterConnection
+        self.stopped = False
+        self.refresher = LoopingCall(self.refresh)
+        self.callback = Deferred()  # will be called once the first router is connected
+
+    def start(self):
+        """connects to the routers. Returns a deferred which will be fired once the first router is connected."""
+        for name in self.seeds:
+            self.add_router(name)
+        self.refresher.start(data.ROUTER_REFRESH_INTERVAL, now=False)
+        return self.callback
+
+    def stop(self):
+        """disconnects from all routers."""
+        self.stopped = True
+        if self.refresher.running:
+            self.refresher.stop()
+        for router in self.routers.values():
+            if router.proto is not None:
+                router.proto.transport.loseConnection()
+
+    def add_router(self, name):
+        """connects to the router described by name unless it is already known."""
+        if name in self.routers:
+            return
+        if len(self.routers) >= data.MAX_ROUTERS:
+            log.err("Too many routers, ignoring '{n}'!".format(n=name))
+            return
+        router = RouterConnection(name, len(self.routers))
+        self.routers[name] = router
+        self.connect(router)
+
+    def connect(self, router):
+        """opens a connection to router."""
+        if self.stopped or router.stopped:
+            return
+        proto = ClientProtocol(
+            self.password, cache_size=self.cache_size, cache_max_age=self.cache_max_age, reactor=self.reactor,
+            compression=self.compression, compression_threshold=self.compression_threshold,
+            )
+        proto.pool = self
+        proto.callback.addCallbacks(self._connected, self._failed, callbackArgs=(router, ), errbackArgs=(router, ))
+        endpoint = endpoints.clientFromString(self.reactor, router.name)
+        d = endpoints.connectProtocol(endpoint, proto)
+        d.addErrback(self._connect_failed, router)
+
+    def _connected(self, proto, router):
+        """called when the handshake with router finished."""
+        router.proto = proto
+        router.delay = data.RECONNECT_DELAY
+        proto.routers().addCallbacks(self._got_routers, log.err)
+        if not self.callback.called:
+            self.callback.callback(self)
+        return proto
+
+    def _failed(self, f, router):
+        """called when the handshake with router failed; reconnecting would fail again."""
+        log.err(f)
+        router.stopped = True
+
+    def _connect_failed(self, f, router):
+        """called when router could not be reached."""
+        log.msg("Could not connect to router '{n}': {e}".format(n=router.name, e=f.getErrorMessage()))
+        self.retry(router)
+
+    def _got_routers(self, names):
+        """adds the routers known by a router."""
+        for name in names:
+            self.add_router(name)
+
+    def connection_lost(self, proto):
+        """called by a protocol of the pool when its connection was lost."""
+        for router in self.routers.values():
+            if router.proto is proto:
+                router.proto = None
+                self.retry(router)
+
+    def retry(self, router):
+        """reconnects to router after a delay."""
+        if self.stopped or router.stopped:
+            return
+        self.reactor.callLater(router.delay, self.connect, router)
+        router.delay = min(router.delay * 2, data.MAX_RECONNECT_DELAY)
+
+    def refresh(self):
+        """asks a connected router for the list of routers."""
+        connected = self.connected()
+        if len(connected) > 0:
+            random.choice(connected).proto.routers().addCallbacks(self._got_routers, log.err)
+
+    def connected(self):
+        """returns a list of the connected routers."""
+        return [router for router in self.routers.values() if router.proto is not None]
+
+    def choose(self, key):
+        """returns the protocol of the router responsible for key."""
+        best = None
+        best_score = None
+        for router in self.routers.values():
+            if router.proto is None:
+                continue
+            score = ring.hash_key(router.name + "#" + key)
+            if best is None or score > best_score:
+                best, best_score = router, score
+        if best is None:
+            raise NotConnected("No router available!")
+        return best.proto
+
+    def group(self, keys):
+        """returns a dict mapping the protocols of the routers to the keys they are responsible for."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.choose(key), []).append(key)
+        return groups
+
+    def hit_ratio(self):
+        """returns the ratio of gets answered by the near caches."""
+        ratios = [router.proto.hit_ratio() for router in self.connected()]
+        if len(ratios) == 0:
+            return 0.0
+        return sum(ratios) / len(ratios)
+
+    def get(self, key, timeout=None):
+        """returns a deferred which will be fired with the value of key."""
+        try:
+            return self.choose(key).get(key, timeout)
+        except NotConnected:
+            return fail()
+
+    def set(self, key, value, acks=0, timeout=None):
+        """sets key to value. See ClientProtocol.set()."""
+        try:
+            return self.choose(key).set(key, value, acks, timeout)
+        except NotConnected:
+            return fail()
+
+    def delete(self, key, acks=0, timeout=None):
+        """deletes the value for key and key. See ClientProtocol.delete()."""
+        try:
+            return self.choose(key).delete(key, acks, timeout)
+        except NotConnected:
+            return fail()
+
+    def getkeys(self, timeout=None):
+        """returns a deferred which will be fired with a list of all keys"""
+        connected = self.connected()
+        if len(connected) == 0:
+            return fail(NotConnected("No router available!"))
+        return random.choice(connected).proto.getkeys(timeout)
+
+    def keyrange(self, start="", end=None, limit=data.DEFAULT_SCAN_COUNT, reverse=False, timeout=None):
+        """returns a deferred which will be fired with a sorted list of the keys in [start, end). See ClientProtocol.keyrange()."""
+        connected = self.connected()
+        if len(connected) == 0:
+            return fail(NotConnected("No router available!"))
+        return random.choice(connected).proto.keyrange(start, end, limit, reverse, timeout)
+
+    def prefix(self, prefix, limit=data.DEFAULT_SCAN_COUNT, reverse=False, timeout=None):
+        """returns a deferred which will be fired with a sorted list of the keys starting with prefix. See ClientProtocol.keyrange()."""
+        return self.keyrange(prefix, utils.prefix_end(prefix), limit, reverse, timeout)
+
+    @inlineCallbacks
+    def stats(self, timeout=None):
+        """returns a deferred which will be fired with a dict mapping the names of the connected routers to their statistics."""
+        connected = self.connected()
+        results = yield DeferredList([router.proto.stats(timeout) for router in connected], fireOnOneErrback=True)
+        returnValue(dict([(router.name, result) for router, (success, result) in zip(connected, results)]))
+
+    @inlineCallbacks
+    def mget(self, keys, timeout=None):
+        """returns a deferred which will be fired with a dict mapping the found keys to their values."""
+        groups = self.group(keys)
+        results = yield DeferredList([proto.mget(protokeys, timeout) for proto, protokeys in groups.items()], fireOnOneErrback=True)
+        found = {}
+        for success, result in results:
+            found.update(result)
+        returnValue(found)
+
+    def mset(self, pairs):
+        """sets multiple keys. pairs may be a dict or a list of (key, value) tuples."""
+        if isinstance(pairs, dict):
+            pairs = pairs.items()
+        values = dict(pairs)
+        for proto, keys in self.group(values.keys()).items():
+            proto.mset([(key, values[key]) for key in keys])
+
+    def mdelete(self, keys):
+        """deletes the values for multiple keys."""
+        for proto, protokeys in self.group(keys).items():
+            proto.mdelete(protokeys)
+
+    @inlineCallbacks
+    def scan(self, cursor=0, count=data.DEFAULT_SCAN_COUNT, timeout=None):
+        """
+returns a deferred which will be fired with a tuple (next cursor, keys) containing up to count keys.
+The scan runs on a single router, which is encoded in the cursor. See ClientProtocol.scan().
+"""
+        if cursor == 0:
+            connected = self.connected()
+            if len(connected) == 0:
+                raise NotConnected("No router available!")
+            router = random.choice(connected)
+        else:
+            router = self.routers.values()[cursor % data.MAX_ROUTERS]
+            if router.proto is None:
+                raise KeyError("Router of the scan lost!")
+        cursor, keys = yield router.proto.scan(cursor // data.MAX_ROUTERS, count, timeout)
+        if cursor != 0:
+            cursor = cursor * data.MAX_ROUTERS + router.index
+        returnValue((cursor, keys))
+
+    @inlineCallbacks
+    def stream_keys(self, callback, count=data.DEFAULT_SCAN_COUNT):
+        """calls callback with a list of keys for every chunk of keys. See ClientProtocol.stream_keys()."""
+        cursor = 0
+        while True:
+            cursor, keys = yield self.scan(cursor, count)
+            if len(keys) > 0:
+                yield callback(keys)
+            if cursor == 0:
+                break
@@ -1,22 +1,24 @@
 """utility functions"""
-import struct
+import math
+import heapq
+import bisect
+import zlib
 
 from twisted.internet.defer import Deferred
 
 from . import data
 
 
-def keystring2list(s):
-    """convert a string of keys to a list of keys."""
-    if len(s) == 0:
-        return []
+def keystring2list(s, offset=0):
+    """convert a string of keys starting at offset to a list of keys."""
     keys = []
-    i = 0
-    while i < len(s):
-        keylength = struct.unpack(data.MESSAGE_KEY_LENGTH_FORMAT, s[i:i + data.MESSAGE_KEY_LENGTH_SIZE])[0]
+    i = offset
+    end = len(s)
+    unpack_from = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from
+    while i < end:
+        keylength = unpack_from(s, i)[0]
         i += data.MESSAGE_KEY_LENGTH_SIZE
-        key = s[i:i + keylength]
-        keys.append(key)
+        keys.append(s[i:i + keylength])
         i += keylength
     return keys
 
@@ -24,13 +26,362 @@ def keystring2list(s):
 def keylist2string(keys):
     """converts a list of keys to a string."""
     answer = []
+    pack = data.MESSAGE_KEY_LENGTH_STRUCT.pack
     for key in keys:
-        keylength = len(key)
-        lengthdata = struct.pack(data.MESSAGE_KEY_LENGTH_FORMAT, keylength)
-        answer += [lengthdata, str(key)]
+        key = str(key)
+        answer += [pack(len(key)), key]
+    return "".join(answer)
+
+
+def pairstring2list(s, offset=0):
+    """convert a string of key/value pairs starting at offset to a list of (key, value) tuples."""
+    pairs = []
+    i = offset
+    end = len(s)
+    unpack_key = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from
+    unpack_value = data.MESSAGE_VALUE_LENGTH_STRUCT.unpack_from
+    while i < end:
+        keylength = unpack_key(s, i)[0]
+        i += data.MESSAGE_KEY_LENGTH_SIZE
+        key = s[i:i + keylength]
+        i += keylength
+        valuelength = unpack_value(s, i)[0]
+        i += data.MESSAGE_VALUE_LENGTH_SIZE
+        pairs.append((key, s[i:i + valuelength]))
+        i += valuelength
+    return pairs
+
+
+def pairlist2string(pairs):
+    """converts a list of (key, value) tuples to a string."""
+    answer = []
+    pack_key = data.MESSAGE_KEY_LENGTH_STRUCT.pack
+    pack_value = data.MESSAGE_VALUE_LENGTH_STRUCT.pack
+    for key, value in pairs:
+        key = str(key)
+        value = str(value)
+        answer += [pack_key(len(key)), key, pack_value(len(value)), value]
     return "".join(answer)
 
 
+def resultstring2list(s, offset=0):
+    """
+convert the answer to a batch get starting at offset to a list of (key, value) tuples.
+value is None if the key was not found.
+"""
+    results = []
+    i = offset
+    end = len(s)
+    unpack_key = data.MESSAGE_KEY_LENGTH_STRUCT.unpack_from
+    unpack_value = data.MESSAGE_VALUE_LENGTH_STRUCT.unpack_from
+    while i < end:
+        state = s[i]
+        i += 1
+        keylength = unpack_key(s, i)[0]
+        i += data.MESSAGE_KEY_LENGTH_SIZE
+        key = s[i:i + keylength]
+        i += keylength
+        if state == data.ID_NOTFOUND:
+            results.append((key, None))
+            continue
+        valuelength = unpack_value(s, i)[0]
+        i += data.MESSAGE_VALUE_LENGTH_SIZE
+        results.append((key, s[i:i + valuelength]))
+        i += valuelength
+    return results
+
+
+def resultlist2string(results):
+    """converts a list of (key, value) tuples to the answer of a batch get. value should be None for missing keys."""
+    answer = []
+    pack_key = data.MESSAGE_KEY_LENGTH_STRUCT.pack
+    pack_value = data.MESSAGE_VALUE_LENGTH_STRUCT.pack
+    for key, value in results:
+        key = str(key)
+        if value is None:
+            answer += [data.ID_NOTFOUND, pack_key(len(key)), key]
+        else:
+            value = str(value)
+            answer += [data.ID_ANSWER, pack_key(len(key)), key, pack_value(len(value)), value]
+    return "".join(answer)
+
+
+def keyrange2string(start, end=None, limit=0, reverse=False):
+    """converts the arguments of a key range request to a string."""
+    flags = 0
+    if reverse:
+        flags |= data.KEYRANGE_REVERSE
+    bounds = [start]
+    if end is not None:
+        bounds.append(end)
+    return data.KEYRANGE_STRUCT.pack(limit, flags) + keylist2string(bounds)
+
+
+def string2keyrange(s, offset=0):
+    """converts a key range request starting at offset to a tuple (start, end, limit, reverse). end is None if unbounded."""
+    limit, flags = data.KEYRANGE_STRUCT.unpack_from(s, offset)
+    bounds = keystring2list(s, offset + data.KEYRANGE_SIZE)
+    end = None
+    if len(bounds) > 1:
+        end = bounds[1]
+    return bounds[0], end, limit, bool(flags & data.KEYRANGE_REVERSE)
+
+
+def prefix_end(prefix):
+    """returns the smallest key greater than all keys starting with prefix or None if there is none."""
+    prefix = prefix.rstrip("\xff")
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def filter_keyrange(keys, start, end=None, limit=0, reverse=False):
+    """
+returns a sorted list of the keys in [start, end), the largest first if reverse is True.
+end None means no upper bound and a limit of 0 means no limit.
+"""
+    keys = sorted([key for key in keys if key >= start and (end is None or key < end)], reverse=reverse)
+    if limit > 0:
+        del keys[limit:]
+    return keys
+
+
+def keyrange(db, start, end=None, limit=0, reverse=False):
+    """
+returns a sorted list of the keys of db in [start, end), using db.keyrange() if the database provides it.
+Otherwise all keys are filtered. If db.getkeys() returns a deferred, a deferred for the list is returned.
+"""
+    if hasattr(db, "keyrange"):
+        return db.keyrange(start, end, limit, reverse)
+    keys = db.getkeys()
+    if isinstance(keys, Deferred):
+        return keys.addCallback(filter_keyrange, start, end, limit, reverse)
+    return filter_keyrange(keys, start, end, limit, reverse)
+
+
+def merge_keys(lists, reverse=False):
+    """merges the sorted lists of keys into a sorted list without duplicates. If reverse is True, the lists are sorted descending."""
+    if reverse:
+        return merge_keys([keys[::-1] for keys in lists])[::-1]
+    merged = []
+    for key in heapq.merge(*lists):
+        if len(merged) == 0 or merged[-1] != key:
+            merged.append(key)
+    return merged
+
+
+class SortedKeys(object):
+    """
+A sorted set of keys for range queries of databases without an order of their own.
+The keys are kept in a list of sorted blocks of up to data.SORTED_BLOCK_SIZE keys, so that adding
+or removing a key only moves the keys of one block.
+"""
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        half = data.SORTED_BLOCK_SIZE // 2
+        self.blocks = [keys[i:i + half] for i in xrange(0, len(keys), half)]
+        self.maxes = [block[-1] for block in self.blocks]  # the last key of every block
+        self.length = len(keys)
+
+    def __len__(self):
+        return self.length
+
+    def _position(self, key):
+        """returns (block, index in block) of the first key not less than key."""
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.blocks):
+            return i, 0
+        return i, bisect.bisect_left(self.blocks[i], key)
+
+    def add(self, key):
+        """adds key."""
+        i, j = self._position(key)
+        if i == len(self.blocks):
+            if i == 0:
+                self.blocks.append([])
+                self.maxes.append(key)
+            # larger than all keys
+            i -= 1
+            j = len(self.blocks[i])
+        block = self.blocks[i]
+        if j < len(block) and block[j] == key:
+            return
+        block.insert(j, key)
+        self.length += 1
+        self.maxes[i] = block[-1]
+        if len(block) > data.SORTED_BLOCK_SIZE:
+            half = len(block) // 2
+            self.blocks.insert(i + 1, block[half:])
+            del block[half:]
+            self.maxes[i:i + 1] = [block[-1], self.blocks[i + 1][-1]]
+
+    def discard(self, key):
+        """removes key if present."""
+        i, j = self._position(key)
+        if i == len(self.blocks):
+            return
+        block = self.blocks[i]
+        if j == len(block) or block[j] != key:
+            return
+        del block[j]
+        self.length -= 1
+        if len(block) == 0:
+            del self.blocks[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = block[-1]
+
+    def range(self, start, end=None, limit=0, reverse=False):
+        """returns a sorted list of the keys in [start, end). See filter_keyrange()."""
+        first = self._position(start)
+        if end is None:
+            last = (len(self.blocks), 0)
+        else:
+            last = self._position(end)
+        parts = []  # (block, start index, end index)
+        for i in xrange(first[0], min(last[0] + 1, len(self.blocks))):
+            lo = first[1] if i == first[0] else 0
+            hi = last[1] if i == last[0] else len(self.blocks[i])
+            parts.append((i, lo, hi))
+        if reverse:
+            parts.reverse()
+        keys = []
+        for i, lo, hi in parts:
+            part = self.blocks[i][lo:hi]
+            if reverse:
+                part.reverse()
+            keys += part
+            if limit > 0 and len(keys) >= limit:
+                del keys[limit:]
+                break
+        return keys
+
+
+def encode_value(value, level=None, threshold=data.DEFAULT_COMPRESSION_THRESHOLD):
+    """
+prepends the flag byte used on connections with data.CAP_COMPRESSION to value.
+If level is not None, values of at least threshold bytes are compressed with zlib at this level
+unless that does not make them smaller.
+"""
+    if level is not None and len(value) >= threshold:
+        compressed = zlib.compress(value, level)
+        if len(compressed) < len(value):
+            return data.VALUE_ZLIB + compressed
+    return data.VALUE_RAW + value
+
+
+def decode_value(value):
+    """returns the original value of a value encoded by encode_value()."""
+    flag = value[:1]
+    if flag == data.VALUE_RAW:
+        return value[1:]
+    elif flag == data.VALUE_ZLIB:
+        return zlib.decompress(buffer(value, 1))
+    raise ValueError("Unknown value encoding: {f}!".format(f=repr(flag)))
+
+
+def convert_results(s, f):
+    """applies f to every value in the answer to a batch get s and returns the new answer."""
+    return resultlist2string([(key, f(value) if value is not None else None) for key, value in resultstring2list(s)])
+
+
+class Histogram(object):
+    """
+Counts latencies in logarithmic buckets, each data.HISTOGRAM_BASE times wider than the previous one.
+Histograms, e.g. those of several load generators, can be merged.
+"""
+    def __init__(self):
+        self.counts = {}  # bucket -> number of latencies
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, latency):
+        """adds a latency in seconds."""
+        bucket = int(math.log(max(latency * 10**6, 1.0), data.HISTOGRAM_BASE))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, latency)
+
+    def merge(self, other):
+        """adds the latencies of the histogram other."""
+        for bucket, n in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """returns the latency in seconds which p percent of the latencies do not exceed."""
+        if self.total == 0:
+            return 0.0
+        needed = self.total * p / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= needed:
+                # upper bound of the bucket
+                return min(data.HISTOGRAM_BASE ** (bucket + 1) / 10**6, self.max)
+        return self.max
+
+    def to_dict(self):
+        """returns the histogram as a dict which can be serialized to JSON."""
+        return {"counts": dict([(str(bucket), n) for bucket, n in self.counts.items()]), "max": self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        """creates a histogram from the result of to_dict()."""
+        histogram = cls()
+        histogram.counts = dict([(int(bucket), n) for bucket, n in d["counts"].items()])
+        histogram.total = sum(histogram.counts.values())
+        histogram.max = d["max"]
+        return histogram
+
+    def summary(self):
+        """returns a dict with the number of latencies and their percentiles in milliseconds."""
+        result = {"count": self.total, "max": round(self.max * 1000, 3)}
+        for p in data.HISTOGRAM_PERCENTILES:
+            name = "p" + str(p).replace(".", "")
+            result[name] = round(self.percentile(p) * 1000, 3)
+        return result
+
+
+def send_parts(proto, parts):
+    """
+sends the concatenation of the strings in parts as a single message of proto, an IntNStringReceiver
+using data.MESSAGE_LENGTH_FORMAT. Unlike sendString(), the parts are not copied into a new string first.
+"""
+    proto.transport.writeSequence([data.MESSAGE_LENGTH_STRUCT.pack(sum([len(part) for part in parts]))] + parts)
+
+
+def iterkeys(db):
+    """
+returns an iterator over the keys of db, using db.iterkeys() if the database provides it.
+If db.getkeys() returns a deferred, a deferred for the iterator is returned.
+"""
+    if hasattr(db, "iterkeys"):
+        return db.iterkeys()
+    keys = db.getkeys()
+    if isinstance(keys, Deferred):
+        return keys.addCallback(iter)
+    return iter(keys)
+
+
+def iter_sorted(keyrange, batch=data.ITERKEYS_BATCH):
+    """
+returns an iterator over the keys returned by keyrange(start, end, limit), reading batch keys at a time in sorted order.
+Every batch starts after the last key returned, so keys stored during the whole iteration are returned exactly once
+and only one batch is kept in memory.
+"""
+    start = ""
+    while True:
+        keys = keyrange(start, None, batch)
+        for key in keys:
+            yield key
+        if len(keys) < batch:
+            return
+        # the smallest key greater than the last one
+        start = keys[-1] + "\x00"
+
+
 def dsleep(reactor, s):
     """return a deferred, which will be called after s seconds."""
     d = Deferred()
@@ -0,0 +1,108 @@
+"""helpers for tests running a router, databases and clients in the same process."""
+from twisted.internet import reactor, endpoints
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.trial import unittest
+
+from kvndb import router, dbproto, txclient, utils
+from kvndb.ramdb import RamDatabase
+
+
+def sleep(s):
+    """returns a deferred which will be called after s seconds."""
+    return utils.dsleep(reactor, s)
+
+
+def notify_lost(protocol):
+    """returns a deferred which will be called once the connection of protocol was lost."""
+    d = Deferred()
+    connectionLost = protocol.connectionLost
+
+    def lost(reason=None):
+        connectionLost(reason)
+        d.callback(None)
+    protocol.connectionLost = lost
+    return d
+
+
+def ignore(protocol, msg, i, deadline):
+    """a message handler which drops the message."""
+    pass
+
+
+def drop_messages(protocol, opcodes):
+    """makes the database protocol drop all messages of the router with one of opcodes."""
+    protocol.handlers = dict(protocol.handlers)
+    for opcode in opcodes:
+        protocol.handlers[opcode] = ignore
+
+
+class ClusterTestCase(unittest.TestCase):
+    """
+A test case running a router on a local port.
+The databases and clients started by a test are disconnected once it is finished.
+"""
+    timeout = 30
+
+    @inlineCallbacks
+    def start_router(self, **kwargs):
+        """starts a router and returns its factory."""
+        self.factory = router.RouterFactory(reactor, None, **kwargs)
+        self.port = yield endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1").listen(self.factory)
+        self.addCleanup(self.stop_router)
+        returnValue(self.factory)
+
+    @inlineCallbacks
+    def stop_router(self):
+        """waits for a scheduled rebalance and stops listening."""
+        while self.factory.rebalance_scheduled or self.factory.rebalancing:
+            yield sleep(0.1)
+        yield self.port.stopListening()
+
+    @inlineCallbacks
+    def connect(self, protocol):
+        """connects protocol to the router and waits for the handshake."""
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1", self.port.getHost().port)
+        yield endpoints.connectProtocol(endpoint, protocol)
+        lost = notify_lost(protocol)
+        self.addCleanup(lambda: self.disconnect(protocol, lost))
+        yield protocol.callback
+        returnValue(protocol)
+
+    def disconnect(self, protocol, lost):
+        """closes the connection of protocol. Returns a deferred which will be called once it is closed."""
+        if protocol.transport.connected:
+            protocol.transport.loseConnection()
+        return lost
+
+    @inlineCallbacks
+    def start_db(self, db=None, **kwargs):
+        """
+connects a database to the router, waits until it serves and returns its protocol on the router.
+kwargs are passed to the DatabaseClientProtocol.
+"""
+        if db is None:
+            db = RamDatabase([])
+        known = set(self.factory.servers)
+        protocol = yield self.connect(dbproto.DatabaseClientProtocol(db, None, reactor, **kwargs))
+        while len(set(self.factory.servers) - known) == 0:
+            yield sleep(0.05)
+        server = list(set(self.factory.servers) - known)[0]
+        returnValue((protocol, server))
+
+    @inlineCallbacks
+    def stop_db(self, protocol, server):
+        """disconnects the database of protocol and waits until the router dropped its connection server."""
+        protocol.transport.loseConnection()
+        while server in self.factory.servers or server in self.factory.syncing:
+            yield sleep(0.05)
+
+    def start_client(self, **kwargs):
+        """connects a client to the router. Returns a deferred which will be called with the ClientProtocol."""
+        return self.connect(txclient.ClientProtocol(None, **kwargs))
+
+    @inlineCallbacks
+    def wait_for_rebalance(self):
+        """waits until the data was moved to the current databases."""
+        yield sleep(0.05)
+        while self.factory.rebalance_scheduled or self.factory.rebalancing:
+            yield sleep(0.1)
@@ -0,0 +1,68 @@
+"""tests for running the calls of blocking databases in a pool of threads."""
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from kvndb.asyncdb import ThreadedDatabase
+
+from .helpers import sleep
+
+
+class SlowDatabase(object):
+    """a database whose reads block until they are released."""
+    threadsafe = True
+
+    def __init__(self):
+        self.data = {}
+        self.released = threading.Event()
+        self.calls = []  # names of the finished calls
+
+    def get(self, key):
+        """returns the value for key once the reads are released."""
+        self.released.wait()
+        self.calls.append("get")
+        return self.data[key]
+
+    def set(self, key, value):
+        """sets key to value"""
+        self.data[key] = value
+        self.calls.append("set")
+
+    def reset(self):
+        """resets the database."""
+        self.data = {}
+        self.calls.append("reset")
+
+    def close(self):
+        """closes the database."""
+        pass
+
+
+class ThreadedDatabaseTests(unittest.TestCase):
+    """tests the order in which ThreadedDatabase runs the calls."""
+
+    def setUp(self):
+        self.db = SlowDatabase()
+        self.threaded = ThreadedDatabase(self.db, reactor)
+        self.addCleanup(self.close)
+
+    def close(self):
+        """releases the reads and closes the database."""
+        self.db.released.set()
+        return self.threaded.close()
+
+    @inlineCallbacks
+    def test_reset_waits_for_reads(self):
+        """a reset waits for the reads which were pending when it was requested."""
+        yield self.threaded.set("key", "value")
+        read = self.threaded.get("key")
+        reset = self.threaded.reset()
+        yield sleep(0.05)
+        self.assertEqual(self.db.calls, ["set"])
+        self.db.released.set()
+        value = yield read
+        self.assertEqual(value, "value")
+        yield reset
+        self.assertEqual(self.db.calls, ["set", "get", "reset"])
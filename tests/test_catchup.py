@@ -0,0 +1,86 @@
+"""tests for catching up databases which reconnect to the router from its write log."""
+from twisted.internet.defer import inlineCallbacks
+
+from kvndb import dbproto
+from kvndb.ramdb import RamDatabase
+
+from .helpers import ClusterTestCase
+
+
+class CatchupTests(ClusterTestCase):
+    """tests that a reconnecting database either receives the writes it missed or is reset."""
+
+    @inlineCallbacks
+    def start_cluster(self, write_log_size):
+        """starts a router with a database and a client and connects the database self.db, which is then disconnected."""
+        yield self.start_router(write_log_size=write_log_size)
+        yield self.start_db()
+        self.db = RamDatabase([])
+        self.state = dbproto.SyncState()
+        protocol, server = yield self.start_db(self.db, state=self.state)
+        self.client = yield self.start_client()
+        for i in range(10):
+            yield self.client.set("key{i}".format(i=i), "old", acks=2)
+        yield self.stop_db(protocol, server)
+        self.caught_up = []  # results of the catchups
+        catchup = self.factory.catchup
+
+        def record(proto, epoch, seq):
+            result = catchup(proto, epoch, seq)
+            self.caught_up.append(result)
+            return result
+        self.factory.catchup = record
+
+    @inlineCallbacks
+    def write(self, n):
+        """overwrites the first n keys and deletes key0."""
+        for i in range(n):
+            yield self.client.set("key{i}".format(i=i), "new", acks=1)
+        yield self.client.delete("key0", acks=1)
+
+    def assertWritten(self, n):
+        """asserts that self.db received the writes of write(n)."""
+        self.assertEqual(sorted(self.db.getkeys()), sorted(["key{i}".format(i=i) for i in range(1, max(n, 10))]))
+        for i in range(1, n):
+            self.assertEqual(self.db.get("key{i}".format(i=i)), "new")
+
+    @inlineCallbacks
+    def test_replay(self):
+        """a database whose missed writes are in the log receives them without a reset."""
+        yield self.start_cluster(2**20)
+        yield self.write(5)
+        yield self.start_db(self.db, state=self.state)
+        self.assertEqual(self.caught_up, [True])
+        self.assertWritten(5)
+        self.assertEqual(self.db.get("key7"), "old")
+
+    @inlineCallbacks
+    def test_truncated(self):
+        """a database which missed writes dropped from the log is reset from the other database."""
+        yield self.start_cluster(100)
+        yield self.write(50)
+        yield self.start_db(self.db, state=self.state)
+        self.assertEqual(self.caught_up, [False])
+        self.assertWritten(50)
+
+    @inlineCallbacks
+    def test_unknown_epoch(self):
+        """the state of another epoch is replayed from the first write if the log still holds it."""
+        yield self.start_cluster(2**20)
+        yield self.write(5)
+        self.db.reset()
+        self.state.epoch = self.factory.epoch + 2
+        yield self.start_db(self.db, state=self.state)
+        self.assertEqual(self.caught_up, [True])
+        self.assertWritten(5)
+
+    @inlineCallbacks
+    def test_unknown_epoch_truncated(self):
+        """the state of another epoch leads to a reset if the first writes were dropped from the log."""
+        yield self.start_cluster(100)
+        yield self.write(50)
+        self.db.reset()
+        self.state.epoch = self.factory.epoch + 2
+        yield self.start_db(self.db, state=self.state)
+        self.assertEqual(self.caught_up, [False])
+        self.assertWritten(50)
@@ -0,0 +1,15 @@
+"""tests for spreading the requests of a client over several routers."""
+from twisted.internet import reactor
+from twisted.trial import unittest
+
+from kvndb import txclient
+
+
+class ClientPoolTests(unittest.TestCase):
+    """tests for ClientPool without connected routers."""
+
+    def test_not_connected(self):
+        """all requests fail with NotConnected instead of raising it."""
+        pool = txclient.ClientPool(reactor, [], None)
+        for d in [pool.get("key"), pool.set("key", "value"), pool.delete("key"), pool.getkeys()]:
+            self.failureResultOf(d, txclient.NotConnected)
@@ -0,0 +1,54 @@
+"""tests for the group commit of the writes acknowledged by the databases."""
+from twisted.internet.defer import inlineCallbacks
+
+from kvndb import data
+from kvndb.ramdb import RamDatabase
+
+from .helpers import ClusterTestCase
+
+
+class FailingSyncDatabase(RamDatabase):
+    """a RamDatabase whose first syncs fail."""
+
+    def __init__(self, failures):
+        RamDatabase.__init__(self, [])
+        self.failures = failures
+
+    def sync(self):
+        """fails while failures are left."""
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError("sync failed")
+
+
+class CommitTests(ClusterTestCase):
+    """tests that the databases acknowledge the writes once they synced them."""
+
+    @inlineCallbacks
+    def test_sync_failure(self):
+        """a failed sync is retried and the writes are acknowledged by the next one."""
+        self.patch(data, "COMMIT_RETRY_INTERVAL", 0.05)
+        yield self.start_router()
+        protocol, server = yield self.start_db(FailingSyncDatabase(2))
+        client = yield self.start_client()
+        yield client.set("key", "value", acks=1, timeout=5)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 2)
+        self.assertEqual(protocol.commit_stats["commits"], 1)
+        self.assertEqual(protocol.commit_stats["writes"], 1)
+
+    @inlineCallbacks
+    def test_sharded_writes(self):
+        """in sharded mode every database counts the writes it received, not those of the other shards."""
+        yield self.start_router(replication=1)
+        protocols = []
+        for i in range(2):
+            protocol, server = yield self.start_db()
+            protocols.append(protocol)
+        yield self.wait_for_rebalance()
+        client = yield self.start_client()
+        for i in range(100):
+            client.set("key{i}".format(i=i), "value")
+        yield client.getkeys()
+        writes = [p.commit_stats["writes"] + p.commit_writes for p in protocols]
+        self.assertEqual(sum(writes), 100)
+        self.assertEqual(sorted(writes), sorted([len(p.db.getkeys()) for p in protocols]))
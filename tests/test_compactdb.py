@@ -0,0 +1,173 @@
+"""tests for the compact in memory database."""
+import random
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from kvndb import compactdb
+from kvndb.compactdb import CompactDatabase
+
+
+def record_size(key, value):
+    """returns the size of the record for key and value in the arena."""
+    return len(compactdb.pack_length(len(key))) + len(compactdb.pack_length(len(value))) + len(key) + len(value)
+
+
+class VarintTests(unittest.TestCase):
+    """tests for the record lengths."""
+
+    def test_roundtrip(self):
+        """lengths are read back from their encoding."""
+        for n in (0, 1, 0x7f, 0x80, 300, 2**14, 2**21 + 5, 2**31):
+            packed = bytearray("x" + compactdb.pack_length(n))
+            self.assertEqual(compactdb.unpack_length(packed, 1), (n, len(packed)))
+
+
+class CompactDatabaseTests(unittest.TestCase):
+    """tests for CompactDatabase."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = CompactDatabase([])
+        self.db.reactor = self.clock
+
+    def run_steps(self):
+        """runs the scheduled steps until the resize and the compaction are finished."""
+        while self.db.call is not None:
+            self.clock.advance(0)
+
+    def assertStored(self, model):
+        """asserts that the database stores exactly the keys and values of the dict model."""
+        self.assertEqual(sorted(self.db.getkeys()), sorted(model.keys()))
+        for key, value in model.items():
+            self.assertEqual(self.db.get(key), value)
+        self.assertEqual(self.db.stats()["keys"], len(model))
+
+    def test_set_get_delete(self):
+        """values can be overwritten with values of the same and of other sizes and deleted."""
+        self.db.set("key", "abc")
+        self.assertEqual(self.db.get("key"), "abc")
+        self.db.set("key", "xyz")
+        self.assertEqual(self.db.get("key"), "xyz")
+        self.db.set("key", "a longer value" * 20)
+        self.assertEqual(self.db.get("key"), "a longer value" * 20)
+        self.db.set("other", "")
+        self.assertEqual(self.db.get("other"), "")
+        self.db.delete("key")
+        self.assertRaises(KeyError, self.db.get, "key")
+        self.db.delete("key")
+        self.assertEqual(self.db.getkeys(), ["other"])
+        self.assertEqual(self.db.stats()["keys"], 1)
+
+    def test_resize(self):
+        """the index grows with the number of keys."""
+        slots = len(self.db.slots)
+        for i in range(slots * 4):
+            self.db.set("key{i}".format(i=i), str(i))
+        self.assertTrue(len(self.db.slots) > slots)
+        for i in range(slots * 4):
+            self.assertEqual(self.db.get("key{i}".format(i=i)), str(i))
+        self.assertEqual(len(self.db.getkeys()), slots * 4)
+
+    def test_capacity(self):
+        """an index sized for the expected number of keys is not resized."""
+        db = CompactDatabase(["10000"])
+        slots = len(db.slots)
+        for i in range(10000):
+            db.set("key{i}".format(i=i), "value")
+        self.assertEqual(len(db.slots), slots)
+
+    def test_model(self):
+        """random writes and deletes, including compactions, give the same results as a dict."""
+        rng = random.Random(1)
+        model = {}
+        for i in range(30000):
+            key = "key{i}".format(i=rng.randrange(3000))
+            if rng.random() < 0.2:
+                self.db.delete(key)
+                model.pop(key, None)
+            else:
+                value = "v" * rng.randrange(300)
+                self.db.set(key, value)
+                model[key] = value
+            if i % 1000 == 0:
+                self.clock.advance(0)
+        self.assertTrue(self.db.compactions > 0)
+        self.assertStored(model)
+        self.run_steps()
+        self.assertStored(model)
+        stats = self.db.stats()
+        self.assertEqual(stats["bytes"], sum([record_size(k, v) for k, v in model.items()]))
+
+    def test_incremental_resize(self):
+        """while the index grows in steps, all keys can be read, overwritten and deleted."""
+        model = {}
+        i = 0
+        while self.db.old is None:
+            key = "key{i}".format(i=i)
+            self.db.set(key, key)
+            model[key] = key
+            i += 1
+        self.assertIsNot(self.db.old, None)
+        self.assertStored(model)
+        for i in range(0, len(model), 3):
+            key = "key{i}".format(i=i)
+            self.db.set(key, "new")
+            model[key] = "new"
+            self.db.delete("key{i}".format(i=i + 1))
+            model.pop("key{i}".format(i=i + 1), None)
+        self.assertStored(model)
+        self.run_steps()
+        self.assertIs(self.db.old, None)
+        self.assertStored(model)
+
+    def test_incremental_compaction(self):
+        """while the arena is compacted in steps, all keys can be read and written."""
+        model = {}
+        for i in range(6000):
+            key = "key{i}".format(i=i)
+            self.db.set(key, "x" * 200)
+            model[key] = "x" * 200
+        self.run_steps()
+        size = len(self.db.arena)
+        for i in range(2, 6000, 2):
+            key = "key{i}".format(i=i)
+            self.db.delete(key)
+            del model[key]
+            if self.db.stats()["compacting"]:
+                break
+        self.assertStored(model)
+        self.db.set("key0", "z")
+        self.db.delete("key1")
+        model["key0"] = "z"
+        del model["key1"]
+        self.assertStored(model)
+        self.run_steps()
+        self.assertEqual(self.db.compactions, 1)
+        self.assertTrue(len(self.db.arena) < size)
+        self.assertStored(model)
+        self.assertEqual(self.db.stats()["bytes"], sum([record_size(k, v) for k, v in model.items()]))
+
+    def test_iterkeys_resize(self):
+        """an iterator returns every key stored during the iteration, even if the index grows meanwhile."""
+        keys = set(["key{i}".format(i=i) for i in range(500)])
+        for key in keys:
+            self.db.set(key, "value")
+        iterator = self.db.iterkeys()
+        seen = set([next(iterator) for i in range(100)])
+        generation = self.db.generation
+        for i in range(5000):
+            self.db.set("new{i}".format(i=i), "value")
+            if i % 500 == 0:
+                seen.add(next(iterator))
+        self.clock.advance(0)
+        seen.update(iterator)
+        self.assertTrue(self.db.generation > generation + 1)
+        self.assertEqual(keys - seen, set())
+
+    def test_reset(self):
+        """reset removes all keys."""
+        self.db.set("key", "value")
+        self.db.reset()
+        self.assertEqual(self.db.getkeys(), [])
+        self.assertRaises(KeyError, self.db.get, "key")
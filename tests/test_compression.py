@@ -0,0 +1,54 @@
+"""tests for compressing the values sent between the clients, the router and the databases."""
+from twisted.internet.defer import inlineCallbacks
+
+from kvndb import data
+from kvndb.ramdb import RamDatabase
+
+from .helpers import ClusterTestCase
+
+
+VALUE = "compressible " * 1000
+
+
+class CompressionTests(ClusterTestCase):
+    """tests that values keep their contents whichever side compresses or stores them compressed."""
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self.start_router()
+        self.stored = RamDatabase([])  # stores the values in the form sent by the router
+        self.plain = RamDatabase([])
+        yield self.start_db(self.stored, store_compressed=True)
+        yield self.start_db(self.plain)
+        yield self.wait_for_rebalance()
+        self.compressing = yield self.start_client(compression=6, compression_threshold=100)
+        self.client = yield self.start_client()
+
+    def test_negotiated(self):
+        """only clients which compress use the flag byte; the router converts the values for the others."""
+        self.assertTrue(self.compressing.compressed)
+        self.assertFalse(self.client.compressed)
+
+    @inlineCallbacks
+    def test_compressed_values(self):
+        """compressed values are stored compressed only by databases asking for it and read back by all clients."""
+        yield self.compressing.set("key", VALUE, acks=2)
+        yield self.compressing.set("small", "short", acks=2)
+        self.assertEqual(self.stored.get("key")[:1], data.VALUE_ZLIB)
+        self.assertTrue(len(self.stored.get("key")) < len(VALUE))
+        self.assertEqual(self.stored.get("small"), data.VALUE_RAW + "short")
+        self.assertEqual(self.plain.get("key"), VALUE)
+        self.assertEqual(self.plain.get("small"), "short")
+        for i in range(10):
+            for client in (self.compressing, self.client):
+                value = yield client.get("key")
+                self.assertEqual(value, VALUE)
+
+    @inlineCallbacks
+    def test_uncompressed_values(self):
+        """values of clients which do not compress are stored with the flag byte for the raw value."""
+        yield self.client.set("key", VALUE, acks=2)
+        self.assertEqual(self.stored.get("key"), data.VALUE_RAW + VALUE)
+        self.assertEqual(self.plain.get("key"), VALUE)
+        values = yield self.compressing.mget(["key", "missing"])
+        self.assertEqual(values, {"key": VALUE})
@@ -0,0 +1,120 @@
+"""tests for listing the keys and for the failover of requests to lost databases."""
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList, TimeoutError
+
+from kvndb import data
+
+from .helpers import ClusterTestCase, drop_messages, sleep
+
+
+KEYS = ["key{i}".format(i=i) for i in range(20)]
+
+
+class SilentDatabaseMixin(object):
+    """starts databases which store the writes but never answer reads."""
+
+    @inlineCallbacks
+    def start_silent_db(self):
+        """returns (protocol, server) of a database which does not answer reads."""
+        protocol, server = yield self.start_db()
+        drop_messages(protocol, (data.ID_GET, data.ID_MGET, data.ID_GETKEYS))
+        returnValue((protocol, server))
+
+    @inlineCallbacks
+    def stop_db(self, protocol, server):
+        """disconnects a database and waits until the router removed it."""
+        protocol.transport.loseConnection()
+        while server in self.factory.servers:
+            yield sleep(0.05)
+
+
+class GetkeysTests(ClusterTestCase):
+    """tests for getkeys."""
+
+    @inlineCallbacks
+    def test_no_databases(self):
+        """without databases, the key list is empty."""
+        yield self.start_router()
+        client = yield self.start_client()
+        keys = yield client.getkeys()
+        self.assertEqual(list(keys), [])
+
+    @inlineCallbacks
+    def test_no_databases_sharded(self):
+        """without databases, the key list is empty in sharded mode too."""
+        yield self.start_router(replication=2)
+        client = yield self.start_client()
+        keys = yield client.getkeys()
+        self.assertEqual(list(keys), [])
+
+    @inlineCallbacks
+    def test_sharded(self):
+        """in sharded mode, the keys of all databases are merged."""
+        yield self.start_router(replication=1)
+        dbs = []
+        for i in range(3):
+            protocol, server = yield self.start_db()
+            dbs.append(protocol.db)
+        yield self.wait_for_rebalance()
+        client = yield self.start_client()
+        for key in KEYS:
+            yield client.set(key, "value", acks=1)
+        keys = yield client.getkeys()
+        self.assertEqual(sorted(keys), sorted(KEYS))
+        self.assertTrue(all(len(db.getkeys()) < len(KEYS) for db in dbs))
+
+
+class FailoverTests(SilentDatabaseMixin, ClusterTestCase):
+    """tests that reads sent to a lost database are answered by the others."""
+
+    @inlineCallbacks
+    def setUp(self):
+        # spread the reads over both databases
+        yield self.start_router(read_policy="random")
+        yield self.start_db()
+        self.silent = yield self.start_silent_db()
+        self.client = yield self.start_client()
+        for key in KEYS:
+            yield self.client.set(key, "value", acks=2)
+
+    @inlineCallbacks
+    def fail_over(self, ds):
+        """loses the silent database once ds were sent and returns their results."""
+        yield sleep(0.1)
+        self.assertTrue(self.silent[1].outstanding > 0)
+        yield self.stop_db(*self.silent)
+        results = yield DeferredList(ds, fireOnOneErrback=True)
+        returnValue([result for success, result in results])
+
+    @inlineCallbacks
+    def test_getkeys(self):
+        """a key list requested from a lost database is requested from another one."""
+        results = yield self.fail_over([self.client.getkeys() for i in range(20)])
+        for keys in results:
+            self.assertEqual(sorted(keys), sorted(KEYS))
+
+    @inlineCallbacks
+    def test_get(self):
+        """a value requested from a lost database is requested from another one."""
+        results = yield self.fail_over([self.client.get(key) for key in KEYS])
+        self.assertEqual(results, ["value"] * len(KEYS))
+
+    @inlineCallbacks
+    def test_mget(self):
+        """a batch get sent to a lost database is sent to another one."""
+        results = yield self.fail_over([self.client.mget(KEYS) for i in range(20)])
+        for values in results:
+            self.assertEqual(values, dict([(key, "value") for key in KEYS]))
+
+
+class DeadlineTests(SilentDatabaseMixin, ClusterTestCase):
+    """tests that reads fail once their deadline passed."""
+
+    @inlineCallbacks
+    def test_deadline(self):
+        """reads which are not answered before their deadline fail with a TimeoutError."""
+        yield self.start_router()
+        yield self.start_silent_db()
+        client = yield self.start_client()
+        yield self.assertFailure(client.get("key", timeout=0.2), TimeoutError)
+        yield self.assertFailure(client.getkeys(timeout=0.2), TimeoutError)
+        yield self.assertFailure(client.mget(KEYS, timeout=0.2), TimeoutError)
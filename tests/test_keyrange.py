@@ -0,0 +1,138 @@
+"""tests for the requests of the sorted keys in a range."""
+import random
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from kvndb import data, utils
+from kvndb.ramdb import RamDatabase
+
+from .helpers import ClusterTestCase
+
+
+class DictDatabase(object):
+    """a database without an index of its own, whose keys are filtered by utils.keyrange()."""
+    blocking = False
+
+    def __init__(self):
+        self.db = {}
+
+    def get(self, key):
+        """returns the value for key."""
+        return self.db[key]
+
+    def set(self, key, value):
+        """sets key to value"""
+        self.db[key] = value
+
+    def delete(self, key):
+        """deletes the key/value pair for key."""
+        self.db.pop(key, None)
+
+    def getkeys(self):
+        """returns a list of keys."""
+        return self.db.keys()
+
+    def reset(self):
+        """resets the database."""
+        self.db = {}
+
+    def close(self):
+        """closes the database."""
+        pass
+
+
+class SortedKeysTests(unittest.TestCase):
+    """tests SortedKeys against a sorted list of the keys."""
+
+    def setUp(self):
+        # split the blocks often
+        self.patch(data, "SORTED_BLOCK_SIZE", 8)
+        self.rng = random.Random(42)
+
+    def random_range(self):
+        """returns random arguments for a key range request."""
+        start = "key{i}".format(i=self.rng.randrange(200))
+        end = self.rng.choice([None, "key{i}".format(i=self.rng.randrange(200))])
+        return start, end, self.rng.choice([0, 1, 5, 50]), self.rng.random() < 0.5
+
+    def test_model(self):
+        """adding and removing keys keeps the ranges equal to those of the sorted keys."""
+        keys = set(["key{i}".format(i=i) for i in range(0, 200, 3)])
+        index = utils.SortedKeys(keys)
+        for n in range(3000):
+            key = "key{i}".format(i=self.rng.randrange(200))
+            if self.rng.random() < 0.6:
+                index.add(key)
+                keys.add(key)
+            else:
+                index.discard(key)
+                keys.discard(key)
+            self.assertEqual(len(index), len(keys))
+            args = self.random_range()
+            self.assertEqual(index.range(*args), utils.filter_keyrange(keys, *args))
+        self.assertEqual(index.range(""), sorted(keys))
+        for key in list(keys):
+            index.discard(key)
+        self.assertEqual(index.range(""), [])
+
+    def test_prefix_end(self):
+        """prefix_end returns the first key after all keys with the prefix."""
+        self.assertEqual(utils.prefix_end("ab"), "ac")
+        self.assertEqual(utils.prefix_end("a\xff"), "b")
+        self.assertEqual(utils.prefix_end("\xff\xff"), None)
+        self.assertEqual(utils.prefix_end(""), None)
+
+    def test_merge_keys(self):
+        """merge_keys merges sorted lists without duplicates in both directions."""
+        self.assertEqual(utils.merge_keys([["a", "c"], ["b", "c", "d"], []]), ["a", "b", "c", "d"])
+        self.assertEqual(utils.merge_keys([["c", "a"], ["d", "c", "b"]], reverse=True), ["d", "c", "b", "a"])
+
+    def test_request_string(self):
+        """the arguments of a key range request survive the conversion to a string."""
+        for args in [("a", None, 0, False), ("a", "b", 10, True), ("", "\x00", 1, False)]:
+            self.assertEqual(utils.string2keyrange(utils.keyrange2string(*args)), args)
+
+
+class KeyRangeTests(ClusterTestCase):
+    """tests key range requests to a sharded router."""
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self.start_router(replication=1)
+        for db in [RamDatabase([]), DictDatabase()]:
+            yield self.start_db(db)
+        yield self.wait_for_rebalance()
+        self.client = yield self.start_client()
+        self.keys = ["{p}{i:03}".format(p=prefix, i=i) for prefix in ("a", "b") for i in range(100)]
+        for key in self.keys:
+            self.client.set(key, "value")
+        yield self.client.getkeys()
+
+    @inlineCallbacks
+    def test_ranges(self):
+        """the router merges the sorted keys of all shards."""
+        for args in [("", None, 0, False), ("a050", "b010", 0, False), ("a050", None, 20, False), ("a", "b", 7, True)]:
+            keys = yield self.client.keyrange(*args)
+            self.assertEqual(keys, utils.filter_keyrange(self.keys, *args))
+
+    @inlineCallbacks
+    def test_prefix(self):
+        """prefix returns the keys with a prefix."""
+        keys = yield self.client.prefix("b", limit=0)
+        self.assertEqual(keys, [key for key in self.keys if key.startswith("b")])
+        keys = yield self.client.prefix("a09", reverse=True)
+        self.assertEqual(keys, ["a0{i}".format(i=i) for i in range(99, 89, -1)])
+
+    @inlineCallbacks
+    def test_pages(self):
+        """paging with the last key returns every key once."""
+        found = []
+        start = ""
+        while True:
+            keys = yield self.client.keyrange(start, limit=30)
+            found += keys
+            if len(keys) < 30:
+                break
+            start = keys[-1] + "\x00"
+        self.assertEqual(found, self.keys)
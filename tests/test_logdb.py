@@ -0,0 +1,128 @@
+"""tests for the log-structured database."""
+import os
+
+from twisted.trial import unittest
+
+from kvndb import logdb
+from kvndb.logdb import LogDatabase
+
+
+class LogDatabaseTests(unittest.TestCase):
+    """tests that LogDatabase keeps the written data across restarts and crashes."""
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.db = LogDatabase([self.path])
+        self.addCleanup(lambda: self.db.close())
+
+    def reopen(self, *args):
+        """closes the database and opens it again."""
+        self.db.close()
+        self.db = LogDatabase([self.path] + list(args))
+
+    def wait(self):
+        """waits until the background thread wrote the hint files and finished merging."""
+        worker = self.db.worker
+        if worker is not None:
+            worker.join()
+
+    def active_path(self):
+        """returns the path of the active segment."""
+        return os.path.join(self.path, logdb.segment_name(self.db.active_id, logdb.DATA_SUFFIX))
+
+    def test_reopen(self):
+        """values, overwrites and deletes are kept after reopening."""
+        for i in range(100):
+            self.db.set("key{i}".format(i=i), "value{i}".format(i=i))
+        self.db.set("key1", "new")
+        self.db.delete("key2")
+        self.reopen()
+        self.assertEqual(self.db.get("key1"), "new")
+        self.assertEqual(self.db.get("key99"), "value99")
+        self.assertRaises(KeyError, self.db.get, "key2")
+        self.assertEqual(len(self.db.getkeys()), 99)
+
+    def test_reopen_segments(self):
+        """keys spread over several segments with hint files are found after reopening."""
+        self.reopen("1000")
+        for i in range(200):
+            self.db.set("key{i}".format(i=i), "x" * 20)
+        self.db.delete("key0")
+        self.assertTrue(len(self.db.sizes) > 2)
+        self.reopen("1000")
+        self.assertEqual(sorted(self.db.getkeys()), sorted(["key{i}".format(i=i) for i in range(1, 200)]))
+        self.assertEqual(self.db.get("key150"), "x" * 20)
+        self.db.merge()
+        self.reopen("1000")
+        self.assertEqual(len(self.db.getkeys()), 199)
+        self.assertEqual(self.db.get("key1"), "x" * 20)
+        self.assertRaises(KeyError, self.db.get, "key0")
+
+    def test_hints(self):
+        """the rotated segments get hint files, which are used for reopening."""
+        self.reopen("1000")
+        for i in range(200):
+            self.db.set("key{i}".format(i=i), "x" * 20)
+        self.wait()
+        for segment_id in self.db.segments:
+            self.assertTrue(os.path.exists(os.path.join(self.path, logdb.segment_name(segment_id, logdb.HINT_SUFFIX))))
+        self.patch(logdb, "read_records", lambda path: iter([]))
+        self.reopen("1000")
+        self.assertEqual(self.db.get("key10"), "x" * 20)
+        self.assertTrue(len(self.db.getkeys()) > 150)
+
+    def test_merge_crash(self):
+        """a crash after writing the merged segment and before removing the old ones does not bring back deleted keys."""
+        self.reopen("1000")
+        for i in range(100):
+            self.db.set("key{i}".format(i=i), "x" * 20)
+        self.db.delete("key0")
+        for i in range(100, 150):
+            self.db.set("key{i}".format(i=i), "x" * 20)
+        self.wait()
+        sync_dir = logdb.sync_dir
+
+        def crash(path):
+            raise IOError("crashed")
+        logdb.sync_dir = crash
+        try:
+            self.db.merge()
+        finally:
+            logdb.sync_dir = sync_dir
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        self.reopen("1000")
+        self.assertRaises(KeyError, self.db.get, "key0")
+        self.assertEqual(self.db.get("key1"), "x" * 20)
+        self.assertEqual(len(self.db.getkeys()), 149)
+        self.db.merge()
+        self.reopen("1000")
+        self.assertRaises(KeyError, self.db.get, "key0")
+        self.assertEqual(len(self.db.getkeys()), 149)
+
+    def test_torn_write(self):
+        """an incomplete record at the end of the log is dropped and the following writes are kept."""
+        self.db.set("key1", "value1")
+        self.db.set("key2", "value2")
+        self.db.sync()
+        size = os.path.getsize(self.active_path())
+        with open(self.active_path(), "ab") as f:
+            f.write(logdb.pack_record(logdb.FLAG_VALUE, "key3", "value3")[:-3])
+        self.reopen()
+        self.assertEqual(os.path.getsize(self.active_path()), size)
+        self.assertRaises(KeyError, self.db.get, "key3")
+        self.db.set("key4", "value4")
+        self.reopen()
+        self.assertEqual(self.db.get("key2"), "value2")
+        self.assertEqual(self.db.get("key4"), "value4")
+        self.assertEqual(sorted(self.db.getkeys()), ["key1", "key2", "key4"])
+
+    def test_corrupted_record(self):
+        """a record at the end of the log whose checksum does not match is dropped."""
+        self.db.set("key1", "value1")
+        self.db.set("key1", "value2")
+        self.db.sync()
+        with open(self.active_path(), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write("X")
+        self.reopen()
+        self.assertEqual(self.db.get("key1"), "value1")
@@ -0,0 +1,74 @@
+"""tests for the invalidation of the near caches of the clients."""
+from twisted.internet.defer import inlineCallbacks
+
+from .helpers import ClusterTestCase
+
+
+class NearCacheTests(ClusterTestCase):
+    """tests that clients never keep serving a value another client overwrote."""
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self.start_router()
+        yield self.start_db()
+        self.a = yield self.start_client(cache_size=100000)
+        self.b = yield self.start_client(cache_size=100000)
+
+    @inlineCallbacks
+    def roundtrip(self, *clients):
+        """waits until the router handled the earlier messages of clients and they received its answers."""
+        for client in clients:
+            yield client.getkeys()
+
+    @inlineCallbacks
+    def test_read_value_invalidated(self):
+        """a value read by a client is dropped from its cache when another client writes it."""
+        yield self.a.set("key", "a", acks=1)
+        value = yield self.a.get("key")
+        self.assertEqual(value, "a")
+        yield self.b.set("key", "b", acks=1)
+        yield self.roundtrip(self.a)
+        value = yield self.a.get("key")
+        self.assertEqual(value, "b")
+
+    @inlineCallbacks
+    def test_written_value_invalidated(self):
+        """a value a client wrote itself is dropped from its cache when another client writes it."""
+        yield self.a.set("key", "a", acks=1)
+        self.assertEqual(self.a.cache.get("key"), "a")
+        yield self.b.set("key", "b", acks=1)
+        yield self.roundtrip(self.a)
+        value = yield self.a.get("key")
+        self.assertEqual(value, "b")
+        # b still caches its own write, which a now replaces
+        yield self.a.set("key", "c", acks=1)
+        yield self.roundtrip(self.b)
+        value = yield self.b.get("key")
+        self.assertEqual(value, "c")
+
+    @inlineCallbacks
+    def test_batch_written_values_invalidated(self):
+        """values written by a batch set are dropped from the cache of the writer when another client writes them."""
+        self.a.mset([("key1", "a"), ("key2", "a")])
+        yield self.roundtrip(self.a)
+        self.b.mset([("key1", "b"), ("key2", "b")])
+        yield self.roundtrip(self.b, self.a)
+        values = yield self.a.mget(["key1", "key2"])
+        self.assertEqual(values, {"key1": "b", "key2": "b"})
+
+    @inlineCallbacks
+    def test_delete_invalidates(self):
+        """a value deleted by another client is dropped from the cache."""
+        yield self.a.set("key", "a", acks=1)
+        yield self.b.delete("key", acks=1)
+        yield self.roundtrip(self.a)
+        yield self.assertFailure(self.a.get("key"), KeyError)
+
+    @inlineCallbacks
+    def test_own_write_cached(self):
+        """reads by other clients do not invalidate the cache of the writer."""
+        yield self.a.set("key", "a", acks=1)
+        value = yield self.b.get("key")
+        self.assertEqual(value, "a")
+        yield self.roundtrip(self.a)
+        self.assertEqual(self.a.cache.get("key"), "a")
@@ -0,0 +1,80 @@
+"""tests for the eviction and iteration of keys by the in memory database."""
+from twisted.trial import unittest
+
+from kvndb import data
+from kvndb.ramdb import RamDatabase
+
+
+class RamDatabaseTests(unittest.TestCase):
+    """tests for RamDatabase with a maximum memory."""
+
+    def fill(self, db, n=1000):
+        """writes n keys of 100 bytes to db, checking that the memory stays below the maximum."""
+        for i in range(n):
+            db.set("key{i}".format(i=i), "x" * 100)
+            self.assertTrue(db.memory() <= db.maxmemory)
+            self.assertEqual(db.bytes, sum([len(key) + len(value) for key, value in db.db.items()]))
+
+    def test_unbounded(self):
+        """without a maximum memory, no keys are evicted."""
+        db = RamDatabase([])
+        self.assertFalse(db.lossy)
+        for i in range(1000):
+            db.set("key{i}".format(i=i), "x" * 100)
+        self.assertEqual(len(db.getkeys()), 1000)
+
+    def test_policies(self):
+        """every policy keeps the memory below the maximum and counts the evictions."""
+        for policy in data.RAMDB_EVICTION_POLICIES:
+            db = RamDatabase(["20000", policy])
+            self.assertTrue(db.lossy)
+            self.fill(db)
+            stats = db.stats()
+            self.assertEqual(stats["keys"], len(db.getkeys()))
+            self.assertEqual(stats["evictions"], 1000 - stats["keys"])
+            self.assertTrue(stats["keys"] > 50, stats)
+            db.delete(db.getkeys()[0])
+            self.assertEqual(db.bytes, sum([len(key) + len(value) for key, value in db.db.items()]))
+
+    def test_lru(self):
+        """'lru' evicts the least recently used keys."""
+        db = RamDatabase(["20000", "lru"])
+        db.set("hot", "x" * 100)
+        for i in range(1000):
+            db.set("key{i}".format(i=i), "x" * 100)
+            db.get("hot")
+        self.assertEqual(db.get("hot"), "x" * 100)
+        self.assertEqual(db.get("key999"), "x" * 100)
+        self.assertRaises(KeyError, db.get, "key500")
+
+    def test_lfu(self):
+        """'lfu' keeps the frequently used keys."""
+        db = RamDatabase(["20000", "lfu"])
+        for i in range(1000):
+            db.set("key{i}".format(i=i), "x" * 100)
+            if i < 10:
+                for j in range(50):
+                    db.get("key{i}".format(i=i))
+        hot = [i for i in range(10) if "key{i}".format(i=i) in db.db]
+        self.assertTrue(len(hot) >= 8, hot)
+
+    def test_invalid_policy(self):
+        """unknown eviction policies are rejected."""
+        self.assertRaises(ValueError, RamDatabase, ["1000", "mru"])
+
+    def test_iterkeys_writes(self):
+        """keys stored during an iteration are returned once, whatever is written meanwhile."""
+        db = RamDatabase([])
+        for i in range(5000):
+            db.set("key{i:05}".format(i=i), "x")
+        iterator = db.iterkeys()
+        seen = []
+        for i, key in enumerate(iterator):
+            seen.append(key)
+            if i % 10 == 0:
+                db.set("new{i}".format(i=i), "x")
+                db.delete("key{i:05}".format(i=4999 - i))
+        kept = ["key{i:05}".format(i=i) for i in range(5000) if "key{i:05}".format(i=i) in db.db]
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(set(kept) - set(seen), set())
+        self.assertEqual(seen, sorted(seen))
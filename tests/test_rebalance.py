@@ -0,0 +1,106 @@
+"""tests for moving the keys between the databases when databases join or leave a sharded router."""
+from twisted.internet.defer import inlineCallbacks
+
+from kvndb import data
+from kvndb.ramdb import RamDatabase
+
+from .helpers import ClusterTestCase, drop_messages, sleep
+
+
+KEYS = ["key{i}".format(i=i) for i in range(400)]
+
+
+class RebalanceTests(ClusterTestCase):
+    """tests that every key stays readable and ends up on its owners."""
+
+    @inlineCallbacks
+    def start_cluster(self, replication, dbs):
+        """starts a router and the databases dbs and writes KEYS."""
+        yield self.start_router(replication=replication)
+        self.dbs = {}  # server -> database
+        self.protocols = {}  # server -> DatabaseClientProtocol
+        for db in dbs:
+            yield self.add_db(db)
+        yield self.wait_for_rebalance()
+        self.client = yield self.start_client()
+        for key in KEYS:
+            self.client.set(key, "value-" + key)
+        yield self.client.getkeys()
+
+    @inlineCallbacks
+    def add_db(self, db):
+        """connects db to the router."""
+        protocol, server = yield self.start_db(db)
+        self.dbs[server] = db
+        self.protocols[server] = protocol
+
+    @inlineCallbacks
+    def remove_db(self, server):
+        """disconnects the database of server and waits until the router removed it."""
+        self.protocols.pop(server).transport.loseConnection()
+        del self.dbs[server]
+        while server in self.factory.servers:
+            yield sleep(0.05)
+
+    @inlineCallbacks
+    def assertReadable(self):
+        """asserts that all keys can be read."""
+        values = yield self.client.mget(KEYS)
+        self.assertEqual(values, dict([(key, "value-" + key) for key in KEYS]))
+        for key in KEYS[:50]:
+            value = yield self.client.get(key)
+            self.assertEqual(value, "value-" + key)
+
+    def assertPlaced(self):
+        """asserts that every database which does not evict keys stores exactly the keys it owns."""
+        for server, db in self.dbs.items():
+            if db.lossy:
+                continue
+            owned = [key for key in KEYS if server in self.factory.placement_ring.get_nodes(key, self.factory.replication)]
+            self.assertEqual(sorted(db.getkeys()), sorted(owned))
+
+    @inlineCallbacks
+    def test_join(self):
+        """a joining database receives the keys it owns and the others drop them."""
+        yield self.start_cluster(2, [RamDatabase([]), RamDatabase([])])
+        yield self.add_db(RamDatabase([]))
+        yield self.wait_for_rebalance()
+        yield self.assertReadable()
+        self.assertPlaced()
+
+    @inlineCallbacks
+    def test_leave(self):
+        """the keys of a leaving database are copied to their new owners."""
+        yield self.start_cluster(2, [RamDatabase([]), RamDatabase([]), RamDatabase([])])
+        self.assertPlaced()
+        yield self.remove_db(self.dbs.keys()[0])
+        yield self.wait_for_rebalance()
+        yield self.assertReadable()
+        self.assertPlaced()
+
+    @inlineCallbacks
+    def test_join_lossy_owner(self):
+        """keys evicted by a lossy owner are copied from the owners which do not evict keys."""
+        lossy = RamDatabase(["3000"])
+        yield self.start_cluster(2, [lossy, RamDatabase([])])
+        self.assertTrue(lossy.evictions > 0)
+        yield self.assertReadable()
+        yield self.add_db(RamDatabase([]))
+        yield self.wait_for_rebalance()
+        yield self.assertReadable()
+        self.assertPlaced()
+
+    @inlineCallbacks
+    def test_unconfirmed_copies_kept(self):
+        """a database does not drop keys which did not arrive on their new owner."""
+        yield self.start_cluster(1, [RamDatabase([])])
+        old = self.dbs.values()[0]
+        broken = RamDatabase([])
+        yield self.add_db(broken)
+        # the new database loses the keys it loaded when it joined and all writes
+        server = [server for server, db in self.dbs.items() if db is broken][0]
+        drop_messages(self.protocols[server], (data.ID_SET, data.ID_MSET))
+        broken.reset()
+        yield self.wait_for_rebalance()
+        self.assertEqual(broken.getkeys(), [])
+        self.assertEqual(sorted(old.getkeys()), sorted(KEYS))
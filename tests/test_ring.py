@@ -0,0 +1,85 @@
+"""tests for the consistent hash ring."""
+from twisted.trial import unittest
+
+from kvndb.ring import HashRing
+
+
+class Node(object):
+    """a node placed on the ring."""
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+    def __repr__(self):
+        return "Node({i!r})".format(i=self.node_id)
+
+
+KEYS = ["key{i}".format(i=i) for i in range(2000)]
+
+
+class HashRingTests(unittest.TestCase):
+    """tests for HashRing."""
+
+    def setUp(self):
+        self.nodes = [Node("db{i}".format(i=i)) for i in range(4)]
+        self.ring = HashRing(nodes=self.nodes)
+
+    def placement(self, ring, n=1):
+        """returns a dict mapping every key to the node ids of its owners."""
+        return dict([(key, [node.node_id for node in ring.get_nodes(key, n)]) for key in KEYS])
+
+    def test_distinct_owners(self):
+        """a key is placed on n distinct nodes, but never on more nodes than the ring has."""
+        for key in KEYS[:100]:
+            owners = self.ring.get_nodes(key, 3)
+            self.assertEqual(len(owners), 3)
+            self.assertEqual(len(set(owners)), 3)
+            self.assertEqual(len(self.ring.get_nodes(key, 10)), 4)
+
+    def test_same_placement(self):
+        """the placement only depends on the node ids, not on the objects or the order they were added in."""
+        other = HashRing(nodes=[Node(node.node_id) for node in reversed(self.nodes)])
+        self.assertEqual(self.placement(self.ring, 2), self.placement(other, 2))
+
+    def test_balance(self):
+        """every node owns a fair share of the keys."""
+        counts = {}
+        for owners in self.placement(self.ring).values():
+            counts[owners[0]] = counts.get(owners[0], 0) + 1
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertTrue(len(KEYS) / 8 < count < len(KEYS) / 2, counts)
+
+    def test_join_moves_few_keys(self):
+        """a joining node only takes keys from the others; no key moves between the old nodes."""
+        before = self.placement(self.ring)
+        self.ring.add(Node("db4"))
+        after = self.placement(self.ring)
+        moved = [key for key in KEYS if before[key] != after[key]]
+        self.assertTrue(0 < len(moved) < len(KEYS) / 3, len(moved))
+        for key in moved:
+            self.assertEqual(after[key], ["db4"])
+
+    def test_leave_moves_only_its_keys(self):
+        """the keys of a leaving node move to the next owners; the others stay."""
+        before = self.placement(self.ring, 2)
+        self.ring.remove(self.nodes[0])
+        after = self.placement(self.ring, 2)
+        self.assertNotIn(self.nodes[0], self.ring)
+        self.assertEqual(len(self.ring), 3)
+        for key in KEYS:
+            if "db0" in before[key]:
+                self.assertNotIn("db0", after[key])
+                self.assertIn([node for node in before[key] if node != "db0"][0], after[key])
+            else:
+                self.assertEqual(before[key], after[key])
+
+    def test_allowed(self):
+        """skipping nodes which are not allowed gives the same owners as a ring without them."""
+        allowed = self.nodes[1:]
+        without = HashRing(nodes=allowed)
+        for key in KEYS[:200]:
+            self.assertEqual(self.ring.get_nodes(key, 2, allowed=allowed), without.get_nodes(key, 2))
+
+    def test_empty(self):
+        """an empty ring places keys nowhere."""
+        self.assertEqual(HashRing().get_nodes("key", 2), [])
@@ -0,0 +1,59 @@
+"""tests for queueing the writes to databases whose connection can not keep up."""
+from twisted.internet.defer import inlineCallbacks
+
+from .helpers import ClusterTestCase, sleep
+
+
+class WriteQueueTests(ClusterTestCase):
+    """tests for the WriteQueue of a database whose send buffer is full."""
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self.start_router(queue_high=1000, queue_low=100)
+        self.protocol, self.server = yield self.start_db()
+        self.client = yield self.start_client()
+        self.queue = self.server.queue
+        # what the transport does once the send buffer is full
+        self.queue.pauseProducing()
+
+    @inlineCallbacks
+    def test_coalesce(self):
+        """queued writes to a key are coalesced and the database receives the latest value."""
+        self.client.set("key", "a")
+        self.client.set("other", "x")
+        self.client.set("key", "b")
+        self.client.delete("other")
+        yield self.client.getkeys()
+        self.assertEqual(self.queue.stats()["coalesced"], 2)
+        self.assertEqual(self.queue.writes.keys(), ["key", "other"])
+        self.queue.resumeProducing()
+        yield self.client.getkeys()
+        self.assertEqual(len(self.queue.writes), 0)
+        self.assertEqual(self.protocol.db.get("key"), "b")
+        self.assertRaises(KeyError, self.protocol.db.get, "other")
+
+    @inlineCallbacks
+    def test_read_queued(self):
+        """reads of a key with a queued write are answered from the queue."""
+        self.client.set("key", "queued")
+        self.client.set("deleted", "x")
+        self.client.delete("deleted")
+        value = yield self.client.get("key")
+        self.assertEqual(value, "queued")
+        self.assertRaises(KeyError, self.protocol.db.get, "key")
+        yield self.assertFailure(self.client.get("deleted"), KeyError)
+
+    @inlineCallbacks
+    def test_pause_clients(self):
+        """the clients are paused while a queue is above the high water mark and resumed once it drained."""
+        self.client.set("key", "x" * 2000)
+        yield sleep(0.1)
+        self.assertIn(self.queue, self.factory.congested)
+        d = self.client.get("key")
+        yield sleep(0.1)
+        self.assertFalse(d.called)
+        self.queue.resumeProducing()
+        value = yield d
+        self.assertEqual(value, "x" * 2000)
+        self.assertEqual(len(self.factory.congested), 0)
+        self.assertEqual(self.protocol.db.get("key"), "x" * 2000)